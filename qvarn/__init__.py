@@ -102,6 +102,24 @@ from .write_only import (
     CannotAddWithId,
     CannotAddWithRevision,
     WrongRevision,
+    json_document_column,
+    make_json_document,
+    id_chunks,
+)
+
+from .search_plan_cache import (
+    SearchPlanCache,
+)
+
+from .item_cache import (
+    ItemCache,
+)
+
+from .etag import (
+    format_etag,
+    etag_matches,
+    set_etag,
+    not_modified,
 )
 
 from .read_only import (
@@ -109,6 +127,7 @@ from .read_only import (
     ItemDoesNotExist,
     FieldNotInResource,
     create_search_param,
+    select_revision,
 )
 
 from .restype_storage import (
@@ -130,6 +149,9 @@ from .util import (
     table_name,
     ComplicatedTableNameError,
     create_tables_for_resource_type,
+    create_indexes_for_resource_type,
+    index_columns_from_schema,
+    index_name,
 )
 
 from .simple_resource import (
@@ -160,6 +182,21 @@ from .string_to_unicode_plugin import (
     StringToUnicodePlugin,
 )
 
+from .notification_waker import (
+    NotificationWaker,
+    DatabaseNotificationWaker,
+    create_notification_waker,
+)
+
+from .notification_sweeper import (
+    NotificationSweeper,
+)
+
+from .listener_registry import (
+    ListenerRegistry,
+    ListenerIndex,
+)
+
 from .listener_resource import (
     ListenerResource,
     listener_prototype,
@@ -180,8 +217,16 @@ from .schema import (
     schema_from_prototype,
 )
 
+from .field_index import (
+    FieldIndex,
+    FieldColumn,
+)
+
 from .versioned_storage import (
     VersionedStorage,
+    UnknownSearchIndexRule,
+    SearchIndexFieldNotInResource,
+    NoMainPrototype,
 )
 
 from .resource_server import (
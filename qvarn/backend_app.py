@@ -284,6 +284,11 @@ class BackendApplication(object):
             with self._dbconn.transaction() as t:
                 for vs in self._vs_list:
                     vs.prepare_storage(t)
+            with self._dbconn.transaction(autocommit=True) as t:
+                for vs in self._vs_list:
+                    vs.create_indexes(t)
+            for vs in self._vs_list:
+                vs.fill_json_documents(self._dbconn)
 
     def _configure_logging(self, conf):  # pragma: no cover
         lognames = ['log', 'log2', 'log3', 'log4', 'log5']
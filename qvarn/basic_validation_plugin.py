@@ -68,6 +68,10 @@ class BasicValidationPlugin(object):
 
     def _check_json_for_create(self):
         item = bottle.request.qvarn_json
+        # Only an object can have an id or a revision. The route
+        # itself checks that the body has the shape it needs.
+        if not isinstance(item, dict):
+            return
         if u'id' in item:
             raise NewItemHasIdAlready(item_id=item[u'id'])
         if u'revision' in item:
@@ -75,6 +79,8 @@ class BasicValidationPlugin(object):
 
     def _check_json_for_update(self, kwargs):
         item = bottle.request.qvarn_json
+        if not isinstance(item, dict):
+            return
         item_route_id = kwargs[self._id_field_name]
         if u'id' in item and item[u'id'] != item_route_id:
             raise ItemHasConflictingId(
@@ -0,0 +1,190 @@
+# basic_validation_plugin_tests.py - unit tests for BasicValidationPlugin
+#
+# Copyright 2017 QvarnLabs Ltd
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import json
+import StringIO
+import unittest
+import wsgiref.util
+
+import bottle
+
+import qvarn
+
+
+class AppTestBase(unittest.TestCase):
+
+    def setUp(self):
+        self.app = bottle.Bottle()
+        self.app.install(qvarn.ErrorTransformPlugin())
+
+    def tearDown(self):
+        # Reset bottle request.
+        bottle.request = bottle.LocalRequest()
+
+    def request(self, method, path, body=None,
+                content_type='application/json'):
+        if not isinstance(body, str):
+            body = json.dumps(body)
+        environ = {}
+        wsgiref.util.setup_testing_defaults(environ)
+        environ.update({
+            'REQUEST_METHOD': method,
+            'PATH_INFO': path,
+            'CONTENT_TYPE': content_type,
+            'CONTENT_LENGTH': str(len(body)),
+            'wsgi.input': StringIO.StringIO(body),
+        })
+        statuses = []
+
+        def start_response(status, headers, exc_info=None):
+            statuses.append(status)
+
+        output = ''.join(self.app(environ, start_response))
+        return int(statuses[0].split()[0]), json.loads(output)
+
+
+class BasicValidationPluginTests(AppTestBase):
+
+    def setUp(self):
+        super(BasicValidationPluginTests, self).setUp()
+        self.app.route(
+            '/things', method='POST', callback=self.callback,
+            apply=qvarn.BasicValidationPlugin())
+        self.app.route(
+            '/things/<thing_id>', method='PUT', callback=self.callback,
+            apply=qvarn.BasicValidationPlugin(u'thing_id'))
+        self.app.route(
+            '/things', method='GET', callback=self.callback,
+            apply=qvarn.BasicValidationPlugin())
+
+    def callback(self, **kwargs):
+        return {u'body': getattr(bottle.request, 'qvarn_json', u'unset')}
+
+    def test_passes_new_item_to_route(self):
+        self.assertEqual(
+            self.request('POST', '/things', {u'foo': u'bar'}),
+            (200, {u'body': {u'foo': u'bar'}}))
+
+    def test_rejects_content_that_is_not_json(self):
+        for body, content_type in [('{}', 'text/plain'),
+                                   ('{', 'application/json')]:
+            status, error = self.request(
+                'POST', '/things', body, content_type=content_type)
+            self.assertEqual(status, 400)
+            self.assertEqual(error[u'error_code'], u'ContentIsNotJSON')
+
+    def test_rejects_new_item_with_id(self):
+        status, error = self.request('POST', '/things', {u'id': u'123'})
+        self.assertEqual(status, 400)
+        self.assertEqual(error[u'error_code'], u'NewItemHasIdAlready')
+
+    def test_rejects_new_item_with_revision(self):
+        status, error = self.request('POST', '/things', {u'revision': u'1'})
+        self.assertEqual(status, 400)
+        self.assertEqual(error[u'error_code'], u'NewItemHasRevisionAlready')
+
+    def test_passes_body_that_is_not_object_to_route(self):
+        for body in [None, 5, [u'id'], u'id']:
+            self.assertEqual(
+                self.request('POST', '/things', body), (200, {u'body': body}))
+            self.assertEqual(
+                self.request('PUT', '/things/123', body),
+                (200, {u'body': body}))
+
+    def test_passes_updated_item_to_route(self):
+        item = {u'id': u'123', u'revision': u'1'}
+        self.assertEqual(
+            self.request('PUT', '/things/123', item), (200, {u'body': item}))
+
+    def test_rejects_updated_item_with_conflicting_id(self):
+        status, error = self.request(
+            'PUT', '/things/123', {u'id': u'456', u'revision': u'1'})
+        self.assertEqual(status, 400)
+        self.assertEqual(error[u'error_code'], u'ItemHasConflictingId')
+
+    def test_rejects_updated_item_without_revision(self):
+        status, error = self.request('PUT', '/things/123', {u'id': u'123'})
+        self.assertEqual(status, 409)
+        self.assertEqual(error[u'error_code'], u'NoItemRevision')
+
+    def test_does_not_check_other_methods(self):
+        self.assertEqual(
+            self.request('GET', '/things', 'not json'),
+            (200, {u'body': u'unset'}))
+
+
+class ResourceRouteTests(AppTestBase):
+
+    resource_type = u'yo'
+
+    path = u'/yo'
+
+    prototype = {
+        u'type': u'',
+        u'id': u'',
+        u'revision': u'',
+        u'value': u'',
+    }
+
+    def setUp(self):
+        super(ResourceRouteTests, self).setUp()
+        self._dbconn = qvarn.DatabaseConnection()
+        self._dbconn.set_sql(qvarn.SqliteAdapter())
+
+        vs = qvarn.VersionedStorage()
+        vs.set_resource_type(self.resource_type)
+        vs.start_version(u'first-version', None)
+        vs.add_prototype(self.prototype)
+        vs.add_prototype(qvarn.listener_prototype, auxtable=u'listener')
+        vs.add_prototype(qvarn.notification_prototype,
+                         auxtable=u'notification')
+        vs.add_prepare_callback(
+            qvarn.ListenerRegistry(self.resource_type).prepare)
+        with self._dbconn.transaction() as t:
+            vs.prepare_storage(t)
+
+        listener = qvarn.ListenerResource()
+        listener.set_top_resource_path(self.resource_type, self.path)
+        routes = listener.prepare_resource(self._dbconn)
+
+        resource = qvarn.ListResource()
+        resource.set_path(self.path)
+        resource.set_item_type(self.resource_type)
+        resource.set_item_prototype(self.prototype)
+        resource.set_listener(listener)
+        routes += resource.prepare_resource(self._dbconn)
+
+        for route in routes:
+            self.app.route(**route)
+
+    def test_rejects_acknowledge_that_is_not_object(self):
+        status, listener = self.request(
+            'POST', '/yo/listeners', {u'notify_of_new': True})
+        self.assertEqual(status, 201)
+        path = '/yo/listeners/{}/notifications/_acknowledge'.format(
+            listener[u'id'])
+        for body in [None, 5]:
+            status, error = self.request('POST', path, body)
+            self.assertEqual(status, 400)
+            self.assertEqual(error[u'error_code'], u'BadAcknowledge')
+
+    def test_rejects_batch_that_is_not_object(self):
+        for body in [None, 5]:
+            status, error = self.request('POST', '/yo/_batch', body)
+            self.assertEqual(status, 400)
+            self.assertEqual(error[u'error_code'], u'BadBatch')
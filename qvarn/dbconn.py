@@ -31,11 +31,21 @@ class DatabaseConnection(object):
 
     def __init__(self):
         self._sql = None
+        self._notification_waker = None
 
     def set_sql(self, sql):
         self._sql = sql
+        self._notification_waker = None
 
-    def transaction(self):
+    def get_notification_waker(self):
+        '''Return the NotificationWaker shared by users of the database.'''
+        if self._notification_waker is None:
+            self._notification_waker = qvarn.create_notification_waker(
+                self._sql)
+        return self._notification_waker
+
+    def transaction(self, autocommit=False):
         trans = qvarn.Transaction()
         trans.set_sql(self._sql)
+        trans.set_autocommit(autocommit)
         return trans
@@ -0,0 +1,70 @@
+# etag.py - conditional GET support with ETag and If-None-Match
+#
+# Copyright 2017 QvarnLabs Ltd
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# pylint: disable=no-member
+
+
+'''ETags for resources.
+
+The ETag of a resource is its revision, which changes whenever the
+resource or any of its sub-resources changes.
+
+'''
+
+
+import bottle
+
+
+def format_etag(revision):
+    '''Return the ETag header value for a revision.'''
+    return u'"{}"'.format(revision)
+
+
+def etag_matches(if_none_match, revision):
+    '''Does an If-None-Match header value match a revision?'''
+    if if_none_match is None:
+        return False
+    if if_none_match.strip() == u'*':
+        return True
+    etag = format_etag(revision)
+    for tag in if_none_match.split(u','):
+        tag = tag.strip()
+        # Weak comparison is fine for GET: strip the weak prefix.
+        if tag.startswith(u'W/'):
+            tag = tag[2:]
+        if tag == etag:
+            return True
+    return False
+
+
+def set_etag(revision):  # pragma: no cover
+    '''Set the ETag header of the response.'''
+    bottle.response.set_header('ETag', format_etag(revision))
+
+
+def not_modified(revision):  # pragma: no cover
+    '''Respond with 304 Not Modified, if the client has the revision.
+
+    Return True if the response should then have no body.
+
+    '''
+
+    if etag_matches(bottle.request.headers.get('If-None-Match'), revision):
+        set_etag(revision)
+        bottle.response.status = 304
+        return True
+    return False
@@ -0,0 +1,48 @@
+# etag_tests.py - unit tests for ETag support
+#
+# Copyright 2017 QvarnLabs Ltd
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import unittest
+
+import qvarn
+
+
+class EtagTests(unittest.TestCase):
+
+    def test_formats_revision_as_quoted_etag(self):
+        self.assertEqual(qvarn.format_etag(u'rev1'), u'"rev1"')
+
+    def test_does_not_match_without_header(self):
+        self.assertFalse(qvarn.etag_matches(None, u'rev1'))
+
+    def test_matches_same_revision(self):
+        self.assertTrue(qvarn.etag_matches(u'"rev1"', u'rev1'))
+
+    def test_does_not_match_other_revision(self):
+        self.assertFalse(qvarn.etag_matches(u'"rev2"', u'rev1'))
+
+    def test_does_not_match_unquoted_revision(self):
+        self.assertFalse(qvarn.etag_matches(u'rev1', u'rev1'))
+
+    def test_matches_any_of_several_etags(self):
+        self.assertTrue(qvarn.etag_matches(u'"rev2", "rev1"', u'rev1'))
+
+    def test_matches_weak_etag(self):
+        self.assertTrue(qvarn.etag_matches(u'W/"rev1"', u'rev1'))
+
+    def test_matches_star(self):
+        self.assertTrue(qvarn.etag_matches(u'*', u'rev1'))
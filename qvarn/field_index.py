@@ -0,0 +1,69 @@
+# field_index.py - map resource fields to database columns
+#
+# Copyright 2017 QvarnLabs Ltd
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import collections
+
+
+FieldColumn = collections.namedtuple('FieldColumn', (
+    'table_name',
+    'column_type',
+    # Tuple of the list position columns (list_pos, dict_list_pos,
+    # str_list_pos) of the table, in table order.
+    'list_pos_columns',
+))
+
+
+class FieldIndex(object):
+
+    '''An index from field names to the columns that store them.
+
+    The index is built from a schema, as returned by
+    ``qvarn.schema_from_prototype``, and does not change after that.
+    A field may be stored in several tables, for example if a list of
+    dicts and the main dict both have a field with the same name.
+
+    '''
+
+    _list_pos_names = (u'list_pos', u'str_list_pos', u'dict_list_pos')
+
+    def __init__(self, schema):
+        list_pos_columns = collections.defaultdict(list)
+        for table_name, column_name, _ in schema:
+            if column_name in self._list_pos_names:
+                list_pos_columns[table_name].append(column_name)
+
+        fields = collections.defaultdict(list)
+        for table_name, column_name, column_type in schema:
+            fields[column_name].append(FieldColumn(
+                table_name, column_type,
+                tuple(list_pos_columns[table_name])))
+
+        self._fields = dict(
+            (name, tuple(columns)) for name, columns in fields.items())
+
+    def has_field(self, field_name):
+        return field_name in self._fields
+
+    def get_columns(self, field_name):
+        '''Return tuple of FieldColumn for field, in schema order.
+
+        The tuple is empty if the field is not in the index.
+
+        '''
+
+        return self._fields.get(field_name, ())
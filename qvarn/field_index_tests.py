@@ -0,0 +1,71 @@
+# field_index_tests.py - unit tests for FieldIndex
+#
+# Copyright 2017 QvarnLabs Ltd
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import unittest
+
+import qvarn
+
+
+class FieldIndexTests(unittest.TestCase):
+
+    def setUp(self):
+        prototype = {
+            u'type': u'',
+            u'id': u'',
+            u'foo': u'',
+            u'count': 0,
+            u'bars': [u''],
+            u'dicts': [
+                {
+                    u'foo': u'',
+                    u'foobars': [u''],
+                },
+            ],
+        }
+        schema = qvarn.schema_from_prototype(prototype, resource_type=u'yo')
+        self.index = qvarn.FieldIndex(schema)
+
+    def test_knows_fields_in_all_tables(self):
+        for name in [u'type', u'id', u'foo', u'count', u'bars', u'foobars']:
+            self.assertTrue(self.index.has_field(name))
+
+    def test_does_not_know_unknown_field(self):
+        self.assertFalse(self.index.has_field(u'nope'))
+        self.assertEqual(self.index.get_columns(u'nope'), ())
+
+    def test_returns_column_of_main_table(self):
+        self.assertEqual(
+            self.index.get_columns(u'count'),
+            (qvarn.FieldColumn(u'yo', int, ()),))
+
+    def test_returns_columns_of_all_tables_with_field(self):
+        self.assertEqual(
+            self.index.get_columns(u'foo'),
+            (
+                qvarn.FieldColumn(u'yo', unicode, ()),
+                qvarn.FieldColumn(u'yo_dicts', unicode, (u'list_pos',)),
+            ))
+
+    def test_returns_list_positions_of_nested_list(self):
+        self.assertEqual(
+            self.index.get_columns(u'foobars'),
+            (
+                qvarn.FieldColumn(
+                    u'yo_dicts_foobars', unicode,
+                    (u'dict_list_pos', u'list_pos')),
+            ))
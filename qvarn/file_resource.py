@@ -74,7 +74,8 @@ class FileResource(object):
         '''Set the listener for this resource.
 
         A listener must have methods ``notify_create``, ``notify_update``
-        and ``notify_delete``. ListenerResource implements these methods
+        and ``notify_delete``, which take the transaction of the change
+        as ``transaction``. ListenerResource implements these methods
         and has a more detailed description of them.
         '''
         self._listener = listener
@@ -113,10 +114,13 @@ class FileResource(object):
         '''Serve GET /foos/123/<file_resource_name> to get a file.'''
         ro = self._create_ro_storage()
         with self._dbconn.transaction() as t:
+            revision = ro.get_revision(t, item_id)
+            if qvarn.not_modified(revision):
+                return u''
             subitem = ro.get_subitem(t, item_id, self._file_resource_name)
-            item = ro.get_item(t, item_id)
 
-        bottle.response.set_header('Revision', item[u'revision'])
+        bottle.response.set_header('Revision', revision)
+        qvarn.set_etag(revision)
         bottle.response.set_header('Content-Type', subitem[u'content_type'])
         return subitem[u'body']
 
@@ -143,7 +147,8 @@ class FileResource(object):
         with self._dbconn.transaction() as t:
             added[u'revision'] = wo.update_subitem(
                 t, item_id, revision, self._file_resource_name, subitem)
-        self._listener.notify_update(added[u'id'], added[u'revision'])
+            self._listener.notify_update(
+                added[u'id'], added[u'revision'], transaction=t)
         return added
 
     def _create_ro_storage(self):
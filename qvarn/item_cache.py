@@ -0,0 +1,114 @@
+# item_cache.py - cache items between requests
+#
+# Copyright 2017 QvarnLabs Ltd
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import collections
+import json
+import thread
+import time
+
+import qvarn
+
+
+class ItemCache(object):
+
+    '''A threadsafe cache of items, validated by revision.
+
+    At most ``max_items`` items are kept; when the cache is full, the
+    least recently used item is dropped. Items older than ``ttl``
+    seconds are not returned. An item is only returned if the caller
+    gives its current revision, so a cached item is never out of date,
+    even if another process changed it.
+
+    Items are stored as JSON text, so that callers get a fresh copy
+    they can modify, and so that the memory used can be counted.
+
+    '''
+
+    def __init__(self, max_items=1000, ttl=60, clock=time.time):
+        self._lock = thread.allocate_lock()
+        self._max_items = max_items
+        self._ttl = ttl
+        self._clock = clock
+        # Item id to (revision, JSON text, time added).
+        self._items = collections.OrderedDict()
+        self._bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def get(self, item_id, revision):
+        '''Return item if it is cached with the given revision.
+
+        Otherwise, return None.
+
+        '''
+
+        with self._lock:
+            entry = self._items.pop(item_id, None)
+            if entry is not None:
+                cached_revision, text, added = entry
+                if (cached_revision == revision and
+                        self._clock() - added < self._ttl):
+                    self._items[item_id] = entry
+                    self._hits += 1
+                    self._log(hit=True)
+                    return json.loads(text)
+                self._bytes -= len(text)
+            self._misses += 1
+            self._log(hit=False)
+            return None
+
+    def put(self, item):
+        '''Cache an item. It must have an id and a revision.'''
+        text = json.dumps(item)
+        with self._lock:
+            self._remove(item[u'id'])
+            self._items[item[u'id']] = (item[u'revision'], text, self._clock())
+            self._bytes += len(text)
+            while len(self._items) > self._max_items:
+                _, (_, old_text, _) = self._items.popitem(last=False)
+                self._bytes -= len(old_text)
+                self._evictions += 1
+
+    def invalidate(self, item_id):
+        '''Remove an item from the cache, if it is there.'''
+        with self._lock:
+            self._remove(item_id)
+
+    def _remove(self, item_id):
+        entry = self._items.pop(item_id, None)
+        if entry is not None:
+            self._bytes -= len(entry[1])
+
+    def get_stats(self):
+        with self._lock:
+            return self._get_stats()
+
+    def _get_stats(self):
+        lookups = self._hits + self._misses
+        return {
+            'hits': self._hits,
+            'misses': self._misses,
+            'evictions': self._evictions,
+            'items': len(self._items),
+            'bytes': self._bytes,
+            'hit_ratio': float(self._hits) / lookups if lookups else 0.0,
+        }
+
+    def _log(self, hit):
+        qvarn.log.log('item-cache', hit=hit, **self._get_stats())
@@ -0,0 +1,84 @@
+# item_cache_tests.py - unit tests for ItemCache
+#
+# Copyright 2017 QvarnLabs Ltd
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import json
+import unittest
+
+import qvarn
+
+
+class ItemCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0
+        self.cache = qvarn.ItemCache(
+            max_items=2, ttl=10, clock=lambda: self.now)
+
+    def _item(self, item_id, revision=u'rev1', foo=u'bar'):
+        return {u'id': item_id, u'revision': revision, u'foo': foo}
+
+    def test_returns_none_for_unknown_item(self):
+        self.assertEqual(self.cache.get(u'id1', u'rev1'), None)
+
+    def test_returns_cached_item_with_same_revision(self):
+        self.cache.put(self._item(u'id1'))
+        self.assertEqual(self.cache.get(u'id1', u'rev1'), self._item(u'id1'))
+
+    def test_returns_copy_of_item(self):
+        self.cache.put(self._item(u'id1'))
+        self.cache.get(u'id1', u'rev1')[u'foo'] = u'changed'
+        self.assertEqual(self.cache.get(u'id1', u'rev1'), self._item(u'id1'))
+
+    def test_returns_none_for_other_revision(self):
+        self.cache.put(self._item(u'id1'))
+        self.assertEqual(self.cache.get(u'id1', u'rev2'), None)
+        self.assertEqual(self.cache.get_stats()['items'], 0)
+
+    def test_returns_none_after_ttl(self):
+        self.cache.put(self._item(u'id1'))
+        self.now = 10
+        self.assertEqual(self.cache.get(u'id1', u'rev1'), None)
+
+    def test_returns_none_after_invalidation(self):
+        self.cache.put(self._item(u'id1'))
+        self.cache.invalidate(u'id1')
+        self.assertEqual(self.cache.get(u'id1', u'rev1'), None)
+
+    def test_evicts_least_recently_used_item(self):
+        self.cache.put(self._item(u'id1'))
+        self.cache.put(self._item(u'id2'))
+        self.cache.get(u'id1', u'rev1')
+        self.cache.put(self._item(u'id3'))
+        self.assertEqual(self.cache.get(u'id2', u'rev1'), None)
+        self.assertNotEqual(self.cache.get(u'id1', u'rev1'), None)
+        self.assertEqual(self.cache.get_stats()['evictions'], 1)
+
+    def test_counts_hits_misses_and_bytes(self):
+        self.cache.put(self._item(u'id1'))
+        self.cache.put(self._item(u'id1', revision=u'rev2'))
+        self.cache.get(u'id1', u'rev2')
+        self.cache.get(u'id2', u'rev1')
+        stats = self.cache.get_stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['hit_ratio'], 0.5)
+        self.assertEqual(stats['items'], 1)
+        self.assertEqual(
+            stats['bytes'], len(json.dumps(self._item(u'id1', u'rev2'))))
+        self.cache.invalidate(u'id1')
+        self.assertEqual(self.cache.get_stats()['bytes'], 0)
@@ -26,6 +26,8 @@
 '''Multi-item resources in the HTTP API.'''
 
 
+import collections
+import itertools
 import urllib
 import urlparse
 import json
@@ -58,6 +60,10 @@ class ListResource(object):
         self._subitem_prototypes = qvarn.SubItemPrototypes()
         self._listener = None
         self._dbconn = None
+        self._search_plans = qvarn.SearchPlanCache()
+        self._field_index = None
+        self._item_cache = None
+        self._json_document = False
 
     def _no_validator(self, item):  # pragma: no cover
         return
@@ -90,12 +96,22 @@ class ListResource(object):
         '''Set prototype for a subitem.'''
         self._subitem_prototypes.add(self._item_type, subitem_name, prototype)
 
+    def set_item_cache(self, item_cache):
+        '''Set qvarn.ItemCache for GET /foos/123, or None to not cache.'''
+        self._item_cache = item_cache
+
+    def set_json_document(self, enabled):
+        '''Set whether items are also stored as JSON documents.'''
+        self._json_document = enabled
+
     def set_listener(self, listener):
         '''Set the listener for this resource.
 
-        A listener must have methods ``notify_create``, ``notify_update``
-        and ``notify_delete``. ListenerResource implements these methods
-        and has a more detailed description of them.
+        A listener must have methods ``notify_create``, ``notify_update``,
+        ``notify_delete`` and ``notify_changes``, which take the
+        transaction of the change as ``transaction``. ListenerResource
+        implements these methods and has a more detailed description of
+        them.
         '''
         self._listener = listener
 
@@ -103,6 +119,7 @@ class ListResource(object):
         '''Prepare the resource for action.'''
 
         self._dbconn = dbconn
+        self._field_index = self._create_ro_storage().build_field_index()
 
         item_paths = [
             {
@@ -116,11 +133,22 @@ class ListResource(object):
                 'callback': self.post_item,
                 'apply': qvarn.BasicValidationPlugin(),
             },
+            {
+                'path': self._path + '/_batch',
+                'method': 'POST',
+                'callback': self.post_batch,
+                'apply': qvarn.BasicValidationPlugin(),
+            },
             {
                 'path': self._path + '/<item_id>',
                 'method': 'GET',
                 'callback': self.get_item,
             },
+            {
+                'path': self._path + '/<item_id>',
+                'method': 'HEAD',
+                'callback': self.head_item,
+            },
             {
                 'path': self._path + '/<item_id>',
                 'method': 'PUT',
@@ -137,6 +165,11 @@ class ListResource(object):
                 'method': 'GET',
                 'callback': self.get_matching_items,
             },
+            {
+                'path': self._path + '/search/<search_criteria:path>',
+                'method': 'DELETE',
+                'callback': self.delete_matching_items,
+            },
         ]
 
         subitem_paths = []
@@ -175,6 +208,56 @@ class ListResource(object):
     def get_matching_items(self, search_criteria):  # pragma: no cover
         '''Serve GET /foos/search to list items matching search criteria.'''
 
+        criteria = self._parse_search_criteria()
+        ro = self._create_ro_storage()
+        if criteria.count:
+            with self._dbconn.transaction() as t:
+                return ro.count(t, criteria.search_params)
+        if criteria.stream:
+            return self._stream_matching_items(
+                ro, criteria.search_params, criteria.show_params,
+                criteria.sort_params, limit=criteria.limit,
+                offset=criteria.offset, after=criteria.after)
+        with self._dbconn.transaction() as t:
+            return ro.search(
+                t, criteria.search_params, criteria.show_params,
+                criteria.sort_params, limit=criteria.limit,
+                offset=criteria.offset, after=criteria.after)
+
+    def delete_matching_items(self, search_criteria):
+        '''Serve DELETE /foos/search to delete items matching a search.
+
+        Only search conditions are allowed, and there must be at least
+        one. The matching items are deleted in one transaction, a chunk
+        of ids at a time, and the result is the number of deleted items.
+
+        '''
+
+        criteria = self._parse_search_criteria()
+        only_conditions = (
+            not criteria.show_params and
+            not criteria.sort_params and
+            (criteria.limit, criteria.offset, criteria.after) ==
+            (None, None, None) and
+            not criteria.stream and
+            not criteria.count)
+        if not criteria.search_params or not only_conditions:
+            raise BadDeleteSearch()
+
+        ro = self._create_ro_storage()
+        wo = self._create_wo_storage()
+        with self._dbconn.transaction() as t:
+            item_ids = ro.search_ids(t, criteria.search_params)
+            wo.delete_items(t, item_ids)
+            self._listener.notify_changes(
+                [(u'deleted', item_id, None) for item_id in item_ids],
+                transaction=t)
+
+        for item_id in item_ids:
+            self._invalidate_cached_item(item_id)
+        return {u'deleted': len(item_ids)}
+
+    def _parse_search_criteria(self):
         # We need criteria to be encoded so that when we split by slash (/),
         # we split the criteria correctly and keep the slashes in the
         # condition values.
@@ -192,6 +275,9 @@ class ListResource(object):
         sort_params = []
         limit = None
         offset = None
+        after = None
+        stream = False
+        count = False
         search_any = False
 
         any_opers = [
@@ -262,6 +348,17 @@ class ListResource(object):
                 if offset < 0:
                     raise BadOffsetValue(error="should be positive integer")
                 i += 2
+            elif part == u'stream':
+                stream = True
+                i += 1
+            elif part == u'count':
+                count = True
+                i += 1
+            elif part == u'after':
+                if i + 1 >= len(criteria):
+                    raise BadSearchCondition()
+                after = criteria[i + 1]
+                i += 2
             elif part == u'any':
                 if (i + 1) >= len(criteria):
                     raise MissingAnyOperator()
@@ -277,11 +374,34 @@ class ListResource(object):
 
         if (limit is not None or offset is not None) and not sort_params:
             raise LimitWithoutSortError()
-
-        ro = self._create_ro_storage()
+        if after is not None and not sort_params:
+            raise AfterWithoutSortError()
+        if count and (limit, offset, after) != (None, None, None):
+            raise CountWithLimitError()
+
+        return SearchCriteria(
+            search_params=search_params,
+            show_params=show_params,
+            sort_params=sort_params,
+            limit=limit,
+            offset=offset,
+            after=after,
+            stream=stream,
+            count=count)
+
+    def _stream_matching_items(self, ro, *args, **kwargs):
+        pieces = self._generate_matching_items(ro, *args, **kwargs)
+        # Run the search before returning, so that errors are reported
+        # the same way as for other searches. Bottle sends the rest of
+        # the pieces as they're generated.
+        first = next(pieces)
+        bottle.response.content_type = 'application/json'
+        return itertools.chain([first], pieces)
+
+    def _generate_matching_items(self, ro, *args, **kwargs):
         with self._dbconn.transaction() as t:
-            return ro.search(t, search_params, show_params, sort_params,
-                             limit=limit, offset=offset)
+            for piece in ro.search_stream(t, *args, **kwargs):
+                yield piece
 
     def post_item(self):  # pragma: no cover
         '''Serve POST /foos to create a new item.'''
@@ -302,8 +422,9 @@ class ListResource(object):
         wo = self._create_wo_storage()
         with self._dbconn.transaction() as t:
             added = wo.add_item(t, item)
+            self._listener.notify_create(
+                added[u'id'], added[u'revision'], transaction=t)
 
-        self._listener.notify_create(added[u'id'], added[u'revision'])
         resource_path = u'%s/%s' % (self._path, added[u'id'])
         resource_url = urlparse.urljoin(
             bottle.request.url, resource_path)
@@ -314,20 +435,165 @@ class ListResource(object):
         bottle.response.status = 201
         return added
 
+    def post_batch(self):
+        '''Serve POST /foos/_batch to create, update and delete many items.
+
+        The body is ``{"operations": [...]}``, where each operation is
+        ``{"op": "create", "item": {...}}``, ``{"op": "update", "item":
+        {...}}``, or ``{"op": "delete", "id": "..."}``. All operations
+        are validated first, and then done in one transaction, so
+        either all of them succeed or none do. The result of each
+        operation is returned in the same order.
+
+        '''
+
+        operations = self._validate_batch(bottle.request.qvarn_json)
+
+        def items_for(op_name):
+            return [op[u'item'] for op in operations if op[u'op'] == op_name]
+
+        delete_ids = [op[u'id'] for op in operations if op[u'op'] == u'delete']
+
+        wo = self._create_wo_storage()
+        with self._dbconn.transaction() as t:
+            wo.delete_items(t, delete_ids)
+            updated = iter(wo.update_items(t, items_for(u'update')))
+            added = iter(wo.add_items(t, items_for(u'create')))
+
+            results = []
+            changes = []
+            for op in operations:
+                if op[u'op'] == u'create':
+                    item = next(added)
+                    change = u'created'
+                elif op[u'op'] == u'update':
+                    item = next(updated)
+                    change = u'updated'
+                    if item[u'revision'] == op[u'item'][u'revision']:
+                        change = None
+                else:
+                    item = {u'id': op[u'id'], u'revision': None}
+                    change = u'deleted'
+                results.append({
+                    u'op': op[u'op'],
+                    u'id': item[u'id'],
+                    u'revision': item[u'revision'],
+                })
+                if change is not None:
+                    changes.append((change, item[u'id'], item[u'revision']))
+
+            self._listener.notify_changes(changes, transaction=t)
+
+        for change, item_id, _ in changes:
+            if change != u'created':
+                self._invalidate_cached_item(item_id)
+        return {u'results': results}
+
+    def _validate_batch(self, body):
+        if not isinstance(body, dict):
+            raise BadBatch()
+        operations = body.get(u'operations')
+        if not isinstance(operations, list):
+            raise BadBatch()
+
+        item_ids = set()
+        for i, op in enumerate(operations):
+            try:
+                item_id = self._validate_batch_operation(op)
+            except qvarn.HTTPError as e:
+                e.error[u'batch_index'] = i
+                raise
+            if item_id is not None:
+                if item_id in item_ids:
+                    raise DuplicateBatchItem(item_id=item_id, batch_index=i)
+                item_ids.add(item_id)
+        return operations
+
+    def _validate_batch_operation(self, op):
+        # Return the id of the item the operation changes, or None
+        # when creating.
+
+        if not isinstance(op, dict):
+            raise BadBatchOperation()
+        op_name = op.get(u'op')
+        if op_name == u'delete':
+            if not isinstance(op.get(u'id'), unicode):
+                raise BadBatchOperation()
+            return op[u'id']
+        if op_name not in (u'create', u'update'):
+            raise BadBatchOperation()
+
+        item = op.get(u'item')
+        if not isinstance(item, dict):
+            raise BadBatchOperation()
+        if op_name == u'create':
+            if u'id' in item:
+                raise qvarn.CannotAddWithId(id=item[u'id'])
+            if u'revision' in item:
+                raise qvarn.CannotAddWithRevision(revision=item[u'revision'])
+        else:
+            if not isinstance(item.get(u'id'), unicode):
+                raise BadBatchOperation()
+            if u'revision' not in item:
+                raise qvarn.NoItemRevision(item_id=item[u'id'])
+
+        qvarn.add_missing_item_fields(
+            self._item_type, self._item_prototype, item)
+        iv = qvarn.ItemValidator()
+        iv.validate_item(self._item_type, self._item_prototype, item)
+        self._item_validator(item)
+
+        if op_name == u'create':
+            # As in post_item, filling in defaults added these.
+            del item[u'id']
+            del item[u'revision']
+            return None
+        return item[u'id']
+
     def get_item(self, item_id):  # pragma: no cover
         '''Serve GET /foos/123 to get an existing item.'''
         ro = self._create_ro_storage()
         with self._dbconn.transaction() as t:
-            return ro.get_item(t, item_id)
+            revision = ro.get_revision(t, item_id)
+            if qvarn.not_modified(revision):
+                return u''
+            item = None
+            if self._item_cache is not None:
+                item = self._item_cache.get(item_id, revision)
+            if item is None:
+                item = ro.get_item(t, item_id)
+                if self._item_cache is not None:
+                    self._item_cache.put(item)
+        qvarn.set_etag(item[u'revision'])
+        return item
+
+    def head_item(self, item_id):
+        '''Serve HEAD /foos/123 to get the revision of an item.
+
+        The revision is in the ETag and Revision headers. This is
+        much cheaper than GET, as the item is not read.
+
+        '''
+
+        ro = self._create_ro_storage()
+        with self._dbconn.transaction() as t:
+            revision = ro.get_revision(t, item_id)
+        if not qvarn.not_modified(revision):
+            qvarn.set_etag(revision)
+        bottle.response.set_header('Revision', revision)
+        return u''
 
     def get_subitem(self, item_id, subitem_path):  # pragma: no cover
         '''Serve GET /foos/123/subitem.'''
         ro = self._create_ro_storage()
         with self._dbconn.transaction() as t:
+            revision = ro.get_revision(t, item_id)
+            if qvarn.not_modified(revision):
+                return u''
             subitem = ro.get_subitem(t, item_id, subitem_path)
-            item = ro.get_item(t, item_id)
 
-        subitem[u'revision'] = item[u'revision']
+        subitem[u'revision'] = revision
+        qvarn.set_etag(revision)
         return subitem
 
     def put_item(self, item_id):  # pragma: no cover
@@ -344,10 +610,17 @@ class ListResource(object):
         self._item_validator(item)
 
         wo = self._create_wo_storage()
+        # If nothing changed, the revision is the same, and there's
+        # nothing to notify of.
         with self._dbconn.transaction() as t:
             updated = wo.update_item(t, item)
+            changed = updated[u'revision'] != item[u'revision']
+            if changed:
+                self._listener.notify_update(
+                    updated[u'id'], updated[u'revision'], transaction=t)
 
-        self._listener.notify_update(updated[u'id'], updated[u'revision'])
+        if changed:
+            self._invalidate_cached_item(item_id)
         return updated
 
     def put_subitem(self, item_id, subitem_name):  # pragma: no cover
@@ -367,10 +640,9 @@ class ListResource(object):
         with self._dbconn.transaction() as t:
             subitem[u'revision'] = wo.update_subitem(
                 t, item_id, revision, subitem_name, subitem)
-
-        updated = dict(subitem)
-        updated.update({u'id': item_id})
-        self._listener.notify_update(updated[u'id'], updated[u'revision'])
+            self._listener.notify_update(
+                item_id, subitem[u'revision'], transaction=t)
+        self._invalidate_cached_item(item_id)
         return subitem
 
     def delete_item(self, item_id):  # pragma: no cover
@@ -378,13 +650,22 @@ class ListResource(object):
         wo = self._create_wo_storage()
         with self._dbconn.transaction() as t:
             wo.delete_item(t, item_id)
-        self._listener.notify_delete(item_id)
+            self._listener.notify_delete(item_id, transaction=t)
+        self._invalidate_cached_item(item_id)
+
+    def _invalidate_cached_item(self, item_id):  # pragma: no cover
+        if self._item_cache is not None:
+            self._item_cache.invalidate(item_id)
 
     def _create_ro_storage(self):  # pragma: no cover
         ro = qvarn.ReadOnlyStorage()
         ro.set_item_prototype(self._item_type, self._item_prototype)
         for subitem_name, prototype in self._subitem_prototypes.get_all():
             ro.set_subitem_prototype(self._item_type, subitem_name, prototype)
+        ro.set_search_plan_cache(self._search_plans)
+        if self._field_index is not None:
+            ro.set_field_index(self._field_index)
+        ro.set_json_document(self._json_document)
         return ro
 
     def _create_wo_storage(self):  # pragma: no cover
@@ -392,6 +673,7 @@ class ListResource(object):
         wo.set_item_prototype(self._item_type, self._item_prototype)
         for subitem_name, prototype in self._subitem_prototypes.get_all():
             wo.set_subitem_prototype(self._item_type, subitem_name, prototype)
+        wo.set_json_document(self._json_document)
         return wo
 
     def _create_resource_ro_storage(
@@ -407,11 +689,51 @@ class ListResource(object):
         return wo
 
 
+# The parsed path of a /search request. The fields are the arguments
+# of ReadOnlyStorage.search, plus the /stream and /count flags.
+SearchCriteria = collections.namedtuple('SearchCriteria', (
+    'search_params',
+    'show_params',
+    'sort_params',
+    'limit',
+    'offset',
+    'after',
+    'stream',
+    'count',
+))
+
+
 class BadSearchCondition(qvarn.BadRequest):
 
     msg = u'Could not parse search condition'
 
 
+class BadDeleteSearch(qvarn.BadRequest):
+
+    msg = (
+        u'Deleting by search needs at least one search condition, '
+        u'and nothing else'
+    )
+
+
+class BadBatch(qvarn.BadRequest):
+
+    msg = u'Batch must have a list of operations'
+
+
+class BadBatchOperation(qvarn.BadRequest):
+
+    msg = (
+        u'Batch operation {batch_index} must be a create or update with '
+        u'an item, or a delete with an id'
+    )
+
+
+class DuplicateBatchItem(qvarn.BadRequest):
+
+    msg = u'Batch operation {batch_index} changes {item_id} again'
+
+
 class LimitError(qvarn.BadRequest):
     pass
 
@@ -421,6 +743,16 @@ class LimitWithoutSortError(LimitError):
     msg = u'LIMIT and OFFSET can only be used with together SORT.'
 
 
+class AfterWithoutSortError(LimitError):
+
+    msg = u'AFTER can only be used together with SORT.'
+
+
+class CountWithLimitError(LimitError):
+
+    msg = u'COUNT can not be used together with LIMIT, OFFSET or AFTER.'
+
+
 class BadLimitValue(LimitError):
 
     msg = u'Invalid LIMIT value: {error}.'
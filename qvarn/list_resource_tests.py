@@ -26,8 +26,11 @@ import qvarn
 
 from qvarn.list_resource import (
     LimitWithoutSortError, BadLimitValue, BadOffsetValue, BadAnySearchValue,
-    InvalidAnyOperator, MissingAnyOperator,
+    InvalidAnyOperator, MissingAnyOperator, AfterWithoutSortError,
+    CountWithLimitError, BadBatch, BadBatchOperation, DuplicateBatchItem,
+    BadDeleteSearch,
 )
+from qvarn.read_only import BadAfterValue
 
 
 class ListResourceBase(unittest.TestCase):
@@ -83,10 +86,14 @@ class ListResourceBase(unittest.TestCase):
                 u'lst': lst or [],
             })
 
-    def _search(self, url, show=None):
+    def _search_result(self, url):
         bottle.request.environ['REQUEST_URI'] = url
         search_result = self.resource.get_matching_items(url)
         bottle.request = bottle.LocalRequest()
+        return search_result
+
+    def _search(self, url, show=None):
+        search_result = self._search_result(url)
 
         show = self._default_show if show is None else show
         if show is None:
@@ -176,6 +183,193 @@ class LimitTests(ListResourceBase):
         ))
 
 
+class ItemCacheTests(ListResourceBase):
+
+    def setUp(self):
+        super(ItemCacheTests, self).setUp()
+        self.cache = qvarn.ItemCache()
+        self.resource.set_item_cache(self.cache)
+        with self._dbconn.transaction() as t:
+            self.item = self.wo.add_item(
+                t, {u'type': u'yo', u'foo': u'a', u'bar': u'', u'lst': []})
+
+    def test_returns_cached_item(self):
+        item = self.resource.get_item(self.item[u'id'])
+        self.assertEqual(item, self.item)
+        self.assertEqual(self.resource.get_item(self.item[u'id']), item)
+        self.assertEqual(self.cache.get_stats()['hits'], 1)
+
+    def test_does_not_return_item_changed_elsewhere(self):
+        self.resource.get_item(self.item[u'id'])
+        changed = dict(self.item, foo=u'b')
+        with self._dbconn.transaction() as t:
+            changed = self.wo.update_item(t, changed)
+        self.assertEqual(self.resource.get_item(self.item[u'id']), changed)
+
+    def test_forgets_deleted_item(self):
+        self.resource.get_item(self.item[u'id'])
+        self.resource.delete_item(self.item[u'id'])
+        self.assertEqual(self.cache.get_stats()['items'], 0)
+        with self.assertRaises(qvarn.ItemDoesNotExist):
+            self.resource.get_item(self.item[u'id'])
+
+
+class ConditionalGetTests(ListResourceBase):
+
+    def setUp(self):
+        super(ConditionalGetTests, self).setUp()
+        bottle.response = bottle.LocalResponse()
+        with self._dbconn.transaction() as t:
+            self.item = self.wo.add_item(
+                t, {u'type': u'yo', u'foo': u'a', u'bar': u'', u'lst': []})
+        self.etag = u'"{}"'.format(self.item[u'revision'])
+
+    def tearDown(self):
+        super(ConditionalGetTests, self).tearDown()
+        bottle.response = bottle.LocalResponse()
+
+    def test_sets_etag_to_revision(self):
+        self.assertEqual(self.resource.get_item(self.item[u'id']), self.item)
+        self.assertEqual(bottle.response.headers['ETag'], self.etag)
+        self.assertEqual(bottle.response.status_code, 200)
+
+    def test_returns_not_modified_for_current_revision(self):
+        bottle.request.environ['HTTP_IF_NONE_MATCH'] = self.etag
+        self.assertEqual(self.resource.get_item(self.item[u'id']), u'')
+        self.assertEqual(bottle.response.status_code, 304)
+        self.assertEqual(bottle.response.headers['ETag'], self.etag)
+
+    def test_head_returns_revision_without_item(self):
+        self.assertEqual(self.resource.head_item(self.item[u'id']), u'')
+        self.assertEqual(bottle.response.headers['ETag'], self.etag)
+        self.assertEqual(
+            bottle.response.headers['Revision'], self.item[u'revision'])
+
+    def test_head_raises_error_for_missing_item(self):
+        with self.assertRaises(qvarn.ItemDoesNotExist):
+            self.resource.head_item(u'does-not-exist')
+
+    def test_returns_item_for_old_revision(self):
+        bottle.request.environ['HTTP_IF_NONE_MATCH'] = u'"old"'
+        self.assertEqual(self.resource.get_item(self.item[u'id']), self.item)
+        self.assertEqual(bottle.response.status_code, 200)
+
+
+class CountTests(ListResourceBase):
+
+    def setUp(self):
+        super(CountTests, self).setUp()
+        for foo in [u'a', u'b', u'c']:
+            self._add_item(foo=foo, lst=[foo, u'x'])
+
+    def test_counts_all_items(self):
+        self.assertEqual(self._search_result(u'/search/count'), {u'count': 3})
+
+    def test_counts_matching_items(self):
+        self.assertEqual(
+            self._search_result(u'/search/gt/foo/a/count'), {u'count': 2})
+
+    def test_counts_items_with_matching_list_item_once(self):
+        self.assertEqual(
+            self._search_result(u'/search/exact/lst/x/count'), {u'count': 3})
+
+    def test_counts_zero_if_nothing_matches(self):
+        self.assertEqual(
+            self._search_result(u'/search/exact/foo/nope/count'),
+            {u'count': 0})
+
+    def test_ignores_show_and_sort(self):
+        self.assertEqual(
+            self._search_result(u'/search/show_all/sort/foo/count'),
+            {u'count': 3})
+
+    def test_count_with_limit_fails(self):
+        with self.assertRaises(CountWithLimitError):
+            self._search_result(u'/search/sort/foo/limit/1/count')
+
+
+class AfterTests(ListResourceBase):
+
+    def setUp(self):
+        super(AfterTests, self).setUp()
+        for foo in [u'd', u'b', u'a', u'c', u'b']:
+            self._add_item(foo=foo)
+
+    def _pages(self, url):
+        result = self._search_result(url)
+        pages = [[x[u'foo'] for x in result[u'resources']]]
+        while u'next_after' in result:
+            result = self._search_result(
+                url + u'/after/' + result[u'next_after'])
+            pages.append([x[u'foo'] for x in result[u'resources']])
+        return pages
+
+    def test_pages_through_all_items(self):
+        self.assertEqual(
+            self._pages(u'/search/show_all/sort/foo/limit/2'),
+            [[u'a', u'b'], [u'b', u'c'], [u'd']])
+
+    def test_pages_through_items_with_search_condition(self):
+        self.assertEqual(
+            self._pages(u'/search/show_all/ne/foo/c/sort/foo/limit/3'),
+            [[u'a', u'b', u'b'], [u'd']])
+
+    def test_pages_through_items_with_no_sort_key(self):
+        self._add_item(foo=u'e', lst=[u'y'])
+        self._add_item(foo=u'f', lst=[u'x'])
+        # Items with empty lists have no sort key, and come last, in
+        # order of their ids.
+        foos = sum(self._pages(u'/search/show_all/sort/lst/limit/1'), [])
+        self.assertEqual(foos[:2], [u'f', u'e'])
+        self.assertEqual(sorted(foos[2:]), [u'a', u'b', u'b', u'c', u'd'])
+
+    def test_has_no_next_after_for_last_page(self):
+        result = self._search_result(u'/search/show_all/sort/foo/limit/10')
+        self.assertNotIn(u'next_after', result)
+
+    def test_after_without_sort(self):
+        with self.assertRaises(AfterWithoutSortError):
+            self._search(u'/search/show_all/after/WzFd')
+
+    def test_invalid_after(self):
+        with self.assertRaises(BadAfterValue):
+            self._search(u'/search/show_all/sort/foo/after/!!!')
+
+    def test_after_with_wrong_number_of_sort_keys(self):
+        result = self._search_result(u'/search/sort/foo/limit/1')
+        with self.assertRaises(BadAfterValue):
+            self._search(
+                u'/search/sort/foo/sort/bar/after/' + result[u'next_after'])
+
+
+class StreamTests(ListResourceBase):
+
+    def setUp(self):
+        super(StreamTests, self).setUp()
+        for foo in [u'c', u'a', u'b']:
+            self._add_item(foo=foo, lst=[foo, u'x'])
+
+    def _stream(self, url):
+        pieces = self._search_result(url)
+        return json.loads(''.join(pieces))
+
+    def test_streams_same_result_as_search(self):
+        for url in [u'/search/show_all/sort/foo',
+                    u'/search/show/lst/sort/foo/limit/2',
+                    u'/search/exact/lst/x']:
+            self.assertEqual(
+                self._stream(url + u'/stream'), self._search_result(url))
+
+    def test_streams_empty_result(self):
+        self.assertEqual(
+            self._stream(u'/search/exact/foo/nope/stream'),
+            {u'resources': []})
+
+    def test_reports_errors_before_streaming(self):
+        with self.assertRaises(qvarn.FieldNotInResource):
+            self._search_result(u'/search/exact/nope/x/stream')
+
+
 class SearchAnyTests(ListResourceBase):
 
     def test_exact_scalar(self):
@@ -186,7 +380,7 @@ class SearchAnyTests(ListResourceBase):
         value = urllib.quote(json.dumps([u'a', u'b']), safe='')
         result = self._search(u'/search/any/exact/foo/%s/show_all' % value,
                               show=u'foo')
-        self.assertEqual(result, [u'a', u'b'])
+        self.assertEqual(sorted(result), [u'a', u'b'])
 
     def test_contains_scalar(self):
         self._add_item(foo=u'foo')
@@ -197,7 +391,7 @@ class SearchAnyTests(ListResourceBase):
         value = urllib.quote(json.dumps([u'o', u'a']), safe='')
         result = self._search(u'/search/any/contains/foo/%s/show_all' % value,
                               show=u'foo')
-        self.assertEqual(result, [u'foo', u'bar', u'baz'])
+        self.assertEqual(sorted(result), [u'bar', u'baz', u'foo'])
 
     def test_startswith_scalar(self):
         self._add_item(foo=u'foo')
@@ -208,7 +402,7 @@ class SearchAnyTests(ListResourceBase):
         value = urllib.quote(json.dumps([u'fo', u'ba']), safe='')
         result = self._search(
             u'/search/any/startswith/foo/%s/show_all' % value, show=u'foo')
-        self.assertEqual(result, [u'foo', u'bar', u'baz'])
+        self.assertEqual(sorted(result), [u'bar', u'baz', u'foo'])
 
     def test_exact_list(self):
         self._add_item(lst=list(u'abc'))
@@ -218,7 +412,7 @@ class SearchAnyTests(ListResourceBase):
         value = urllib.quote(json.dumps([u'b', u'd']), safe='')
         result = self._search(u'/search/any/exact/lst/%s/show_all' % value,
                               show=u'lst')
-        self.assertEqual(result, [
+        self.assertEqual(sorted(result), [
             list(u'abc'),
             list(u'def'),
         ])
@@ -265,13 +459,189 @@ class SearchAnyTests(ListResourceBase):
         ))
 
 
+class BatchTests(ListResourceBase):
+
+    def setUp(self):
+        super(BatchTests, self).setUp()
+        with self._dbconn.transaction() as t:
+            self.first = self.wo.add_item(
+                t, {u'type': u'yo', u'foo': u'a', u'bar': u'', u'lst': []})
+            self.second = self.wo.add_item(
+                t, {u'type': u'yo', u'foo': u'b', u'bar': u'', u'lst': []})
+
+    def _post_batch(self, operations):
+        bottle.request.qvarn_json = {u'operations': operations}
+        return self.resource.post_batch()
+
+    def _get_foos(self):
+        with self._dbconn.transaction() as t:
+            items = self.ro.get_items(t, self.ro.get_item_ids(t))
+        return sorted(item[u'foo'] for item in items)
+
+    def test_creates_updates_and_deletes_items(self):
+        changed = dict(self.first, foo=u'c')
+        result = self._post_batch([
+            {u'op': u'create', u'item': {u'type': u'yo', u'foo': u'x'}},
+            {u'op': u'update', u'item': changed},
+            {u'op': u'delete', u'id': self.second[u'id']},
+            {u'op': u'create', u'item': {u'type': u'yo', u'lst': [u'l']}},
+        ])
+
+        results = result[u'results']
+        self.assertEqual(
+            [(r[u'op'], r[u'id'] is None) for r in results],
+            [(u'create', False), (u'update', False), (u'delete', False),
+             (u'create', False)])
+        self.assertEqual(results[1][u'id'], self.first[u'id'])
+        self.assertNotEqual(results[1][u'revision'], self.first[u'revision'])
+        self.assertEqual(results[2][u'id'], self.second[u'id'])
+        self.assertEqual(self._get_foos(), [None, u'c', u'x'])
+
+        with self._dbconn.transaction() as t:
+            created = self.ro.get_item(t, results[3][u'id'])
+        self.assertEqual(created[u'lst'], [u'l'])
+        self.assertEqual(created[u'revision'], results[3][u'revision'])
+
+    def test_notifies_of_all_changes_at_once(self):
+        result = self._post_batch([
+            {u'op': u'create', u'item': {u'type': u'yo'}},
+            {u'op': u'delete', u'id': self.second[u'id']},
+        ])
+        created = result[u'results'][0]
+        self.assertEqual(self.resource._listener.changes, [[
+            (u'created', created[u'id'], created[u'revision']),
+            (u'deleted', self.second[u'id'], None),
+        ]])
+
+    def test_does_not_notify_of_update_that_changes_nothing(self):
+        result = self._post_batch([
+            {u'op': u'update', u'item': dict(self.first)},
+        ])
+        self.assertEqual(
+            result[u'results'][0][u'revision'], self.first[u'revision'])
+        self.assertEqual(self.resource._listener.changes, [[]])
+
+    def test_requires_list_of_operations(self):
+        for body in [{u'operations': {}}, [], u'operations', None]:
+            bottle.request.qvarn_json = body
+            with self.assertRaises(BadBatch):
+                self.resource.post_batch()
+
+    def test_rejects_unknown_operation_with_its_index(self):
+        with self.assertRaises(BadBatchOperation) as cm:
+            self._post_batch([
+                {u'op': u'create', u'item': {u'type': u'yo'}},
+                {u'op': u'replace', u'item': {u'type': u'yo'}},
+            ])
+        self.assertEqual(cm.exception.error[u'batch_index'], 1)
+        self.assertEqual(self._get_foos(), [u'a', u'b'])
+
+    def test_rejects_invalid_item(self):
+        with self.assertRaises(qvarn.ValidationError) as cm:
+            self._post_batch([
+                {u'op': u'create', u'item': {u'type': u'yo', u'foo': 1}},
+            ])
+        self.assertEqual(cm.exception.error[u'batch_index'], 0)
+
+    def test_rejects_create_with_id(self):
+        with self.assertRaises(qvarn.CannotAddWithId):
+            self._post_batch([
+                {u'op': u'create', u'item': {u'type': u'yo', u'id': u'x'}},
+            ])
+
+    def test_rejects_update_without_revision(self):
+        item = dict(self.first)
+        del item[u'revision']
+        with self.assertRaises(qvarn.NoItemRevision):
+            self._post_batch([{u'op': u'update', u'item': item}])
+
+    def test_rejects_changing_same_item_twice(self):
+        with self.assertRaises(DuplicateBatchItem):
+            self._post_batch([
+                {u'op': u'update', u'item': dict(self.first, foo=u'c')},
+                {u'op': u'delete', u'id': self.first[u'id']},
+            ])
+
+    def test_changes_nothing_if_an_update_has_wrong_revision(self):
+        with self.assertRaises(qvarn.WrongRevision):
+            self._post_batch([
+                {u'op': u'create', u'item': {u'type': u'yo', u'foo': u'x'}},
+                {u'op': u'delete', u'id': self.second[u'id']},
+                {
+                    u'op': u'update',
+                    u'item': dict(self.first, foo=u'c', revision=u'old'),
+                },
+            ])
+        self.assertEqual(self._get_foos(), [u'a', u'b'])
+        self.assertEqual(self.resource._listener.changes, [])
+
+
+class DeleteBySearchTests(ListResourceBase):
+
+    def setUp(self):
+        super(DeleteBySearchTests, self).setUp()
+        for foo in [u'a', u'b', u'c']:
+            self._add_item(foo=foo, lst=[foo, u'x'])
+
+    def _delete(self, url):
+        bottle.request.environ['REQUEST_URI'] = url
+        result = self.resource.delete_matching_items(url)
+        bottle.request = bottle.LocalRequest()
+        return result
+
+    def test_deletes_matching_items(self):
+        deleted_ids = [x[u'id'] for x in self._search(u'/search/gt/foo/a')]
+        result = self._delete(u'/search/gt/foo/a')
+        self.assertEqual(result, {u'deleted': 2})
+        self.assertEqual(
+            self._search(u'/search/show_all', show=u'foo'), [u'a'])
+        self.assertEqual(self.resource._listener.changes, [
+            [(u'deleted', item_id, None) for item_id in deleted_ids],
+        ])
+
+    def test_deletes_item_with_many_matching_list_items_once(self):
+        self.assertEqual(
+            self._delete(u'/search/exact/lst/x'), {u'deleted': 3})
+        self.assertEqual(self._search(u'/search/show_all'), [])
+
+    def test_deletes_in_chunks(self):
+        old_max = qvarn.write_only.max_ids_per_query
+        qvarn.write_only.max_ids_per_query = 2
+        try:
+            result = self._delete(u'/search/exact/lst/x')
+        finally:
+            qvarn.write_only.max_ids_per_query = old_max
+        self.assertEqual(result, {u'deleted': 3})
+        self.assertEqual(self._search(u'/search/show_all'), [])
+
+    def test_deletes_nothing_if_nothing_matches(self):
+        self.assertEqual(
+            self._delete(u'/search/exact/foo/nope'), {u'deleted': 0})
+        self.assertEqual(len(self._search(u'/search/show_all')), 3)
+
+    def test_requires_a_search_condition(self):
+        with self.assertRaises(BadDeleteSearch):
+            self._delete(u'/search/show_all')
+
+    def test_rejects_other_than_search_conditions(self):
+        with self.assertRaises(BadDeleteSearch):
+            self._delete(u'/search/exact/foo/a/sort/foo/limit/1')
+        self.assertEqual(len(self._search(u'/search/show_all')), 3)
+
+
 class FakeListenerResource(object):
 
-    def notify_create(self, item_id, item_revision):
+    def __init__(self):
+        self.changes = []
+
+    def notify_create(self, item_id, item_revision, transaction=None):
         pass
 
-    def notify_update(self, item_id, item_revision):
+    def notify_update(self, item_id, item_revision, transaction=None):
         pass
 
-    def notify_delete(self, item_id):
+    def notify_delete(self, item_id, transaction=None):
         pass
+
+    def notify_changes(self, changes, transaction=None):
+        self.changes.append(changes)
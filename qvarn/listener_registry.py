@@ -0,0 +1,121 @@
+# listener_registry.py - find listeners of changes without searching
+#
+# Copyright 2017 QvarnLabs Ltd
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import thread
+
+import qvarn
+
+
+class ListenerRegistry(object):
+
+    '''A threadsafe in-memory index of the listeners of a resource type.
+
+    Listeners change rarely, but are needed for every write. The
+    registry keeps them in memory, and reads them again only when the
+    generation of the listeners in the database has changed. Whatever
+    changes listeners must call ``listeners_changed`` in the same
+    transaction. Checking the generation is one single-row query.
+
+    '''
+
+    def __init__(self, item_type):
+        self._listener_table = qvarn.table_name(
+            resource_type=item_type, auxtable=u'listener')
+        self._generation_table = qvarn.table_name(
+            resource_type=item_type, auxtable=u'listener_generation')
+        self._id_generator = qvarn.ResourceIdGenerator()
+        self._lock = thread.allocate_lock()
+        self._generation = None
+        self._index = None
+
+    def prepare(self, transaction):
+        '''Create the generation table, if it doesn't exist yet.
+
+        This is done when storage is prepared, not when Qvarn starts.
+
+        '''
+
+        transaction.create_table(
+            self._generation_table, {u'generation': unicode})
+
+    def listeners_changed(self, transaction):
+        '''Make all workers read the listeners again.'''
+        new = {u'generation': self._new_id()}
+        if not transaction.update(self._generation_table, None, new):
+            transaction.insert(self._generation_table, new)
+
+    def get_index(self, transaction):
+        '''Return a ListenerIndex of the current listeners.'''
+
+        # Read the generation before the listeners. If the listeners
+        # change in between, the index is newer than its generation,
+        # and is only read again needlessly.
+        generation = self._get_generation(transaction)
+        with self._lock:
+            if self._index is not None and self._generation == generation:
+                return self._index
+
+        index = ListenerIndex(self._get_listeners(transaction))
+        with self._lock:
+            self._generation = generation
+            self._index = index
+        return index
+
+    def _new_id(self):
+        return self._id_generator.new_id(u'listener_generation')
+
+    def _get_generation(self, transaction):
+        # The table is empty until listeners first change, and may
+        # have more than one row, if they first changed in concurrent
+        # transactions, but then all rows are updated together.
+        rows = transaction.select(
+            self._generation_table, [u'generation'], None)
+        return tuple(sorted(row[u'generation'] for row in rows))
+
+    def _get_listeners(self, transaction):
+        ro = qvarn.ReadOnlyStorage()
+        ro.set_item_prototype(self._listener_table, qvarn.listener_prototype)
+        return ro.get_items(transaction, ro.get_item_ids(transaction))
+
+
+class ListenerIndex(object):
+
+    '''Listeners of a resource type, indexed by what they listen on.'''
+
+    def __init__(self, listeners):
+        self._new_listeners = set()
+        self._all_listeners = set()
+        self._item_listeners = {}
+        for listener in listeners:
+            listener_id = listener[u'id']
+            if listener[u'notify_of_new']:
+                self._new_listeners.add(listener_id)
+            if listener[u'listen_on_all']:
+                self._all_listeners.add(listener_id)
+            for item_id in listener[u'listen_on']:
+                self._item_listeners.setdefault(item_id, set()).add(
+                    listener_id)
+
+    def find(self, change, item_id):
+        '''Return ids of listeners to notify of a change, sorted.'''
+        if change == u'created':
+            found = self._new_listeners
+        else:
+            found = self._all_listeners.union(
+                self._item_listeners.get(item_id, ()))
+        return sorted(found)
@@ -0,0 +1,123 @@
+# listener_registry_tests.py - unit tests
+#
+# Copyright 2017 QvarnLabs Ltd
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import collections
+import unittest
+
+import qvarn
+
+
+class ListenerRegistryTests(unittest.TestCase):
+
+    resource_type = u'yo'
+
+    def setUp(self):
+        self.dbconn = qvarn.DatabaseConnection()
+        self.dbconn.set_sql(qvarn.SqliteAdapter())
+
+        vs = qvarn.VersionedStorage()
+        vs.set_resource_type(self.resource_type)
+        vs.start_version(u'first-version', None)
+        vs.add_prototype(qvarn.listener_prototype, auxtable=u'listener')
+        with self.dbconn.transaction() as t:
+            vs.prepare_storage(t)
+
+        self.wo = qvarn.WriteOnlyStorage()
+        self.wo.set_item_prototype(
+            qvarn.table_name(
+                resource_type=self.resource_type, auxtable=u'listener'),
+            qvarn.listener_prototype)
+
+        self.registry = qvarn.ListenerRegistry(self.resource_type)
+        with self.dbconn.transaction() as t:
+            self.registry.prepare(t)
+
+    def add_listener(self, t, **kwargs):
+        listener = {
+            u'type': u'listener',
+            u'notify_of_new': False,
+            u'listen_on_all': False,
+            u'listen_on': [],
+        }
+        listener.update(kwargs)
+        return self.wo.add_item(t, listener)[u'id']
+
+    def test_prepares_table_again(self):
+        with self.dbconn.transaction() as t:
+            self.registry.prepare(t)
+            self.assertEqual(self.registry._get_generation(t), ())
+
+    def test_keeps_one_generation(self):
+        generations = []
+        for _ in range(2):
+            with self.dbconn.transaction() as t:
+                self.registry.listeners_changed(t)
+                generations.append(self.registry._get_generation(t))
+        self.assertEqual([len(x) for x in generations], [1, 1])
+        self.assertNotEqual(generations[0], generations[1])
+
+    def test_reads_listeners_added_before_first_change(self):
+        with self.dbconn.transaction() as t:
+            self.registry.get_index(t)
+            new = self.add_listener(t, notify_of_new=True)
+            self.registry.listeners_changed(t)
+            index = self.registry.get_index(t)
+        self.assertEqual(index.find(u'created', u'foo'), [new])
+
+    def test_finds_listeners_of_each_change(self):
+        with self.dbconn.transaction() as t:
+            new = self.add_listener(t, notify_of_new=True)
+            foo = self.add_listener(t, listen_on=[u'foo', u'bar'])
+            every = self.add_listener(t, listen_on_all=True)
+            self.registry.listeners_changed(t)
+            index = self.registry.get_index(t)
+
+        self.assertEqual(index.find(u'created', u'foo'), [new])
+        self.assertEqual(
+            index.find(u'updated', u'foo'), sorted([foo, every]))
+        self.assertEqual(
+            index.find(u'deleted', u'bar'), sorted([foo, every]))
+        self.assertEqual(index.find(u'updated', u'other'), [every])
+
+    def test_keeps_index_until_listeners_change(self):
+        with self.dbconn.transaction() as t:
+            self.registry.get_index(t)
+            self.add_listener(t, notify_of_new=True)
+            counter = SelectCounter(t)
+            index = self.registry.get_index(counter)
+        self.assertEqual(index.find(u'created', u'foo'), [])
+        self.assertEqual(counter.tables.values(), [1])
+
+        with self.dbconn.transaction() as t:
+            self.registry.listeners_changed(t)
+            index = self.registry.get_index(t)
+        self.assertEqual(len(index.find(u'created', u'foo')), 1)
+
+
+class SelectCounter(object):
+
+    def __init__(self, transaction):
+        self._transaction = transaction
+        self.tables = collections.Counter()
+
+    def __getattr__(self, name):
+        return getattr(self._transaction, name)
+
+    def select(self, table_name, *args, **kwargs):
+        self.tables[table_name] += 1
+        return self._transaction.select(table_name, *args, **kwargs)
@@ -25,6 +25,7 @@
 '''Listener and notification resources in the HTTP API.'''
 
 
+import collections
 import time
 import urlparse
 import bottle
@@ -54,6 +55,30 @@ notification_prototype = {
 }
 
 
+# Fields of notifications included in a list with ?embed=true.
+embedded_fields = [
+    u'resource_id',
+    u'resource_revision',
+    u'resource_change',
+    u'last_modified',
+]
+
+
+NotificationQuery = collections.namedtuple('NotificationQuery', (
+    # Only notifications modified after this, or None.
+    'since',
+    # The most notifications to list, or None.
+    'limit',
+    # A next_after token from the previous page, or None.
+    'after',
+    # Whether to include embedded_fields of each notification.
+    'embed',
+    # Whether since, limit or after was given, so that only
+    # notifications older than max_transaction_age are listed.
+    'paged',
+))
+
+
 class ListenerResource(object):
 
     '''A listener (+ notification) resource in the HTTP API.
@@ -74,13 +99,35 @@ class ListenerResource(object):
 
     ``notify_delete`` with argument item id only
 
+    Each also takes an optional ``transaction``. If given, the
+    notifications are added in that transaction, so that they're
+    committed together with the change, or not at all.
+
     '''
 
+    # The longest a GET of notifications may wait for new ones, in
+    # seconds.
+    max_wait = 60
+
+    # The longest a write may take from setting the last_modified time
+    # of its notifications to committing them, in seconds. Pages of
+    # notifications end this long before now, so that no notification
+    # that is still being committed can later appear before the end
+    # of a page.
+    max_transaction_age = 10
+
+    # How often, in seconds, a waiting GET of a page looks again for
+    # notifications that have become old enough to list.
+    settle_interval = 1
+
     def __init__(self):
         self._path = None
         self._dbconn = None
+        self._waker = None
         self._notification_table = None
         self._listener_table = None
+        self._registry = None
+        self._sweeper = None
 
     def set_top_resource_path(self, item_type, path):
         '''Set the type of resource items we operate on, and its path.'''
@@ -91,6 +138,20 @@ class ListenerResource(object):
             resource_type=item_type, auxtable=u'listener')
         self._notification_table = qvarn.table_name(
             resource_type=item_type, auxtable=u'notification')
+        self._registry = qvarn.ListenerRegistry(item_type)
+
+    def set_notification_retention_days(self, days):
+        '''Delete notifications after they're ``days`` days old.
+
+        If ``days`` is None, notifications are kept until they're
+        deleted via the API. Call this after set_top_resource_path.
+
+        '''
+
+        self._sweeper = None
+        if days is not None:
+            self._sweeper = qvarn.NotificationSweeper(
+                self._notification_table, days)
 
     def _quote(self, path):  # pragma: no cover
         path = path.lstrip('/')
@@ -106,6 +167,7 @@ class ListenerResource(object):
         '''
 
         self._dbconn = dbconn
+        self._waker = dbconn.get_notification_waker()
 
         # Add the listen_on_all column to the table, if missing. It
         # might be missing if the table was created by an earlier
@@ -152,6 +214,12 @@ class ListenerResource(object):
                 'method': 'GET',
                 'callback': self.get_notifications,
             },
+            {
+                'path': notifications_path + '/_acknowledge',
+                'method': 'POST',
+                'callback': self.acknowledge_notifications,
+                'apply': qvarn.BasicValidationPlugin(),
+            },
             {
                 'path':
                 notifications_path + '/<notification_id>',
@@ -194,16 +262,99 @@ class ListenerResource(object):
     def get_notifications(self, listener_id):
         '''Serve GET /foos/listeners/123/notifications.
 
-        Lists all notifications.
+        Lists notifications, oldest first. ``?since=T`` lists only those
+        modified after T, and ``?limit=N`` at most N of them, with a
+        ``next_after`` token if there may be more. ``?after=token``
+        continues from the previous page. ``?embed=true`` includes the
+        fields of each notification, instead of only its id. With
+        ``?wait=N``, if there are none, waits up to N seconds for one
+        to be added.
+
+        ``last_modified`` is taken before the notification commits, so
+        notifications don't commit in ``last_modified`` order. With
+        ``since``, ``limit`` or ``after``, only notifications at least
+        ``max_transaction_age`` seconds old are listed, so that a page
+        never ends past a notification that is still being committed.
         '''
+
+        query = self._parse_notification_query()
+        wait = self._get_wait()
+        if not wait:
+            return self._search_notifications(listener_id, query)
+
+        generation = self._waker.get_generation(listener_id)
+        result = self._search_notifications(listener_id, query)
+        deadline = time.time() + wait
+        while not result[u'resources']:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            if query.paged:
+                # Committed notifications become old enough to list
+                # without anyone waking us.
+                timeout = min(timeout, self.settle_interval)
+            new_generation = self._waker.wait(
+                listener_id, generation, timeout)
+            if new_generation == generation and not query.paged:
+                break
+            if new_generation is not None:
+                generation = new_generation
+            result = self._search_notifications(listener_id, query)
+        return result
+
+    def _get_wait(self):
+        wait = self._get_query_int('wait', 0, BadWaitValue)
+        if wait is None:
+            return 0
+        return min(wait, self.max_wait)
+
+    def _parse_notification_query(self):
+        since = self._get_query_int('since', 0, BadSinceValue)
+        limit = self._get_query_int('limit', 1, BadLimitValue)
+        after = bottle.request.query.get('after')
+        embed = bottle.request.query.get('embed', 'false').lower()
+        if embed not in ('true', 'false'):
+            raise BadEmbedValue()
+        return NotificationQuery(
+            since=since, limit=limit, after=after, embed=embed == 'true',
+            paged=not (since is None and limit is None and after is None))
+
+    def _get_query_int(self, name, minimum, exc_class):
+        value = bottle.request.query.get(name)
+        if value is None:
+            return None
+        try:
+            number = int(value)
+        except ValueError as e:
+            raise exc_class(error=str(e))
+        if number < minimum:
+            raise exc_class(error='should be at least %d' % minimum)
+        return number
+
+    def _search_notifications(self, listener_id, query):
+        search_params = [
+            qvarn.create_search_param(u'exact', u'listener_id', listener_id),
+        ]
+        if query.since is not None:
+            search_params.append(
+                qvarn.create_search_param(
+                    u'gt', u'last_modified', query.since))
+        if query.paged:
+            # last_modified is in microseconds.
+            horizon = int((time.time() - self.max_transaction_age) * 1000000)
+            search_params.append(
+                qvarn.create_search_param(u'le', u'last_modified', horizon))
+        show_params = []
+        if query.embed:
+            show_params = [(u'show', field) for field in embedded_fields]
+
         ro = self._create_resource_ro_storage(
             self._notification_table, notification_prototype)
         with self._dbconn.transaction() as t:
-            result = ro.search(t, [
-                qvarn.create_search_param(u'exact', u'listener_id',
-                                          listener_id),
-            ], [], sort_params=[u'last_modified'])
-        return result
+            return ro.search(
+                t, search_params, show_params,
+                sort_params=[u'last_modified'],
+                limit=query.limit, after=query.after)
 
     def post_listener(self):
         '''Serve POST /foos/listeners to create a new listener.'''
@@ -223,6 +374,7 @@ class ListenerResource(object):
             self._listener_table, listener_prototype)
         with self._dbconn.transaction() as t:
             added = wo.add_item(t, listener)
+            self._registry.listeners_changed(t)
 
         resource_path = u'%s/listeners/%s' % (self._path, added[u'id'])
         resource_url = urlparse.urljoin(
@@ -267,6 +419,7 @@ class ListenerResource(object):
             self._listener_table, listener_prototype)
         with self._dbconn.transaction() as t:
             updated = wo.update_item(t, listener)
+            self._registry.listeners_changed(t)
 
         return updated
 
@@ -276,6 +429,7 @@ class ListenerResource(object):
             wo_listener = self._create_resource_wo_storage(
                 self._listener_table, listener_prototype)
             wo_listener.delete_item(t, listener_id)
+            self._registry.listeners_changed(t)
 
             ro = self._create_resource_ro_storage(
                 self._notification_table, notification_prototype)
@@ -303,96 +457,127 @@ class ListenerResource(object):
         with self._dbconn.transaction() as t:
             wo.delete_item(t, notification_id)
 
-    def notify_create(self, item_id, item_revision):
-        '''Adds a created notification.
+    def acknowledge_notifications(self, listener_id):
+        '''Serve POST /foos/listeners/123/notifications/_acknowledge.
 
-        Notification is added for every listener that has notify_of_new
-        enabled.
+        Deletes many notifications of the listener at once. The body is
+        either ``{"ids": [...]}`` to delete the notifications with the
+        given ids, or ``{"up_to": last_modified}`` to delete all
+        notifications with at most that ``last_modified``. Ids of
+        other listeners' notifications are ignored. Returns the number
+        of deleted notifications.
         '''
 
+        body = bottle.request.qvarn_json
+        if not isinstance(body, dict):
+            raise BadAcknowledge()
+        ids = body.get(u'ids')
+        up_to = body.get(u'up_to')
+        if ids is not None and up_to is None:
+            if not isinstance(ids, list) or not all(
+                    isinstance(x, basestring) for x in ids):
+                raise BadAcknowledge()
+        elif up_to is not None and ids is None:
+            if isinstance(up_to, bool) or not isinstance(up_to, (int, long)):
+                raise BadAcknowledge()
+        else:
+            raise BadAcknowledge()
+
+        table_name = self._notification_table
+        own = ('=', table_name, u'listener_id', listener_id)
         with self._dbconn.transaction() as t:
-            ro = self._create_resource_ro_storage(
-                self._listener_table, listener_prototype)
-            listener_resources = ro.search(t, [
-                qvarn.create_search_param(u'exact', u'notify_of_new', True),
-            ], [])
+            if ids is not None:
+                found = []
+                for chunk in qvarn.id_chunks(ids):
+                    found += t.select(
+                        table_name, [u'id'],
+                        ('AND', own, ('IN', table_name, u'id', chunk)))
+            else:
+                found = t.select(
+                    table_name, [u'id'],
+                    ('AND', own,
+                     ('<=', table_name, u'last_modified', up_to)))
 
             wo = self._create_resource_wo_storage(
-                self._notification_table, notification_prototype)
-            for listener in listener_resources[u'resources']:
-                notification = {
-                    u'type': u'notification',
-                    u'listener_id': listener[u'id'],
-                    u'resource_id': item_id,
-                    u'resource_revision': item_revision,
-                    u'resource_change': u'created',
-                    u'last_modified': int(time.time() * 1000000)
-                }
-                wo.add_item(t, notification)
+                table_name, notification_prototype)
+            wo.delete_items(t, [row[u'id'] for row in found])
+        return {u'deleted': len(found)}
+
+    def notify_create(self, item_id, item_revision, transaction=None):
+        '''Adds a created notification.
+
+        Notification is added for every listener that has notify_of_new
+        enabled.
+        '''
 
-    def notify_update(self, item_id, item_revision):  # pragma: no cover
+        self.notify_changes(
+            [(u'created', item_id, item_revision)], transaction=transaction)
+
+    def notify_update(self, item_id, item_revision,
+                      transaction=None):  # pragma: no cover
         '''Adds an updated notification.
 
         Notification is added for every listener that is listening on
         the updated item id.
         '''
 
-        with self._dbconn.transaction() as t:
-            ro = self._create_resource_ro_storage(
-                self._listener_table, listener_prototype)
-            listener_resources = ro.search(t, [
-                qvarn.create_search_param(u'exact', u'listen_on', item_id),
-            ], [])
-            wildcard_listener_resources = ro.search(t, [
-                qvarn.create_search_param(u'exact', u'listen_on_all', True),
-            ], [])
-            listeners = listener_resources[u'resources']
-            listeners.extend(wildcard_listener_resources[u'resources'])
+        self.notify_changes(
+            [(u'updated', item_id, item_revision)], transaction=transaction)
 
-            wo = self._create_resource_wo_storage(
-                self._notification_table, notification_prototype)
-            for listener in listeners:
-                notification = {
-                    u'type': u'notification',
-                    u'listener_id': listener[u'id'],
-                    u'resource_id': item_id,
-                    u'resource_revision': item_revision,
-                    u'resource_change': u'updated',
-                    u'last_modified': int(time.time() * 1000000)
-                }
-                wo.add_item(t, notification)
-
-    def notify_delete(self, item_id):  # pragma: no cover
+    def notify_delete(self, item_id, transaction=None):  # pragma: no cover
         '''Adds an deleted notification.
 
         Notification is added for every listener that is listening on
         the updated item id.
         '''
 
-        with self._dbconn.transaction() as t:
-            ro = self._create_resource_ro_storage(
-                self._listener_table, listener_prototype)
-            listener_resources = ro.search(t, [
-                qvarn.create_search_param(u'exact', u'listen_on', item_id),
-            ], [])
-            wildcard_listener_resources = ro.search(t, [
-                qvarn.create_search_param(u'exact', u'listen_on_all', True),
-            ], [])
-            listeners = listener_resources[u'resources']
-            listeners.extend(wildcard_listener_resources[u'resources'])
+        self.notify_changes(
+            [(u'deleted', item_id, None)], transaction=transaction)
 
-            wo = self._create_resource_wo_storage(
-                self._notification_table, notification_prototype)
-            for listener in listeners:
-                notification = {
+    def notify_changes(self, changes, transaction=None):
+        '''Adds notifications for many changes at once.
+
+        ``changes`` is a list of (resource_change, item_id,
+        item_revision) tuples, where resource_change is ``created``,
+        ``updated`` or ``deleted``. The listeners are looked up in the
+        ListenerRegistry, and the notifications are added in one
+        transaction: ``transaction``, if given, or a new one. A
+        listener gets one notification per change.
+        '''
+
+        if not changes:
+            return
+
+        if transaction is None:
+            with self._dbconn.transaction() as t:
+                self._add_notifications(t, changes)
+        else:
+            self._add_notifications(transaction, changes)
+
+    def _add_notifications(self, t, changes):
+        listeners = self._registry.get_index(t)
+        notifications = []
+        for change, item_id, item_revision in changes:
+            last_modified = int(time.time() * 1000000)
+            for listener_id in listeners.find(change, item_id):
+                notifications.append({
                     u'type': u'notification',
-                    u'listener_id': listener[u'id'],
+                    u'listener_id': listener_id,
                     u'resource_id': item_id,
-                    u'resource_revision': None,
-                    u'resource_change': u'deleted',
-                    u'last_modified': int(time.time() * 1000000)
-                }
-                wo.add_item(t, notification)
+                    u'resource_revision': item_revision,
+                    u'resource_change': change,
+                    u'last_modified': last_modified,
+                })
+
+        if not notifications:
+            return
+
+        wo = self._create_resource_wo_storage(
+            self._notification_table, notification_prototype)
+        wo.add_items(t, notifications)
+        self._waker.wake(t, set(n[u'listener_id'] for n in notifications))
+        if self._sweeper is not None:
+            t.on_commit(lambda: self._sweeper.maybe_sweep(self._dbconn))
 
     def _create_resource_ro_storage(self, resource_name, prototype):
         ro = qvarn.ReadOnlyStorage()
@@ -403,3 +588,31 @@ class ListenerResource(object):
         wo = qvarn.WriteOnlyStorage()
         wo.set_item_prototype(resource_name, prototype)
         return wo
+
+
+class BadWaitValue(qvarn.BadRequest):
+
+    msg = u'Invalid wait value: {error}.'
+
+
+class BadSinceValue(qvarn.BadRequest):
+
+    msg = u'Invalid since value: {error}.'
+
+
+class BadLimitValue(qvarn.BadRequest):
+
+    msg = u'Invalid limit value: {error}.'
+
+
+class BadEmbedValue(qvarn.BadRequest):
+
+    msg = u'Invalid embed value: should be true or false.'
+
+
+class BadAcknowledge(qvarn.BadRequest):
+
+    msg = (
+        u'Acknowledge needs either a list of notification ids as "ids", '
+        u'or a last_modified value as "up_to"'
+    )
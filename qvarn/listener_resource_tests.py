@@ -16,12 +16,17 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import time
 import unittest
 
 import bottle
 
 import qvarn
 
+from qvarn.listener_resource import (
+    BadWaitValue, BadSinceValue, BadLimitValue, BadEmbedValue,
+    BadAcknowledge)
+
 
 class ListenerResourceBase(unittest.TestCase):
 
@@ -47,6 +52,8 @@ class ListenerResourceBase(unittest.TestCase):
         vs.add_prototype(qvarn.listener_prototype, auxtable=u'listener')
         vs.add_prototype(qvarn.notification_prototype,
                          auxtable=u'notification')
+        vs.add_prepare_callback(
+            qvarn.ListenerRegistry(self.resource_type).prepare)
         with self._dbconn.transaction() as t:
             vs.prepare_storage(t)
 
@@ -101,3 +108,459 @@ class ListenerResourceTests(ListenerResourceBase):
         notification = self.listener.get_notification(
             notifications[u'resources'][0][u'id'])
         self.assertEqual(notification[u'resource_id'], added[u'id'])
+
+    def test_notifies_of_many_changes_at_once(self):
+        bottle.request.url = ''
+        bottle.request.qvarn_json = {u'notify_of_new': True}
+        new_listener = self.listener.post_listener()
+        bottle.request.qvarn_json = {u'listen_on': [u'foo', u'bar']}
+        foo_listener = self.listener.post_listener()
+        bottle.request.qvarn_json = {u'listen_on_all': True}
+        all_listener = self.listener.post_listener()
+
+        self.listener.notify_changes([
+            (u'created', u'new', u'rev1'),
+            (u'updated', u'foo', u'rev2'),
+            (u'deleted', u'bar', None),
+            (u'updated', u'other', u'rev3'),
+        ])
+
+        def changes(listener):
+            ro = qvarn.ReadOnlyStorage()
+            ro.set_item_prototype(
+                self.listener._notification_table,
+                qvarn.notification_prototype)
+            with self._dbconn.transaction() as t:
+                result = ro.search(t, [
+                    qvarn.create_search_param(
+                        u'exact', u'listener_id', listener[u'id']),
+                ], [u'show_all'])
+            return sorted(
+                (x[u'resource_change'], x[u'resource_id'],
+                 x[u'resource_revision'])
+                for x in result[u'resources'])
+
+        self.assertEqual(
+            changes(new_listener), [(u'created', u'new', u'rev1')])
+        self.assertEqual(
+            changes(foo_listener),
+            [(u'deleted', u'bar', None), (u'updated', u'foo', u'rev2')])
+        self.assertEqual(
+            changes(all_listener),
+            [
+                (u'deleted', u'bar', None),
+                (u'updated', u'foo', u'rev2'),
+                (u'updated', u'other', u'rev3'),
+            ])
+
+    def test_notifies_in_given_transaction(self):
+        bottle.request.url = ''
+        bottle.request.qvarn_json = {u'notify_of_new': True}
+        listener = self.listener.post_listener()
+
+        with self.assertRaises(RollBack):
+            with self._dbconn.transaction() as t:
+                self.listener.notify_create(u'lost', u'rev1', transaction=t)
+                raise RollBack()
+        with self._dbconn.transaction() as t:
+            self.listener.notify_create(u'kept', u'rev2', transaction=t)
+
+        notifications = self.listener.get_notifications(listener[u'id'])
+        self.assertEqual(len(notifications[u'resources']), 1)
+        notification = self.listener.get_notification(
+            notifications[u'resources'][0][u'id'])
+        self.assertEqual(notification[u'resource_id'], u'kept')
+
+    def test_resource_change_and_notification_commit_together(self):
+        bottle.request.url = ''
+        bottle.request.qvarn_json = {u'notify_of_new': True}
+        listener = self.listener.post_listener()
+
+        bottle.request.qvarn_json = {u'operations': [
+            {u'op': u'create', u'item': {u'type': u'yo', u'value': u'1'}},
+        ]}
+        result = self.resource.post_batch()
+        added = result[u'results'][0]
+
+        notifications = self.listener.get_notifications(listener[u'id'])
+        notification = self.listener.get_notification(
+            notifications[u'resources'][0][u'id'])
+        self.assertEqual(notification[u'resource_id'], added[u'id'])
+        self.assertEqual(
+            notification[u'resource_revision'], added[u'revision'])
+
+
+class WaitTests(ListenerResourceBase):
+
+    def setUp(self):
+        super(WaitTests, self).setUp()
+        bottle.request.url = ''
+        bottle.request.qvarn_json = {u'notify_of_new': True}
+        self.listener_id = self.listener.post_listener()[u'id']
+
+    def get_notifications(self, query):
+        bottle.request['QUERY_STRING'] = query
+        result = self.listener.get_notifications(self.listener_id)
+        return [x[u'id'] for x in result[u'resources']]
+
+    def test_returns_existing_notifications_without_waiting(self):
+        self.listener.notify_create(u'foo', u'rev1')
+        self.listener._waker = NoWaitWaker()
+        self.assertEqual(len(self.get_notifications('wait=30')), 1)
+
+    def test_returns_notification_added_while_waiting(self):
+        waker = AddingWaker(self.listener)
+        self.listener._waker = waker
+        self.assertEqual(len(self.get_notifications('wait=30')), 1)
+        self.assertEqual(len(waker.timeouts), 1)
+
+    def test_does_not_use_waker_without_wait(self):
+        self.listener._waker = UnusedWaker()
+        self.assertEqual(self.get_notifications(''), [])
+
+    def test_looks_again_if_waker_cannot_tell(self):
+        waker = PollingWaker(self.listener)
+        self.listener._waker = waker
+        self.assertEqual(len(self.get_notifications('wait=30')), 1)
+        self.assertEqual(len(waker.timeouts), 2)
+
+    def test_returns_nothing_if_nothing_is_added(self):
+        self.assertEqual(self.get_notifications('wait=0'), [])
+
+    def test_limits_wait(self):
+        waker = RecordingWaker()
+        self.listener._waker = waker
+        self.assertEqual(self.get_notifications('wait=3600'), [])
+        self.assertTrue(
+            0 < waker.timeouts[0] <= qvarn.ListenerResource.max_wait)
+
+    def test_rejects_bad_wait_value(self):
+        with self.assertRaises(BadWaitValue):
+            self.get_notifications('wait=soon')
+        with self.assertRaises(BadWaitValue):
+            self.get_notifications('wait=-1')
+
+
+class NotificationQueryTests(ListenerResourceBase):
+
+    def setUp(self):
+        super(NotificationQueryTests, self).setUp()
+        bottle.request.url = ''
+        bottle.request.qvarn_json = {u'notify_of_new': True}
+        self.listener_id = self.listener.post_listener()[u'id']
+        for item_id in [u'a', u'b', u'c', u'd', u'e']:
+            self.listener.notify_create(item_id, u'rev-' + item_id)
+        self.all = self.get_notifications('embed=true')[u'resources']
+        # List the notifications just added in pages, too.
+        self.listener.max_transaction_age = 0
+
+    def get_notifications(self, query):
+        bottle.request['QUERY_STRING'] = query
+        return self.listener.get_notifications(self.listener_id)
+
+    def test_embeds_notification_fields(self):
+        self.assertEqual(
+            [x[u'resource_id'] for x in self.all],
+            [u'a', u'b', u'c', u'd', u'e'])
+        for notification in self.all:
+            full = self.listener.get_notification(notification[u'id'])
+            self.assertEqual(notification, {
+                u'id': full[u'id'],
+                u'resource_id': full[u'resource_id'],
+                u'resource_revision': full[u'resource_revision'],
+                u'resource_change': u'created',
+                u'last_modified': full[u'last_modified'],
+            })
+
+    def test_lists_only_ids_by_default(self):
+        result = self.get_notifications('')
+        self.assertEqual(
+            result, {u'resources': [{u'id': x[u'id']} for x in self.all]})
+
+    def test_pages_with_limit_and_after(self):
+        ids = []
+        query = 'limit=2'
+        while True:
+            result = self.get_notifications(query)
+            ids += [x[u'id'] for x in result[u'resources']]
+            if u'next_after' not in result:
+                break
+            query = 'limit=2&after=' + result[u'next_after']
+        self.assertEqual(ids, [x[u'id'] for x in self.all])
+
+    def test_lists_notifications_since_last_modified(self):
+        since = self.all[1][u'last_modified']
+        result = self.get_notifications('since=%d' % since)
+        expected = [
+            x[u'id'] for x in self.all if x[u'last_modified'] > since]
+        self.assertEqual([x[u'id'] for x in result[u'resources']], expected)
+
+    def test_rejects_bad_values(self):
+        with self.assertRaises(BadSinceValue):
+            self.get_notifications('since=yesterday')
+        with self.assertRaises(BadLimitValue):
+            self.get_notifications('limit=0')
+        with self.assertRaises(BadEmbedValue):
+            self.get_notifications('embed=yes')
+        with self.assertRaises(qvarn.BadRequest):
+            self.get_notifications('limit=2&after=garbage')
+
+
+class OutOfOrderCommitTests(ListenerResourceBase):
+
+    def setUp(self):
+        super(OutOfOrderCommitTests, self).setUp()
+        bottle.request.url = ''
+        bottle.request.qvarn_json = {u'notify_of_new': True}
+        self.listener_id = self.listener.post_listener()[u'id']
+        self.listener.max_transaction_age = 100
+        self.now = int(time.time() * 1000000)
+
+    def commit_notification(self, seconds_ago):
+        # As if a write that took its last_modified that many seconds
+        # ago commits now.
+        table_name = qvarn.table_name(
+            resource_type=self.resource_type, auxtable=u'notification')
+        wo = qvarn.WriteOnlyStorage()
+        wo.set_item_prototype(table_name, qvarn.notification_prototype)
+        with self._dbconn.transaction() as t:
+            added = wo.add_item(t, {
+                u'type': u'notification',
+                u'listener_id': self.listener_id,
+                u'resource_id': u'foo',
+                u'resource_revision': u'rev1',
+                u'resource_change': u'created',
+                u'last_modified': self.now - seconds_ago * 1000000,
+            })
+        return added[u'id']
+
+    def get_notifications(self, query):
+        bottle.request['QUERY_STRING'] = query
+        result = self.listener.get_notifications(self.listener_id)
+        return result, [x[u'id'] for x in result[u'resources']]
+
+    def test_since_does_not_skip_notification_committed_late(self):
+        first = self.commit_notification(1000)
+        late = self.commit_notification(50)
+        _, ids = self.get_notifications('limit=2&embed=true')
+        self.assertEqual(ids, [first])
+
+        # A write that started earlier commits after the page was read.
+        earlier = self.commit_notification(60)
+        self.listener.max_transaction_age = 0
+        since = self.listener.get_notification(first)[u'last_modified']
+        _, ids = self.get_notifications('limit=2&since=%d' % since)
+        self.assertEqual(ids, [earlier, late])
+
+    def test_does_not_return_next_after_past_horizon(self):
+        first = self.commit_notification(1000)
+        self.commit_notification(50)
+        self.commit_notification(49)
+        result, ids = self.get_notifications('limit=2')
+        self.assertEqual(ids, [first])
+        self.assertNotIn(u'next_after', result)
+
+    def test_after_does_not_skip_notification_committed_late(self):
+        first = [self.commit_notification(1001),
+                 self.commit_notification(1000)]
+        late = self.commit_notification(50)
+        result, ids = self.get_notifications('limit=2')
+        self.assertEqual(ids, first)
+
+        earlier = self.commit_notification(60)
+        self.listener.max_transaction_age = 0
+        _, ids = self.get_notifications(
+            'limit=2&after=' + result[u'next_after'])
+        self.assertEqual(ids, [earlier, late])
+
+    def test_lists_all_notifications_without_paging(self):
+        first = self.commit_notification(1000)
+        late = self.commit_notification(50)
+        _, ids = self.get_notifications('')
+        self.assertEqual(ids, [first, late])
+
+    def test_waits_for_notification_to_become_old_enough(self):
+        self.commit_notification(50)
+        waker = SettlingWaker(self.listener)
+        self.listener._waker = waker
+        _, ids = self.get_notifications('since=0&wait=30')
+        self.assertEqual(len(ids), 1)
+        self.assertEqual(
+            waker.timeouts, [qvarn.ListenerResource.settle_interval])
+
+
+class AcknowledgeTests(ListenerResourceBase):
+
+    def setUp(self):
+        super(AcknowledgeTests, self).setUp()
+        bottle.request.url = ''
+        bottle.request.qvarn_json = {u'notify_of_new': True}
+        self.first = self.listener.post_listener()[u'id']
+        self.second = self.listener.post_listener()[u'id']
+        for item_id in [u'a', u'b', u'c']:
+            self.listener.notify_create(item_id, u'rev')
+
+    def notifications(self, listener_id):
+        result = self.listener.get_notifications(listener_id)
+        return [
+            self.listener.get_notification(x[u'id'])
+            for x in result[u'resources']
+        ]
+
+    def acknowledge(self, listener_id, body):
+        bottle.request.qvarn_json = body
+        return self.listener.acknowledge_notifications(listener_id)
+
+    def test_deletes_listed_notifications(self):
+        first = self.notifications(self.first)
+        second = self.notifications(self.second)
+        result = self.acknowledge(self.first, {
+            u'ids': [first[0][u'id'], first[2][u'id'], second[0][u'id']],
+        })
+        self.assertEqual(result, {u'deleted': 2})
+        self.assertEqual(self.notifications(self.first), [first[1]])
+        self.assertEqual(self.notifications(self.second), second)
+
+    def test_deletes_listed_notifications_in_chunks(self):
+        first = self.notifications(self.first)
+        old_max = qvarn.write_only.max_ids_per_query
+        qvarn.write_only.max_ids_per_query = 1
+        try:
+            result = self.acknowledge(
+                self.first, {u'ids': [x[u'id'] for x in first]})
+        finally:
+            qvarn.write_only.max_ids_per_query = old_max
+        self.assertEqual(result, {u'deleted': 3})
+        self.assertEqual(self.notifications(self.first), [])
+
+    def test_deletes_notifications_up_to_last_modified(self):
+        first = self.notifications(self.first)
+        second = self.notifications(self.second)
+        result = self.acknowledge(
+            self.first, {u'up_to': first[1][u'last_modified']})
+        self.assertEqual(result, {u'deleted': 2})
+        self.assertEqual(self.notifications(self.first), [first[2]])
+        self.assertEqual(self.notifications(self.second), second)
+
+    def test_deletes_nothing_for_no_ids(self):
+        self.assertEqual(self.acknowledge(self.first, {u'ids': []}),
+                         {u'deleted': 0})
+
+    def test_rejects_bad_requests(self):
+        bodies = [
+            [],
+            None,
+            {},
+            {u'ids': [], u'up_to': 0},
+            {u'ids': u'a'},
+            {u'ids': [1]},
+            {u'up_to': u'0'},
+            {u'up_to': True},
+        ]
+        for body in bodies:
+            with self.assertRaises(BadAcknowledge):
+                self.acknowledge(self.first, body)
+        self.assertEqual(len(self.notifications(self.first)), 3)
+
+
+class SweepTests(ListenerResourceBase):
+
+    def setUp(self):
+        super(SweepTests, self).setUp()
+        self.sweeper = CountingSweeper()
+        self.listener._sweeper = self.sweeper
+
+    def test_does_not_sweep_without_new_notifications(self):
+        self.listener.notify_create(u'foo', u'rev1')
+        self.assertEqual(self.sweeper.count, 0)
+
+    def test_sweeps_after_adding_notifications(self):
+        bottle.request.url = ''
+        bottle.request.qvarn_json = {u'notify_of_new': True}
+        self.listener.post_listener()
+        self.listener.notify_create(u'foo', u'rev1')
+        self.assertEqual(self.sweeper.count, 1)
+
+
+class CountingSweeper(object):
+
+    def __init__(self):
+        self.count = 0
+
+    def maybe_sweep(self, dbconn):
+        self.count += 1
+
+
+class NoWaitWaker(qvarn.NotificationWaker):
+
+    def wait(self, listener_id, generation, timeout):
+        raise AssertionError('should not wait')
+
+
+class UnusedWaker(qvarn.NotificationWaker):
+
+    def get_generation(self, listener_id):
+        raise AssertionError('should not get generation')
+
+
+class RecordingWaker(qvarn.NotificationWaker):
+
+    def __init__(self):
+        super(RecordingWaker, self).__init__()
+        self.timeouts = []
+
+    def wait(self, listener_id, generation, timeout):
+        self.timeouts.append(timeout)
+        return generation
+
+
+class AddingWaker(RecordingWaker):
+
+    '''Add a notification, as if another request did while waiting.'''
+
+    def __init__(self, listener):
+        super(AddingWaker, self).__init__()
+        self._listener = listener
+
+    def wait(self, listener_id, generation, timeout):
+        super(AddingWaker, self).wait(listener_id, generation, timeout)
+        self._listener.notify_create(u'foo', u'rev1')
+        return self.get_generation(listener_id)
+
+
+class SettlingWaker(RecordingWaker):
+
+    '''Lets time pass without new notifications.'''
+
+    def __init__(self, listener):
+        super(SettlingWaker, self).__init__()
+        self._listener = listener
+
+    def wait(self, listener_id, generation, timeout):
+        super(SettlingWaker, self).wait(listener_id, generation, timeout)
+        self._listener.max_transaction_age = 0
+        return generation
+
+
+class PollingWaker(RecordingWaker):
+
+    '''Can't tell if there are new notifications, as if not listening.
+
+    A notification is added during the second wait.
+
+    '''
+
+    def __init__(self, listener):
+        super(PollingWaker, self).__init__()
+        self._listener = listener
+
+    def wait(self, listener_id, generation, timeout):
+        super(PollingWaker, self).wait(listener_id, generation, timeout)
+        if len(self.timeouts) == 2:
+            self._listener.notify_create(u'foo', u'rev1')
+        return None
+
+
+class RollBack(Exception):
+
+    pass
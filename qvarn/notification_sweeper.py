@@ -0,0 +1,110 @@
+# notification_sweeper.py - delete old notifications
+#
+# Copyright 2017 QvarnLabs Ltd
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import thread
+import threading
+import time
+
+import qvarn
+
+
+class NotificationSweeper(object):
+
+    '''Delete notifications older than a retention period.
+
+    Notifications are deleted at most ``batch_size`` at a time, each
+    batch in its own transaction, so that a sweep never locks much of
+    the table for long. A sweep stops after ``max_batches``, and the
+    rest is left for the next one. ``maybe_sweep`` sweeps in a
+    background thread, at most once every ``interval`` seconds, so it
+    is cheap to call often.
+
+    '''
+
+    batch_size = 1000
+    max_batches = 10
+    interval = 60
+
+    def __init__(self, notification_table, retention_days):
+        self._notification_table = notification_table
+        self._retention = retention_days * 24 * 60 * 60
+        self._lock = thread.allocate_lock()
+        self._last_sweep = None
+        self._sweeping = False
+
+    def maybe_sweep(self, dbconn):
+        '''Start a sweep in the background, unless one was started lately.
+
+        Nothing is done if the previous sweep was started less than
+        ``interval`` seconds ago, or is still running. Return the
+        thread of the sweep, or None.
+
+        '''
+
+        now = time.time()
+        with self._lock:
+            if self._sweeping or (
+                    self._last_sweep is not None and
+                    now - self._last_sweep < self.interval):
+                return None
+            self._last_sweep = now
+            self._sweeping = True
+        sweeper = threading.Thread(
+            target=self._sweep_in_background, args=(dbconn, now))
+        sweeper.daemon = True
+        sweeper.start()
+        return sweeper
+
+    def _sweep_in_background(self, dbconn, now):
+        # Errors are logged, not raised, since nobody waits for the
+        # result.
+        try:
+            self.sweep(dbconn, now=now)
+        except Exception as e:  # pragma: no cover
+            qvarn.log.log(
+                'warning', msg_text='Sweeping notifications failed',
+                exception=str(e))
+        finally:
+            with self._lock:
+                self._sweeping = False
+
+    def sweep(self, dbconn, now=None):
+        '''Delete old notifications, and return how many were deleted.'''
+        if now is None:
+            now = time.time()
+        # last_modified is in microseconds.
+        cutoff = int((now - self._retention) * 1000000)
+        deleted = 0
+        for _ in range(self.max_batches):
+            with dbconn.transaction() as t:
+                count = self._sweep_batch(t, cutoff)
+            deleted += count
+            if count < self.batch_size:
+                break
+        return deleted
+
+    def _sweep_batch(self, transaction, cutoff):
+        table_name = self._notification_table
+        rows = transaction.select(
+            table_name, [u'id'],
+            ('<=', table_name, u'last_modified', cutoff),
+            limit=self.batch_size)
+        wo = qvarn.WriteOnlyStorage()
+        wo.set_item_prototype(table_name, qvarn.notification_prototype)
+        wo.delete_items(transaction, [row[u'id'] for row in rows])
+        return len(rows)
@@ -0,0 +1,134 @@
+# notification_sweeper_tests.py - unit tests
+#
+# Copyright 2017 QvarnLabs Ltd
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import threading
+import unittest
+
+import qvarn
+
+
+day = 24 * 60 * 60
+
+
+class NotificationSweeperTests(unittest.TestCase):
+
+    resource_type = u'yo'
+
+    def setUp(self):
+        self.dbconn = qvarn.DatabaseConnection()
+        self.dbconn.set_sql(qvarn.SqliteAdapter())
+
+        vs = qvarn.VersionedStorage()
+        vs.set_resource_type(self.resource_type)
+        vs.start_version(u'first-version', None)
+        vs.add_prototype(
+            qvarn.notification_prototype, auxtable=u'notification')
+        with self.dbconn.transaction() as t:
+            vs.prepare_storage(t)
+
+        self.table_name = qvarn.table_name(
+            resource_type=self.resource_type, auxtable=u'notification')
+        self.wo = qvarn.WriteOnlyStorage()
+        self.wo.set_item_prototype(
+            self.table_name, qvarn.notification_prototype)
+        self.ro = qvarn.ReadOnlyStorage()
+        self.ro.set_item_prototype(
+            self.table_name, qvarn.notification_prototype)
+
+        self.now = 100 * day
+        self.sweeper = qvarn.NotificationSweeper(self.table_name, 7)
+
+    def add_notifications(self, ages_in_days):
+        with self.dbconn.transaction() as t:
+            self.wo.add_items(t, [
+                {
+                    u'type': u'notification',
+                    u'listener_id': u'listener',
+                    u'resource_id': u'resource',
+                    u'resource_revision': u'rev',
+                    u'resource_change': u'updated',
+                    u'last_modified': int((self.now - age * day) * 1000000),
+                }
+                for age in ages_in_days
+            ])
+
+    def remaining_ages(self):
+        with self.dbconn.transaction() as t:
+            items = self.ro.get_items(t, self.ro.get_item_ids(t))
+        return sorted(
+            (self.now - item[u'last_modified'] / 1000000) / day
+            for item in items)
+
+    def test_deletes_notifications_older_than_retention(self):
+        self.add_notifications([1, 6, 7, 8, 30])
+        self.assertEqual(self.sweeper.sweep(self.dbconn, now=self.now), 3)
+        self.assertEqual(self.remaining_ages(), [1, 6])
+
+    def test_deletes_in_batches(self):
+        self.sweeper.batch_size = 2
+        self.add_notifications([10, 11, 12, 13, 14])
+        self.assertEqual(self.sweeper.sweep(self.dbconn, now=self.now), 5)
+        self.assertEqual(self.remaining_ages(), [])
+
+    def test_stops_after_max_batches(self):
+        self.sweeper.batch_size = 2
+        self.sweeper.max_batches = 2
+        self.add_notifications([10, 11, 12, 13, 14])
+        self.assertEqual(self.sweeper.sweep(self.dbconn, now=self.now), 4)
+        self.assertEqual(len(self.remaining_ages()), 1)
+
+
+class MaybeSweepTests(unittest.TestCase):
+
+    def setUp(self):
+        self.sweeper = RecordingSweeper(u'yo__aux_notification', 7)
+
+    def test_sweeps_in_background(self):
+        sweeper_thread = self.sweeper.maybe_sweep(None)
+        sweeper_thread.join()
+        self.assertEqual(self.sweeper.threads, [sweeper_thread])
+        self.assertNotEqual(sweeper_thread, threading.current_thread())
+
+    def test_sweeps_once_per_interval(self):
+        self.sweeper.maybe_sweep(None).join()
+        self.assertEqual(self.sweeper.maybe_sweep(None), None)
+        self.assertEqual(len(self.sweeper.threads), 1)
+
+    def test_does_not_sweep_while_sweeping(self):
+        self.sweeper.interval = 0
+        self.sweeper.done.clear()
+        sweeper_thread = self.sweeper.maybe_sweep(None)
+        self.assertEqual(self.sweeper.maybe_sweep(None), None)
+        self.sweeper.done.set()
+        sweeper_thread.join()
+        self.sweeper.maybe_sweep(None).join()
+        self.assertEqual(len(self.sweeper.threads), 2)
+
+
+class RecordingSweeper(qvarn.NotificationSweeper):
+
+    def __init__(self, *args):
+        super(RecordingSweeper, self).__init__(*args)
+        self.threads = []
+        self.done = threading.Event()
+        self.done.set()
+
+    def sweep(self, dbconn, now=None):
+        self.threads.append(threading.current_thread())
+        self.done.wait()
+        return 0
@@ -0,0 +1,244 @@
+# notification_waker.py - wake up requests waiting for notifications
+#
+# Copyright 2017 QvarnLabs Ltd
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import thread
+import threading
+import time
+
+import qvarn
+
+
+class NotificationWaker(object):
+
+    '''Wake up requests that wait for notifications of listeners.
+
+    Each listener has a generation, which grows every time new
+    notifications for it are committed. A waiting request gets the
+    generation before it looks for notifications, and if it finds
+    none, waits for the generation to change.
+
+    This class only wakes up requests in the same process. Use
+    ``create_notification_waker`` to get one that works across
+    processes, if the database allows it.
+
+    '''
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._generations = {}
+
+    def wake(self, transaction, listener_ids):
+        '''Wake up requests waiting on listeners, once transaction commits.'''
+        listener_ids = list(listener_ids)
+        transaction.on_commit(lambda: self.wake_local(listener_ids))
+
+    def wake_local(self, listener_ids):
+        '''Wake up requests waiting on listeners in this process now.'''
+        with self._cond:
+            for listener_id in listener_ids:
+                self._generations[listener_id] = (
+                    self._generations.get(listener_id, 0) + 1)
+            self._cond.notify_all()
+
+    def get_generation(self, listener_id):
+        '''Return the current generation of a listener.'''
+        with self._cond:
+            return self._generations.get(listener_id, 0)
+
+    def wait(self, listener_id, generation, timeout):
+        '''Wait until a listener has a newer generation, or a timeout.
+
+        Return the generation at the end of the wait. It is the same as
+        ``generation`` if the wait timed out. It is None if the waker
+        can't tell whether there are new notifications, and the caller
+        should look for them again.
+
+        '''
+
+        deadline = time.time() + timeout
+        with self._cond:
+            while self._generations.get(listener_id, 0) == generation:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            return self._generations.get(listener_id, 0)
+
+
+class DatabaseNotificationWaker(NotificationWaker):
+
+    '''Wake up waiting requests in all processes that share a database.
+
+    The listener ids are sent on a database channel after the
+    transaction that adds the notifications commits. A thread in each
+    process listens on the channel, and wakes up the requests in its
+    process. The thread is started when the first request waits, so
+    that it's started after uwsgi has forked the worker processes.
+    Until the thread listens, waiting requests don't wait for it, but
+    poll.
+
+    A transaction that sends a notify takes a lock when it commits,
+    which every other such transaction waits for. So writes don't
+    send them. Instead, committed writes queue their listener ids, and
+    another thread sends all queued ids in one transaction at most
+    every ``notify_interval`` seconds. Requests in the same process
+    are woken at once.
+
+    '''
+
+    channel = u'qvarn_notifications'
+
+    # Payloads must be shorter than 8000 bytes in Postgres.
+    max_ids_per_payload = 100
+
+    # Seconds to wait before listening again after an error.
+    retry_delay = 5
+
+    # Seconds between looking for notifications, when not listening.
+    poll_interval = 1
+
+    # Seconds between sending queued listener ids.
+    notify_interval = 0.1
+
+    def __init__(self, sql):
+        super(DatabaseNotificationWaker, self).__init__()
+        self._sql = sql
+        self._lock = thread.allocate_lock()
+        self._thread = None
+        self._listening = threading.Event()
+        self._pending_cond = threading.Condition()
+        self._pending = set()
+        self._sender = None
+
+    def wake(self, transaction, listener_ids):
+        listener_ids = list(listener_ids)
+        transaction.on_commit(lambda: self._queue(listener_ids))
+
+    def _queue(self, listener_ids):
+        self.wake_local(listener_ids)
+        with self._pending_cond:
+            self._pending.update(listener_ids)
+            self._pending_cond.notify()
+        self._start_sending()
+
+    def send_pending(self):
+        '''Send the queued listener ids to all processes.
+
+        Return False if sending failed. The ids are then queued again.
+
+        '''
+
+        with self._pending_cond:
+            listener_ids = sorted(self._pending)
+            self._pending.clear()
+        if not listener_ids:
+            return True
+
+        # The database sends the payloads to every listening process,
+        # this one included, when the transaction commits.
+        try:
+            with self._sql_transaction() as t:
+                for i in range(
+                        0, len(listener_ids), self.max_ids_per_payload):
+                    chunk = listener_ids[i:i + self.max_ids_per_payload]
+                    t.notify(self.channel, u' '.join(chunk))
+        except Exception as e:
+            self._log_error(u'Sending notifications failed', e)
+            with self._pending_cond:
+                self._pending.update(listener_ids)
+            return False
+        return True
+
+    def _sql_transaction(self):
+        trans = qvarn.Transaction()
+        trans.set_sql(self._sql)
+        return trans
+
+    def _start_sending(self):  # pragma: no cover
+        with self._lock:
+            if self._sender is None:
+                self._sender = threading.Thread(target=self._send)
+                self._sender.daemon = True
+                self._sender.start()
+
+    def _send(self):  # pragma: no cover
+        while True:
+            with self._pending_cond:
+                while not self._pending:
+                    self._pending_cond.wait()
+            if self.send_pending():
+                time.sleep(self.notify_interval)
+            else:
+                time.sleep(self.retry_delay)
+
+    def get_generation(self, listener_id):
+        self._start_listening()
+        return super(DatabaseNotificationWaker, self).get_generation(
+            listener_id)
+
+    def wait(self, listener_id, generation, timeout):
+        if not self._listening.is_set():
+            time.sleep(min(timeout, self.poll_interval))
+            return None
+        return super(DatabaseNotificationWaker, self).wait(
+            listener_id, generation, timeout)
+
+    def _start_listening(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._listen)
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _listen(self):  # pragma: no cover
+        while True:
+            try:
+                conn = self._sql.get_listen_conn(self.channel)
+            except Exception as e:
+                self._log_error(u'Listening for notifications failed', e)
+                time.sleep(self.retry_delay)
+                continue
+            # Notifications may have been missed while not listening,
+            # so let all waiting requests look again.
+            self._wake_all()
+            self._listening.set()
+            try:
+                while True:
+                    payloads = self._sql.wait_for_notifies(conn, 60)
+                    for payload in payloads:
+                        self.wake_local(payload.split())
+            except Exception as e:
+                self._log_error(u'Listening for notifications failed', e)
+            finally:
+                self._listening.clear()
+                conn.close()
+
+    def _wake_all(self):  # pragma: no cover
+        with self._cond:
+            listener_ids = list(self._generations)
+        self.wake_local(listener_ids)
+
+    def _log_error(self, msg_text, e):
+        qvarn.log.log('error', msg_text=msg_text, exception=str(e))
+
+
+def create_notification_waker(sql):
+    '''Return a NotificationWaker for a database.'''
+    if sql.supports_notify:
+        return DatabaseNotificationWaker(sql)
+    return NotificationWaker()
@@ -0,0 +1,189 @@
+# notification_waker_tests.py - unit tests
+#
+# Copyright 2017 QvarnLabs Ltd
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import threading
+import time
+import unittest
+
+import qvarn
+
+
+class NotificationWakerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dbconn = qvarn.DatabaseConnection()
+        self.dbconn.set_sql(qvarn.SqliteAdapter())
+        self.waker = qvarn.NotificationWaker()
+
+    def test_wakes_after_commit(self):
+        generation = self.waker.get_generation(u'foo')
+        with self.dbconn.transaction() as t:
+            self.waker.wake(t, [u'foo'])
+            self.assertEqual(self.waker.get_generation(u'foo'), generation)
+        self.assertNotEqual(self.waker.get_generation(u'foo'), generation)
+        self.assertEqual(self.waker.get_generation(u'bar'), 0)
+
+    def test_does_not_wake_after_rollback(self):
+        with self.assertRaises(RollBack):
+            with self.dbconn.transaction() as t:
+                self.waker.wake(t, [u'foo'])
+                raise RollBack()
+        self.assertEqual(self.waker.get_generation(u'foo'), 0)
+
+    def test_wait_times_out(self):
+        generation = self.waker.get_generation(u'foo')
+        self.assertEqual(self.waker.wait(u'foo', generation, 0.01), generation)
+
+    def test_wait_returns_at_once_if_already_woken(self):
+        self.waker.wake_local([u'foo'])
+        self.assertEqual(self.waker.wait(u'foo', 0, 10), 1)
+
+    def test_wait_returns_when_woken_by_another_thread(self):
+        generation = self.waker.get_generation(u'foo')
+        timer = threading.Timer(0.01, self.waker.wake_local, [[u'foo']])
+        timer.start()
+        try:
+            new_generation = self.waker.wait(u'foo', generation, 10)
+        finally:
+            timer.join()
+        self.assertEqual(new_generation, generation + 1)
+
+    def test_creates_local_waker_for_sqlite(self):
+        waker = qvarn.create_notification_waker(qvarn.SqliteAdapter())
+        self.assertEqual(type(waker), qvarn.NotificationWaker)
+
+    def test_database_connection_has_one_waker(self):
+        self.assertIs(
+            self.dbconn.get_notification_waker(),
+            self.dbconn.get_notification_waker())
+
+
+class DatabaseNotificationWakerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.waker = qvarn.DatabaseNotificationWaker(NeverListeningSql())
+        self.waker.poll_interval = 0.01
+
+    def test_does_not_block_until_listening(self):
+        started = time.time()
+        generation = self.waker.get_generation(u'foo')
+        self.assertEqual(generation, 0)
+        self.assertLess(time.time() - started, 1)
+
+    def test_polls_until_listening(self):
+        generation = self.waker.get_generation(u'foo')
+        started = time.time()
+        self.assertEqual(self.waker.wait(u'foo', generation, 10), None)
+        self.assertLess(time.time() - started, 1)
+
+
+class SendingTests(unittest.TestCase):
+
+    def setUp(self):
+        self.sql = NotifyingSqliteAdapter()
+        self.dbconn = qvarn.DatabaseConnection()
+        self.dbconn.set_sql(self.sql)
+        self.waker = ManuallySendingWaker(self.sql)
+
+    def test_wakes_local_requests_at_commit(self):
+        with self.dbconn.transaction() as t:
+            self.waker.wake(t, [u'foo'])
+            self.assertEqual(self.waker.get_local_generation(u'foo'), 0)
+        self.assertEqual(self.waker.get_local_generation(u'foo'), 1)
+
+    def test_sends_nothing_in_write_transaction(self):
+        with self.dbconn.transaction() as t:
+            self.waker.wake(t, [u'foo'])
+        self.assertEqual(self.sql.payloads, [])
+
+    def test_sends_ids_of_many_writes_at_once(self):
+        for listener_ids in [[u'foo', u'bar'], [u'foo']]:
+            with self.dbconn.transaction() as t:
+                self.waker.wake(t, listener_ids)
+        self.assertTrue(self.waker.send_pending())
+        self.assertEqual(
+            self.sql.payloads,
+            [(qvarn.DatabaseNotificationWaker.channel, u'bar foo')])
+        self.assertTrue(self.waker.send_pending())
+        self.assertEqual(len(self.sql.payloads), 1)
+
+    def test_does_not_send_after_rollback(self):
+        with self.assertRaises(RollBack):
+            with self.dbconn.transaction() as t:
+                self.waker.wake(t, [u'foo'])
+                raise RollBack()
+        self.assertTrue(self.waker.send_pending())
+        self.assertEqual(self.sql.payloads, [])
+
+    def test_splits_long_payloads(self):
+        self.waker.max_ids_per_payload = 2
+        with self.dbconn.transaction() as t:
+            self.waker.wake(t, [u'a', u'b', u'c'])
+        self.waker.send_pending()
+        self.assertEqual(
+            [payload for _, payload in self.sql.payloads], [u'a b', u'c'])
+
+    def test_queues_ids_again_when_sending_fails(self):
+        with self.dbconn.transaction() as t:
+            self.waker.wake(t, [u'foo'])
+        self.sql.fail = True
+        self.assertFalse(self.waker.send_pending())
+        self.sql.fail = False
+        self.assertTrue(self.waker.send_pending())
+        self.assertEqual(
+            [payload for _, payload in self.sql.payloads], [u'foo'])
+
+
+class ManuallySendingWaker(qvarn.DatabaseNotificationWaker):
+
+    '''A waker that only sends when told to, and never listens.'''
+
+    def get_local_generation(self, listener_id):
+        return qvarn.NotificationWaker.get_generation(self, listener_id)
+
+    def _start_sending(self):
+        pass
+
+
+class NotifyingSqliteAdapter(qvarn.SqliteAdapter):
+
+    '''An SQLite adapter that records notifies instead of sending them.'''
+
+    def __init__(self):
+        super(NotifyingSqliteAdapter, self).__init__()
+        self.payloads = []
+        self.fail = False
+
+    def format_notify(self, channel, payload):
+        if self.fail:
+            raise qvarn.QvarnException()
+        self.payloads.append((channel, payload))
+        return u'SELECT 1', {}
+
+
+class NeverListeningSql(object):
+
+    '''A database whose LISTEN connection never gets made.'''
+
+    def get_listen_conn(self, channel):
+        threading.Event().wait()
+
+
+class RollBack(Exception):
+
+    pass
@@ -16,8 +16,10 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import base64
+import json
+import sys
 import time
-import uuid
 import collections
 
 import qvarn
@@ -56,6 +58,9 @@ class ReadOnlyStorage(object):
         self._item_type = None
         self._prototype = None
         self._subitem_prototypes = qvarn.SubItemPrototypes()
+        self._search_plans = None
+        self._field_index = None
+        self._json_document = False
         self._m = None
 
     def set_item_prototype(self, item_type, prototype):
@@ -67,20 +72,155 @@ class ReadOnlyStorage(object):
         '''Set prototype for a subitem.'''
         self._subitem_prototypes.add(item_type, subitem_name, prototype)
 
+    def set_search_plan_cache(self, search_plans):
+        '''Set qvarn.SearchPlanCache for compiled searches.
+
+        The cache may be shared by all ReadOnlyStorage instances with
+        the same prototypes.
+
+        '''
+
+        self._search_plans = search_plans
+
+    def set_field_index(self, field_index):
+        '''Set qvarn.FieldIndex for resolving search and sort fields.
+
+        If not set, one is built from the prototypes when first needed.
+
+        '''
+
+        self._field_index = field_index
+
+    def set_json_document(self, enabled):
+        '''Set whether items may be read from their JSON documents.
+
+        Items whose document is missing are read from the tables as
+        usual.
+
+        '''
+
+        self._json_document = enabled
+
+    def build_field_index(self):
+        '''Build a qvarn.FieldIndex from the prototypes.'''
+        return qvarn.FieldIndex(self._build_schema())
+
+    def _get_field_index(self):
+        if self._field_index is None:
+            with self._m.new('build field index'):
+                self._field_index = self.build_field_index()
+        return self._field_index
+
     def get_item_ids(self, transaction):
         '''Get list of ids of all items.'''
         return [
             row['id']
             for row in transaction.select(self._item_type, [u'id'], None)]
 
+    def get_revision(self, transaction, item_id):
+        '''Get the current revision of an item.
+
+        This is much cheaper than getting the whole item.
+
+        '''
+
+        revision = select_revision(transaction, self._item_type, item_id)
+        if revision is None:
+            raise ItemDoesNotExist(item_id=item_id)
+        return revision
+
     def get_item(self, transaction, item_id, main_fields=None):
-        '''Get a specific item.'''
+        '''Get a specific item.
+
+        If the item has a stored JSON document, or the database can
+        build one, the whole item is fetched with a single query.
+        Otherwise, the tables are read one by one with ReadWalker.
+
+        '''
+
+        if main_fields is None and self._json_document:
+            item = self._get_item_from_document(transaction, item_id)
+            if item is not None:
+                return item
+
+        if main_fields is None and transaction.supports_json_select():
+            jw = JsonShapeWalker(self._item_type)
+            jw.walk_item(self._prototype, self._prototype)
+            if jw.shape is not None:
+                return self._get_item_as_json(transaction, item_id, jw.shape)
+
         item = {}
         rw = ReadWalker(
             transaction, self._item_type, item_id, main_fields=main_fields)
         rw.walk_item(item, self._prototype)
         return item
 
+    def _get_item_from_document(self, transaction, item_id):
+        match = ('=', self._item_type, u'id', item_id)
+        rows = transaction.select(
+            self._item_type, [u'id', u'revision', qvarn.json_document_column],
+            match)
+        if not rows:
+            raise ItemDoesNotExist(item_id=item_id)
+        return self._load_document(rows[0])
+
+    def _load_document(self, row):
+        document = row[qvarn.json_document_column]
+        if document is None:
+            return None
+        item = json.loads(document)
+        # Updating a subitem changes only the revision column.
+        item[u'revision'] = row[u'revision']
+        return item
+
+    def _get_item_as_json(self, transaction, item_id, json_shape):
+        match = ('=', self._item_type, u'id', item_id)
+        for item in transaction.select_json(json_shape, match):
+            return item
+        raise ItemDoesNotExist(item_id=item_id)
+
+    def get_items(self, transaction, item_ids, main_fields=None):
+        '''Get many items at once.
+
+        The items are returned as a list in the same order as
+        ``item_ids``. The ids are read in chunks of at most
+        ``max_ids_per_query``, and the number of queries per chunk
+        depends only on the prototype, not on the number of items.
+
+        '''
+
+        items = {}
+        for chunk in qvarn.id_chunks(item_ids):
+            items.update(self._get_chunk_of_items(
+                transaction, chunk, main_fields))
+        return [items[item_id] for item_id in item_ids]
+
+    def _get_chunk_of_items(self, transaction, item_ids, main_fields):
+        items = {}
+        if main_fields is None and self._json_document:
+            items = self._get_items_from_documents(transaction, item_ids)
+
+        missing = [x for x in item_ids if x not in items]
+        if missing:
+            bw = BatchReadWalker(
+                transaction, self._item_type, missing,
+                main_fields=main_fields)
+            bw.walk_item(self._prototype, self._prototype)
+            items.update(zip(missing, bw.get_items()))
+        return items
+
+    def _get_items_from_documents(self, transaction, item_ids):
+        match = ('IN', self._item_type, u'id', list(item_ids))
+        rows = transaction.select(
+            self._item_type, [u'id', u'revision', qvarn.json_document_column],
+            match)
+        items = {}
+        for row in rows:
+            item = self._load_document(row)
+            if item is not None:
+                items[row[u'id']] = item
+        return items
+
     def get_subitem(self, transaction, item_id, subitem_name):
         '''Get a specific subitem.'''
         subitem = {}
@@ -92,7 +232,7 @@ class ReadOnlyStorage(object):
         return subitem
 
     def search(self, transaction, search_params, show_params, sort_params=None,
-               limit=None, offset=None):
+               limit=None, offset=None, after=None):
         '''Do a search.
 
         ``search_params`` is a list of qvarn.list_resource.SearchParam
@@ -108,21 +248,171 @@ class ReadOnlyStorage(object):
         ``limit`` is applied after applying ``offset``.
         ``offset`` positive integer, if given, skips given number
         of rows before returning result.
+        ``after`` is a token returned as ``next_after`` by a previous
+        search with the same ``sort_params``. If given, only resources
+        that come after the last resource of that search are returned.
+        This is cheaper than ``offset`` for deep paging.
+
+        If ``limit`` is given with ``sort_params``, and the result is a
+        full page, it includes a ``next_after`` token for the next page.
 
         '''
 
         self._m = Measurement()
-        with self._m.new('build_schema'):
-            schema = self._build_schema()
-        ids = self._kludge(transaction, schema, search_params, sort_params,
-                           limit=limit, offset=offset)
+        query, values = self._compile_search(
+            transaction, search_params, sort_params, limit, offset, after)
+        rows = transaction.execute_raw(query, values)
+        ids = [row[0] for row in rows]
         with self._m.new('build_search_result'):
             result = self._build_search_result(transaction, ids, show_params)
+            if sort_params and limit and len(rows) == limit:
+                result[u'next_after'] = self._make_after_token(rows[-1])
         self._m.finish()
         self._m.log(None)
         self._m = None
         return result
 
+    def count(self, transaction, search_params):
+        '''Count the items matching a search.
+
+        ``search_params`` is as for ``search``. The result is a dict
+        with the number of matching items as ``count``.
+
+        '''
+
+        self._m = Measurement()
+        query, values = self._compile_search(
+            transaction, search_params, None, None, None, None, count=True)
+        rows = transaction.execute_raw(query, values)
+        self._m.finish()
+        self._m.log(None)
+        self._m = None
+        return {u'count': int(rows[0][0])}
+
+    def search_ids(self, transaction, search_params):
+        '''Return the ids of all items matching a search.
+
+        ``search_params`` is as for ``search``.
+
+        '''
+
+        self._m = Measurement()
+        query, values = self._compile_search(
+            transaction, search_params, None, None, None, None)
+        rows = transaction.execute_raw(query, values)
+        self._m.finish()
+        self._m.log(None)
+        self._m = None
+        return [row[0] for row in rows]
+
+    def search_stream(self, transaction, search_params, show_params,
+                      sort_params=None, limit=None, offset=None, after=None,
+                      batch_size=100):
+        '''Do a search, producing the result as JSON text incrementally.
+
+        The arguments are as for ``search``. This is a generator that
+        yields pieces of the JSON text of the result. The matching rows
+        are fetched ``batch_size`` at a time from a server-side cursor,
+        where the database supports one, so that the whole result is
+        never in memory at once.
+
+        '''
+
+        m = self._m = Measurement()
+        batches = None
+        try:
+            query, values = self._compile_search(
+                transaction, search_params, sort_params, limit, offset, after)
+            batches = transaction.iter_raw(query, values, batch_size)
+            batch = next(batches, None)
+
+            yield '{"resources": ['
+            count = 0
+            last_row = None
+            while batch:
+                ids = [row[0] for row in batch]
+                result = self._build_search_result(
+                    transaction, ids, show_params)
+                text = ', '.join(json.dumps(x) for x in result[u'resources'])
+                yield (', ' if count else '') + text
+                count += len(batch)
+                last_row = batch[-1]
+                batch = next(batches, None)
+            yield ']'
+
+            if sort_params and limit and count == limit:
+                yield ', "next_after": ' + json.dumps(
+                    self._make_after_token(last_row))
+            yield '}'
+        finally:
+            if batches is not None:
+                batches.close()
+            m.finish()
+            m.log(sys.exc_info()[2])
+            self._m = None
+
+    def _compile_search(self, transaction, search_params, sort_params,
+                        limit, offset, after, count=False):
+        sql = transaction.get_sql()
+        after_values = None
+        if after is not None:
+            if not sort_params:
+                raise BadAfterValue(error=u'sort keys are required')
+            after_values = decode_after_token(after, len(sort_params))
+
+        field_index = self._get_field_index()
+        for key in [p.key for p in search_params] + list(sort_params or []):
+            if not field_index.has_field(key):
+                raise FieldNotInResource(field=key)
+
+        shape = search_shape(
+            search_params, sort_params, limit, offset, after, count=count)
+        plan = self._get_search_plan(shape)
+        if plan is None:
+            plan = self._kludge(
+                sql, field_index, search_params, sort_params,
+                has_limit=limit is not None, has_offset=offset is not None,
+                has_after=after is not None, count=count)
+            if self._search_plans is not None:
+                self._search_plans.put(shape, plan)
+
+        with self._m.new('bind values'):
+            values = self._bind_search_plan(
+                plan, search_params, after_values, limit, offset)
+            self._m.note(query=plan.query, values=values)
+        return plan.query, values
+
+    def _get_search_plan(self, shape):
+        if self._search_plans is None:
+            return None
+        with self._m.new('get search plan'):
+            plan = self._search_plans.get(shape)
+            stats = self._search_plans.get_stats()
+            self._m.note(
+                search_plan_cache_hit=plan is not None,
+                search_plan_cache_hits=stats['hits'],
+                search_plan_cache_misses=stats['misses'])
+        return plan
+
+    def _bind_search_plan(self, plan, search_params, after, limit, offset):
+        values = {}
+        for name, source in plan.bindings:
+            if source[0] == u'param':
+                param = search_params[source[1]]
+                value = param.value[source[2]] if param.any else param.value
+                values[name] = self._cast_value(value)
+            elif source[0] == u'after':
+                values[name] = after[source[1]]
+            elif source[0] == u'limit':
+                values[name] = limit
+            elif source[0] == u'offset':
+                values[name] = offset
+        return values
+
+    def _make_after_token(self, row):
+        # The row has the id first, then the sort key values.
+        return encode_after_token(list(row[1:]) + [row[0]])
+
     def _build_schema(self):  # pragma: no cover
         schema = qvarn.schema_from_prototype(
             self._prototype, resource_type=self._item_type)
@@ -131,36 +421,51 @@ class ReadOnlyStorage(object):
                 subproto, resource_type=self._item_type, subpath=subpath)
         return schema
 
-    def _kludge(self, transaction, schema, search_params,
-                sort_params=None, limit=None, offset=None):  # pragma: no cover
-        sql = getattr(transaction, '_sql')
+    def _kludge(self, sql, field_index, search_params, sort_params=None,
+                has_limit=False, has_offset=False,
+                has_after=False, count=False):  # pragma: no cover
         main_table = qvarn.table_name(resource_type=self._item_type)
         tables_used = [main_table]
+        bindings = []
 
         with self._m.new('build param conditions'):
-            values = {}
             conds = [
                 self._kludge_conds(
-                    sql, schema, param, values, main_table, tables_used)
-                for param in search_params]
+                    sql, field_index, i, param, bindings, main_table,
+                    tables_used)
+                for i, param in enumerate(search_params)]
 
         with self._m.new('build order by fields'):
             join_conditions = {}
             sort_params = sort_params or []
             order_by_fields = [
                 self._kludge_order_by_fields(
-                    sql, schema, key, main_table, tables_used, join_conditions)
+                    sql, field_index, key, main_table, tables_used,
+                    join_conditions)
                 for key in sort_params]
+            if order_by_fields:
+                # Sort by id last, so that the order is total, and the
+                # position of a row can be given in an after token.
+                order_by_fields.append(u't0.id')
+
+        if has_after:
+            with self._m.new('build after condition'):
+                conds.append(self._kludge_after_cond(
+                    sql, order_by_fields, bindings, main_table))
 
         with self._m.new('build full sql query'):
             main_table_alias = u't0'
             # With `SELECT DISTINCT` PostgreSQL requires all ORDER BY fields to
             # be included in select list too.
-            select_list = [main_table_alias + u'.id'] + order_by_fields
+            select_list = [main_table_alias + u'.id'] + order_by_fields[:-1]
+            if count:
+                select_list = [
+                    u'COUNT(DISTINCT {}.id)'.format(main_table_alias)]
             query = (
-                u'SELECT DISTINCT {select_list} '
+                u'SELECT {distinct}{select_list} '
                 u'FROM {main_table} AS {main_table_alias}'
             ).format(
+                distinct=u'' if count else u'DISTINCT ',
                 select_list=u', '.join(select_list),
                 main_table=sql.quote(main_table),
                 main_table_alias=main_table_alias,
@@ -177,34 +482,28 @@ class ReadOnlyStorage(object):
                 query += u' WHERE ' + u' AND '.join(
                     u'({})'.format(c) for c in conds)
             if order_by_fields:
-                query += u' ORDER BY ' + u', '.join(order_by_fields)
-            if limit is not None or offset is not None:
-                query += u' ' + sql.format_limit(limit, offset)
-            self._m.note(query=query, values=values)
-
-        return self._kludge_execute(sql, query, values)
-
-    def _kludge_execute(self, sql, query, values):  # pragma: no cover
-        with self._m.new('get conn'):
-            conn = sql.get_conn()
-        try:
-            with self._m.new('get cursor'):
-                c = conn.cursor()
-            with self._m.new('execute'):
-                c.execute(query, values)
-            with self._m.new('fetch rows'):
-                ids = [row[0] for row in c]
-                self._m.note(row_count=len(ids))
-        except BaseException:
-            with self._m.new('put conn (except)'):
-                sql.put_conn(conn)
-            raise
-        else:
-            with self._m.new('put conn'):
-                sql.put_conn(conn)
-            return ids
-
-    def _kludge_conds(self, sql, schema, param, values,
+                query += u' ORDER BY ' + u', '.join(
+                    [sql.format_sort_key(x) for x in order_by_fields[:-1]] +
+                    order_by_fields[-1:])
+            if has_limit or has_offset:
+                query += u' ' + sql.format_limit_placeholders(
+                    self._kludge_placeholder(
+                        sql, main_table, u'limit', (u'limit',), bindings)
+                    if has_limit else None,
+                    self._kludge_placeholder(
+                        sql, main_table, u'offset', (u'offset',), bindings)
+                    if has_offset else None)
+
+        return SearchPlan(query, tuple(bindings))
+
+    def _kludge_placeholder(self, sql, table_name, name, source, bindings):
+        # Placeholder names only depend on the shape of the search, so
+        # that the same SQL text can be used with different values.
+        bindings.append(
+            (sql.format_qualified_placeholder_name(table_name, name), source))
+        return sql.format_qualified_placeholder(table_name, name)
+
+    def _kludge_conds(self, sql, field_index, param_index, param, bindings,
                       main_table, tables_used):  # pragma: no cover
         rule_queries = {
             u'exact': u'{} = {}',
@@ -219,71 +518,75 @@ class ReadOnlyStorage(object):
         assert param.rule in rule_queries.keys()
 
         conds = []
-        for table_name, column_name, column_type in schema:
-            if column_name == param.key:
-                if table_name == main_table:
-                    table_alias = u't0'
-                else:
-                    table_alias = u't' + str(len(tables_used))
-                    tables_used.append(table_name)
-
-                qualified_name = sql.qualified_column(table_alias, column_name)
-                if column_type == unicode:
-                    qualified_name = u'LOWER(' + qualified_name + u')'
-
-                if param.any:
-                    values_list = param.value
-                else:
-                    values_list = [param.value]
-
-                for value in values_list:
-                    rand_name = unicode(uuid.uuid4())
-                    conds.append(rule_queries[param.rule].format(
-                        qualified_name,
-                        sql.format_qualified_placeholder(
-                            table_name, rand_name)))
-                    name = sql.format_qualified_placeholder_name(
-                        table_name, rand_name)
-                    values[name] = self._cast_value(value)
+        for column in field_index.get_columns(param.key):
+            if column.table_name == main_table:
+                table_alias = u't0'
+            else:
+                table_alias = u't' + str(len(tables_used))
+                tables_used.append(column.table_name)
+
+            qualified_name = sql.qualified_column(table_alias, param.key)
+            if column.column_type == unicode:
+                qualified_name = u'LOWER(' + qualified_name + u')'
+
+            num_values = len(param.value) if param.any else 1
+            for value_index in xrange(num_values):
+                placeholder = self._kludge_placeholder(
+                    sql, column.table_name,
+                    u'p{}_{}'.format(param_index, value_index),
+                    (u'param', param_index, value_index), bindings)
+                conds.append(rule_queries[param.rule].format(
+                    qualified_name, placeholder))
         if not conds:
             # key did not match column name in any table
             raise FieldNotInResource(field=param.key)
         return u' OR '.join(conds)
 
-    def _kludge_order_by_fields(self, sql, schema, key, main_table,
+    def _kludge_order_by_fields(self, sql, field_index, key, main_table,
                                 tables_used, join_conditions):
-        columns_by_table_name = collections.defaultdict(list)
-        for table_name, column_name, _ in schema:
-            columns_by_table_name[table_name].append(column_name)
-
-        for table_name, column_name, _ in schema:
-            if column_name == key:
-                if table_name == main_table:
-                    table_alias = u't0'
-                else:
-                    idx = len(tables_used)
-                    table_alias = u't' + str(idx)
-                    tables_used.append(table_name)
-                    join_conds = self._kludge_first_item_join_cond(
-                        sql, table_alias, columns_by_table_name[table_name])
-                    join_conditions[idx] = join_conds
-                return sql.qualified_column(table_alias, column_name)
+        for column in field_index.get_columns(key):
+            if column.table_name == main_table:
+                table_alias = u't0'
+            else:
+                idx = len(tables_used)
+                table_alias = u't' + str(idx)
+                tables_used.append(column.table_name)
+                join_conds = self._kludge_first_item_join_cond(
+                    sql, table_alias, column.list_pos_columns)
+                join_conditions[idx] = join_conds
+            return sql.qualified_column(table_alias, key)
         # key did not match column name in any table
         raise FieldNotInResource(field=key)
 
-    def _kludge_first_item_join_cond(self, sql, table_alias, columns):
+    def _kludge_after_cond(self, sql, order_by_fields, bindings, main_table):
+        # Compare rows: (sort_key1, ..., id) > (value1, ..., id_value),
+        # with NULLs after all values, as in ORDER BY. A row value
+        # comparison can't be used, since it is never true if a sort
+        # key is NULL, so it's spelled out one key at a time.
+        placeholders = [
+            self._kludge_placeholder(
+                sql, main_table, u'after_{}'.format(i), (u'after', i),
+                bindings)
+            for i in xrange(len(order_by_fields))
+        ]
+        cond = u'{} > {}'.format(order_by_fields[-1], placeholders[-1])
+        pairs = zip(order_by_fields[:-1], placeholders[:-1])
+        for field, placeholder in reversed(pairs):
+            greater = u'{0} > {1} OR ({0} IS NULL AND {1} IS NOT NULL)'.format(
+                field, placeholder)
+            equal = u'{0} = {1} OR ({0} IS NULL AND {1} IS NULL)'.format(
+                field, placeholder)
+            cond = u'{} OR (({}) AND ({}))'.format(greater, equal, cond)
+        return cond
+
+    def _kludge_first_item_join_cond(self, sql, table_alias,
+                                     list_pos_columns):
         # Build extra condition JOIN conditions in order to join just first
         # itemns in lists, whre query should consider only first item in list.
-        list_pos_names = set([
-            u'list_pos',
-            u'str_list_pos',
-            u'dict_list_pos',
-        ])
         conds = []
-        for column_name in columns:
-            if column_name in list_pos_names:
-                qualified_name = sql.qualified_column(table_alias, column_name)
-                conds.append('{} = 0'.format(qualified_name))
+        for column_name in list_pos_columns:
+            qualified_name = sql.qualified_column(table_alias, column_name)
+            conds.append('{} = 0'.format(qualified_name))
         return ' AND '.join(conds)
 
     def _cast_value(self, value):  # pragma: no cover
@@ -312,9 +615,7 @@ class ReadOnlyStorage(object):
     def _build_search_result_show_all(self, transaction,
                                       ids):  # pragma: no cover
         return {
-            u'resources': [
-                self.get_item(transaction, resource_id) for resource_id in ids
-            ],
+            u'resources': self.get_items(transaction, ids),
         }
 
     def _build_search_result_with_fields(self, transaction, ids,
@@ -322,10 +623,8 @@ class ReadOnlyStorage(object):
         if u'id' not in fields:
             fields = fields + [u'id']
         return {
-            u'resources': [
-                self.get_item(transaction, resource_id, main_fields=fields)
-                for resource_id in ids
-            ],
+            u'resources': self.get_items(
+                transaction, ids, main_fields=fields),
         }
 
     def _build_search_result_ids_only(self, ids):  # pragma: no cover
@@ -336,11 +635,78 @@ class ReadOnlyStorage(object):
         }
 
 
+SearchPlan = collections.namedtuple('SearchPlan', (
+    # The SQL text of the search, with placeholders for all values.
+    'query',
+    # Tuple of (placeholder name, source) pairs, where source tells
+    # where the value comes from: (u'param', param index, value index),
+    # (u'after', index), (u'limit',), or (u'offset',).
+    'bindings',
+))
+
+
+def search_shape(search_params, sort_params, limit, offset, after,
+                 count=False):
+    '''Return the shape of a search, as a key for compiled plans.
+
+    Searches with the same shape differ only in the values they bind
+    to placeholders, and can use the same SQL text.
+
+    '''
+
+    return (
+        tuple(
+            (p.rule, p.key, len(p.value) if p.any else None)
+            for p in search_params),
+        tuple(sort_params or []),
+        limit is not None,
+        offset is not None,
+        after is not None,
+        count,
+    )
+
+
+def select_revision(transaction, item_type, item_id):
+    '''Return current revision of an item, or None if there's no item.'''
+    table_name = qvarn.table_name(resource_type=item_type)
+    match = ('=', table_name, u'id', item_id)
+    for row in transaction.select(table_name, [u'revision'], match):
+        return row[u'revision']
+    return None
+
+
+def encode_after_token(values):
+    '''Encode sort key values and id of a row into an after token.'''
+    return unicode(base64.urlsafe_b64encode(json.dumps(values)))
+
+
+def decode_after_token(token, num_sort_keys):
+    '''Decode an after token into a list of values.
+
+    The list has a value for each sort key, and the id of the row
+    last.
+
+    '''
+
+    try:
+        values = json.loads(base64.urlsafe_b64decode(token.encode('ascii')))
+    except (TypeError, ValueError, UnicodeError) as e:
+        raise BadAfterValue(error=str(e))
+    if not isinstance(values, list) or len(values) != num_sort_keys + 1:
+        raise BadAfterValue(error=u'does not match sort keys')
+    return values
+
+
 class FieldNotInResource(qvarn.BadRequest):
 
     msg = u'Resource does not contain given field'
 
 
+class BadAfterValue(qvarn.BadRequest):
+
+    msg = u'Invalid AFTER value: {error}.'
+
+
 class ItemDoesNotExist(qvarn.NotFound):
 
     msg = u'Item does not exist'
@@ -429,25 +795,28 @@ class ReadWalker(qvarn.ItemWalker):
                 table_name, self._item_id, column_names)
 
     def visit_dict_in_list_str_list(self, item, field, pos, str_list_field):
+        # This gets called once per dict in the list, but the first
+        # call fills in all of the dicts, with one query for the table.
         if not self._main_field_ok(field):  # pragma: no cover
             return
+        if pos > 0:
+            return
 
         table_name = qvarn.table_name(
             resource_type=self._item_type,
             list_field=field,
             subdict_list_field=str_list_field)
 
-        match = (
-            'AND',
-            ('=', table_name, u'id', self._item_id),
-            ('=', table_name, u'dict_list_pos', unicode(pos))
-        )
-        rows = self._transaction.select(
-            table_name, [u'list_pos', str_list_field], match)
+        for a_dict in item[field]:
+            a_dict[str_list_field] = []
 
-        in_order = self._sort_rows(rows)
-        result = [row[str_list_field] for row in in_order]
-        item[field][pos][str_list_field] = result
+        match = ('=', table_name, u'id', self._item_id)
+        rows = self._transaction.select(
+            table_name, [u'dict_list_pos', u'list_pos', str_list_field],
+            match)
+        for row in sorted(rows, key=self._get_pos):
+            a_dict = item[field][row[u'dict_list_pos']]
+            a_dict[str_list_field].append(row[str_list_field])
 
     def visit_inner_dict_list(self, item, outer_field, inner_field,
                               column_names):
@@ -463,11 +832,7 @@ class ReadWalker(qvarn.ItemWalker):
 
         match = ('=', table_name, u'id', self._item_id)
         rows = self._transaction.select(table_name, column_names, match)
-
-        def get_pos(row):
-            return row[u'dict_list_pos'], row[u'list_pos']
-
-        in_order = list(sorted(rows, key=get_pos))
+        in_order = list(sorted(rows, key=self._get_pos))
 
         for outer_dict in item[outer_field]:
             if inner_field not in outer_dict:
@@ -480,6 +845,171 @@ class ReadWalker(qvarn.ItemWalker):
             assert j == len(inner_list), '{} != {}'.format(j, len(inner_list))
             inner_list.append(row)
 
+    def _get_pos(self, row):
+        return row[u'dict_list_pos'], row[u'list_pos']
+
+
+class BatchReadWalker(ReadWalker):
+
+    '''Visit every part of a prototype to retrieve many items at once.
+
+    This walks the prototype instead of an item, and runs one query
+    per table for all the wanted items. The rows are then distributed
+    to the right items, in list order.
+
+    '''
+
+    def __init__(self, transaction, item_type, item_ids, main_fields=None):
+        super(BatchReadWalker, self).__init__(
+            transaction, item_type, None, main_fields=main_fields)
+        self._item_ids = list(item_ids)
+        self._items = {}
+
+    def get_items(self):
+        return [self._items[item_id] for item_id in self._item_ids]
+
+    def _select_rows(self, table_name, column_names):
+        column_names = [u'id'] + [x for x in column_names if x != u'id']
+        match = ('IN', table_name, u'id', self._item_ids)
+        return self._transaction.select(table_name, column_names, match)
+
+    def visit_main_dict(self, item, column_names):
+        if self._main_fields:  # pragma: no cover
+            column_names = [c for c in column_names if c in self._main_fields]
+        for row in self._select_rows(self._item_type, column_names):
+            self._items[row[u'id']] = dict(
+                (name, row[name]) for name in column_names)
+        for item_id in self._item_ids:
+            if item_id not in self._items:
+                raise ItemDoesNotExist(item_id=item_id)
+
+    def visit_main_str_list(self, item, field):
+        if self._main_field_ok(field):
+            table_name = qvarn.table_name(
+                resource_type=self._item_type, list_field=field)
+            for item_id in self._item_ids:
+                self._items[item_id][field] = []
+            rows = self._select_rows(table_name, [u'list_pos', field])
+            for row in self._sort_rows(rows):
+                self._items[row[u'id']][field].append(row[field])
+
+    def visit_main_dict_list(self, item, field, column_names):
+        if self._main_field_ok(field):
+            table_name = qvarn.table_name(
+                resource_type=self._item_type, list_field=field)
+            for item_id in self._item_ids:
+                self._items[item_id][field] = []
+            rows = self._sort_rows(
+                self._select_rows(table_name, [u'list_pos'] + column_names))
+            for row in rows:
+                self._items[row[u'id']][field].append(
+                    dict((name, row[name]) for name in column_names))
+
+    def visit_dict_in_list_str_list(self, item, field, pos, str_list_field):
+        # This gets called once for the prototype, not once per dict
+        # in each item, so we fill in all dicts of all items at once.
+        if not self._main_field_ok(field):  # pragma: no cover
+            return
+
+        table_name = qvarn.table_name(
+            resource_type=self._item_type,
+            list_field=field,
+            subdict_list_field=str_list_field)
+
+        for item_id in self._item_ids:
+            for a_dict in self._items[item_id][field]:
+                a_dict[str_list_field] = []
+
+        rows = self._select_rows(
+            table_name, [u'dict_list_pos', u'list_pos', str_list_field])
+        for row in sorted(rows, key=self._get_pos):
+            a_dict = self._items[row[u'id']][field][row[u'dict_list_pos']]
+            a_dict[str_list_field].append(row[str_list_field])
+
+    def visit_inner_dict_list(self, item, outer_field, inner_field,
+                              column_names):
+        if not self._main_field_ok(outer_field):  # pragma: no cover
+            return
+
+        table_name = qvarn.table_name(
+            resource_type=self._item_type,
+            list_field=outer_field,
+            subdict_list_field=inner_field)
+
+        for item_id in self._item_ids:
+            for outer_dict in self._items[item_id][outer_field]:
+                outer_dict[inner_field] = []
+
+        rows = self._select_rows(
+            table_name, [u'dict_list_pos', u'list_pos'] + column_names)
+        for row in sorted(rows, key=self._get_pos):
+            outer_dict = self._items[row[u'id']][outer_field][
+                row[u'dict_list_pos']]
+            outer_dict[inner_field].append(
+                dict((name, row[name]) for name in column_names))
+
+
+class JsonShapeWalker(qvarn.ItemWalker):
+
+    '''Visit every part of a prototype to describe its JSON shape.
+
+    The shape is given to the SQL adapter, which builds a statement
+    that returns whole items as JSON documents. See qvarn.SqlAdapter
+    for what a shape is. If the prototype has fields that can't be
+    represented in JSON (blobs), ``shape`` is set to None.
+
+    '''
+
+    def __init__(self, item_type):
+        self._item_type = item_type
+        self._children = []
+        self._dict_lists = {}
+        self._has_blobs = False
+        self._shape = None
+
+    @property
+    def shape(self):
+        return None if self._has_blobs else self._shape
+
+    def _check_types(self, proto_dict, column_names):
+        for name in column_names:
+            if isinstance(proto_dict[name], buffer):
+                self._has_blobs = True
+
+    def visit_main_dict(self, item, column_names):
+        self._check_types(item, column_names)
+        self._shape = ('dict', self._item_type, column_names, self._children)
+
+    def visit_main_str_list(self, item, field):
+        table_name = qvarn.table_name(
+            resource_type=self._item_type, list_field=field)
+        self._children.append((field, ('str_list', table_name, field)))
+
+    def visit_main_dict_list(self, item, field, column_names):
+        self._check_types(item[field][0], column_names)
+        table_name = qvarn.table_name(
+            resource_type=self._item_type, list_field=field)
+        children = self._dict_lists[field] = []
+        self._children.append(
+            (field, ('dict_list', table_name, column_names, children)))
+
+    def visit_dict_in_list_str_list(self, item, field, pos, str_list_field):
+        table_name = qvarn.table_name(
+            resource_type=self._item_type,
+            list_field=field,
+            subdict_list_field=str_list_field)
+        self._dict_lists[field].append(
+            (str_list_field, ('str_list', table_name, str_list_field)))
+
+    def visit_inner_dict_list(self, item, field, inner_field, column_names):
+        self._check_types(item[field][0][inner_field][0], column_names)
+        table_name = qvarn.table_name(
+            resource_type=self._item_type,
+            list_field=field,
+            subdict_list_field=inner_field)
+        self._dict_lists[field].append(
+            (inner_field, ('dict_list', table_name, column_names, [])))
+
 
 class Measurement(object):  # pragma: no cover
 
@@ -16,6 +16,8 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import json
+import os
 import unittest
 
 import qvarn
@@ -135,6 +137,94 @@ class ReadOnlyStorageTests(ReadOnlyStorageBase):
             item = self.ro.get_item(t, added[u'id'])
             self.assertEqual(added, item)
 
+    def test_reads_str_lists_in_dict_list_with_one_select(self):
+        item = _build_item()
+        for i, a_dict in enumerate(item[u'dicts']):
+            a_dict[u'foobars'] = [u'foobar{}{}'.format(i, j) for j in [0, 1]]
+            a_dict[u'foo'] = [u'foo{}'.format(i)]
+        with self._dbconn.transaction() as t:
+            added = self.wo.add_item(t, item)
+            counter = SelectCounter(t)
+            read = {}
+            rw = qvarn.read_only.ReadWalker(
+                counter, self.resource_type, added[u'id'])
+            rw.walk_item(read, self.prototype)
+        self.assertEqual(read, added)
+        # One select each for the main table, bars, dicts, inner,
+        # foobars, and foo.
+        self.assertEqual(counter.count, 6)
+
+    def test_gets_revision_of_added_item(self):
+        with self._dbconn.transaction() as t:
+            added = self.wo.add_item(t, self.item)
+            self.assertEqual(
+                self.ro.get_revision(t, added[u'id']), added[u'revision'])
+
+    def test_get_revision_raises_error_when_item_does_not_exist(self):
+        with self.assertRaises(qvarn.ItemDoesNotExist):
+            with self._dbconn.transaction() as t:
+                self.ro.get_revision(t, u'does-not-exist')
+
+    def test_gets_many_added_items_in_given_order(self):
+        self.maxDiff = None
+        with self._dbconn.transaction() as t:
+            added = [
+                self.wo.add_item(t, _build_item(foo=foo))
+                for foo in [u'a', u'b', u'c']
+            ]
+            ids = [x[u'id'] for x in reversed(added)]
+            items = self.ro.get_items(t, ids)
+        self.assertEqual(items, list(reversed(added)))
+
+    def test_gets_many_items_in_chunks(self):
+        old_max = qvarn.write_only.max_ids_per_query
+        qvarn.write_only.max_ids_per_query = 2
+        try:
+            with self._dbconn.transaction() as t:
+                added = [
+                    self.wo.add_item(t, _build_item(foo=foo))
+                    for foo in [u'a', u'b', u'c', u'd', u'e']
+                ]
+                ids = [x[u'id'] for x in reversed(added)]
+                items = self.ro.get_items(t, ids)
+        finally:
+            qvarn.write_only.max_ids_per_query = old_max
+        self.assertEqual(items, list(reversed(added)))
+
+    def test_gets_many_items_with_main_fields(self):
+        with self._dbconn.transaction() as t:
+            added = self.wo.add_item(t, self.item)
+            items = self.ro.get_items(
+                t, [added[u'id']], main_fields=[u'id', u'foo', u'dicts'])
+        self.assertEqual(items, [{
+            u'id': added[u'id'],
+            u'foo': added[u'foo'],
+            u'dicts': added[u'dicts'],
+        }])
+
+    def test_gets_no_items_for_no_ids(self):
+        with self._dbconn.transaction() as t:
+            self.assertEqual(self.ro.get_items(t, []), [])
+
+    def test_get_items_raises_error_when_item_does_not_exist(self):
+        with self.assertRaises(qvarn.ItemDoesNotExist):
+            with self._dbconn.transaction() as t:
+                added = self.wo.add_item(t, self.item)
+                self.ro.get_items(t, [added[u'id'], u'does-not-exist'])
+
+    def test_get_items_query_count_does_not_depend_on_item_count(self):
+        counts = []
+        for num_items in [1, 5]:
+            with self._dbconn.transaction() as t:
+                ids = [
+                    self.wo.add_item(t, self.item)[u'id']
+                    for _ in range(num_items)
+                ]
+                counter = SelectCounter(t)
+                self.ro.get_items(counter, ids)
+                counts.append(counter.count)
+        self.assertEqual(counts[0], counts[1])
+
     def test_gets_empty_subitem_of_added_item(self):
         with self._dbconn.transaction() as t:
             added = self.wo.add_item(t, self.item)
@@ -238,6 +328,14 @@ class ReadOnlyStorageTests(ReadOnlyStorageBase):
         match_list = search_result[u'resources']
         self.assertIn(new_id, match_list[0][u'id'])
 
+    def test_search_ids_returns_matching_ids(self):
+        with self._dbconn.transaction() as t:
+            added = self.wo.add_item(t, self.item)
+            self.wo.add_item(t, _build_item(foo=u'other'))
+            ids = self.ro.search_ids(
+                t, [qvarn.create_search_param(u'exact', u'foo', u'foobar')])
+        self.assertEqual(ids, [added[u'id']])
+
     def test_case_search_bad_key(self):
         with self.assertRaises(qvarn.FieldNotInResource):
             with self._dbconn.transaction() as t:
@@ -316,6 +414,152 @@ class ReadOnlyStorageTests(ReadOnlyStorageBase):
         ])
 
 
+class JsonShapeWalkerTests(unittest.TestCase):
+
+    def test_describes_prototype(self):
+        jw = qvarn.read_only.JsonShapeWalker(u'yo')
+        proto = ReadOnlyStorageBase.prototype
+        jw.walk_item(proto, proto)
+        self.assertEqual(
+            jw.shape,
+            (
+                'dict', u'yo',
+                [u'bar', u'bool', u'foo', u'id', u'revision', u'type'],
+                [
+                    (u'bars', ('str_list', u'yo_bars', u'bars')),
+                    (u'dicts', (
+                        'dict_list', u'yo_dicts', [u'bar', u'baz'],
+                        [
+                            (u'inner', (
+                                'dict_list', u'yo_dicts_inner',
+                                [u'inner_foo'], [])),
+                            (u'foo', (
+                                'str_list', u'yo_dicts_foo', u'foo')),
+                            (u'foobars', (
+                                'str_list', u'yo_dicts_foobars',
+                                u'foobars')),
+                        ],
+                    )),
+                ],
+            ))
+
+    def test_has_no_shape_for_blobs(self):
+        jw = qvarn.read_only.JsonShapeWalker(u'yo')
+        proto = {u'id': u'', u'body': buffer('')}
+        jw.walk_item(proto, proto)
+        self.assertEqual(jw.shape, None)
+
+
+def _postgres_args():
+    # QVARN_TEST_POSTGRES names a scratch database as space separated
+    # key=value pairs, e.g. "host=localhost port=5432 db_name=test
+    # user=test password=secret".
+    value = os.environ.get('QVARN_TEST_POSTGRES')
+    if not value:
+        return None
+    args = dict(pair.split('=', 1) for pair in value.split())
+    args['port'] = int(args.get('port', 5432))
+    args['min_conn'] = 1
+    args['max_conn'] = 1
+    return args
+
+
+class RollBack(Exception):
+
+    pass
+
+
+@unittest.skipUnless(_postgres_args(), 'QVARN_TEST_POSTGRES is not set')
+class PostgresJsonSelectTests(unittest.TestCase):
+
+    prototype = dict(
+        [
+            (u'type', u''),
+            (u'id', u''),
+            (u'revision', u''),
+            (u'foo', u''),
+            (u'dashed-name', u''),
+            (u'count', 0),
+            (u'bool', False),
+            (u'bars', [u'']),
+            (u'dicts', [
+                {
+                    u'baz': u'',
+                    u'foobars': [u''],
+                    u'inner': [
+                        {
+                            u'inner_foo': u'',
+                        },
+                    ],
+                },
+            ]),
+        ] +
+        # More fields than jsonb_build_object takes in one call.
+        [(u'field{}'.format(i), u'') for i in range(60)])
+
+    def setUp(self):
+        self._dbconn = qvarn.DatabaseConnection()
+        self._dbconn.set_sql(qvarn.PostgresAdapter(**_postgres_args()))
+
+    def test_gets_same_item_as_table_walker(self):
+        item = dict((name, u'value {}'.format(name))
+                    for name in self.prototype
+                    if name not in (u'id', u'revision'))
+        item.update({
+            u'type': u'yo',
+            u'foo': None,
+            u'count': 42,
+            u'bool': True,
+            u'bars': [u'bar2', u'bar1', u'bar3'],
+            u'dicts': [
+                {
+                    u'baz': u'\u00e4',
+                    u'foobars': [u'b', u'a'],
+                    u'inner': [{u'inner_foo': u'x'}, {u'inner_foo': u'y'}],
+                },
+                {
+                    u'baz': u"it's",
+                    u'foobars': [],
+                    u'inner': [],
+                },
+            ],
+        })
+
+        vs = qvarn.VersionedStorage()
+        vs.set_resource_type(u'yo')
+        vs.start_version(u'first-version', None)
+        vs.add_prototype(self.prototype)
+
+        ro = qvarn.ReadOnlyStorage()
+        ro.set_item_prototype(u'yo', self.prototype)
+        wo = qvarn.WriteOnlyStorage()
+        wo.set_item_prototype(u'yo', self.prototype)
+
+        # Everything happens in one transaction that is rolled back,
+        # so the scratch database is left as it was.
+        with self.assertRaises(RollBack):
+            with self._dbconn.transaction() as t:
+                vs.prepare_storage(t)
+                added = wo.add_item(t, item)
+                walked = {}
+                rw = qvarn.read_only.ReadWalker(t, u'yo', added[u'id'])
+                rw.walk_item(walked, self.prototype)
+                self.assertEqual(ro.get_item(t, added[u'id']), walked)
+                self.assertEqual(walked, added)
+                raise RollBack()
+
+
+class SelectCounter(object):
+
+    def __init__(self, transaction):
+        self._transaction = transaction
+        self.count = 0
+
+    def select(self, *args, **kwargs):
+        self.count += 1
+        return self._transaction.select(*args, **kwargs)
+
+
 class LimitTests(ReadOnlyStorageBase):
 
     def setUp(self):
@@ -337,3 +581,122 @@ class LimitTests(ReadOnlyStorageBase):
 
     def test_search_limit_and_offset(self):
         self.assertEqual(self._search(limit=2, offset=1), [u'b', u'c'])
+
+    def test_streams_search_in_batches(self):
+        with self._dbconn.transaction() as t:
+            expected = self.ro.search(
+                t, [], [u'show_all'], [u'foo'], limit=4)
+            text = ''.join(self.ro.search_stream(
+                t, [], [u'show_all'], [u'foo'], limit=4, batch_size=3))
+        self.assertEqual(json.loads(text), expected)
+
+
+class JsonDocumentTests(ReadOnlyStorageBase):
+
+    def setUp(self):
+        super(JsonDocumentTests, self).setUp()
+        with self._dbconn.transaction() as t:
+            t.add_column(
+                self.resource_type, qvarn.json_document_column, unicode)
+            self.plain = self.wo.add_item(t, _build_item(foo=u'plain'))
+            self.wo.set_json_document(True)
+            self.with_doc = self.wo.add_item(t, _build_item(foo=u'doc'))
+        self.ro.set_json_document(True)
+
+    def test_gets_item_from_document_with_one_select(self):
+        with self._dbconn.transaction() as t:
+            counter = SelectCounter(t)
+            item = self.ro.get_item(counter, self.with_doc[u'id'])
+        self.assertEqual(item, self.with_doc)
+        self.assertEqual(counter.count, 1)
+
+    def test_gets_item_without_document_from_tables(self):
+        with self._dbconn.transaction() as t:
+            item = self.ro.get_item(t, self.plain[u'id'])
+        self.assertEqual(item, self.plain)
+
+    def test_gets_current_revision_after_subitem_update(self):
+        with self._dbconn.transaction() as t:
+            revision = self.wo.update_subitem(
+                t, self.with_doc[u'id'], self.with_doc[u'revision'],
+                self.subitem_name, {u'secret_identity': u'x'})
+            item = self.ro.get_item(t, self.with_doc[u'id'])
+        self.assertEqual(item[u'revision'], revision)
+
+    def test_gets_items_with_and_without_documents(self):
+        ids = [self.with_doc[u'id'], self.plain[u'id']]
+        with self._dbconn.transaction() as t:
+            items = self.ro.get_items(t, ids)
+        self.assertEqual(items, [self.with_doc, self.plain])
+
+    def test_raises_error_for_missing_item(self):
+        with self._dbconn.transaction() as t:
+            with self.assertRaises(qvarn.ItemDoesNotExist):
+                self.ro.get_item(t, u'does-not-exist')
+
+
+class SearchPlanTests(ReadOnlyStorageBase):
+
+    def setUp(self):
+        super(SearchPlanTests, self).setUp()
+        self.cache = qvarn.SearchPlanCache()
+        self.ro.set_search_plan_cache(self.cache)
+        with self._dbconn.transaction() as t:
+            for foo in [u'a', u'b', u'c', u'd']:
+                self.wo.add_item(t, _build_item(foo=foo))
+
+    def _search(self, params, **kwargs):
+        with self._dbconn.transaction() as t:
+            result = self.ro.search(
+                t, params, [(u'show', u'foo')], [u'foo'], **kwargs)
+        return [item[u'foo'] for item in result[u'resources']]
+
+    def test_reuses_plan_for_same_shape_with_other_values(self):
+        gt = qvarn.create_search_param
+        self.assertEqual(self._search([gt(u'gt', u'foo', u'a')]),
+                         [u'b', u'c', u'd'])
+        self.assertEqual(self._search([gt(u'gt', u'foo', u'c')]), [u'd'])
+        self.assertEqual(
+            self.cache.get_stats(), {'hits': 1, 'misses': 1, 'size': 1})
+
+    def test_reuses_plan_with_other_limit_and_offset(self):
+        self.assertEqual(self._search([], limit=1, offset=1), [u'b'])
+        self.assertEqual(self._search([], limit=2, offset=2), [u'c', u'd'])
+        self.assertEqual(self.cache.get_stats()['hits'], 1)
+
+    def test_does_not_reuse_plan_for_other_shape(self):
+        param = qvarn.create_search_param(u'exact', u'foo', [u'a', u'b'], True)
+        self.assertEqual(self._search([param]), [u'a', u'b'])
+        param = qvarn.create_search_param(u'exact', u'foo', [u'c'], True)
+        self.assertEqual(self._search([param]), [u'c'])
+        self.assertEqual(self._search([], limit=1), [u'a'])
+        self.assertEqual(
+            self.cache.get_stats(), {'hits': 0, 'misses': 3, 'size': 3})
+
+    def test_rejects_unknown_field_before_compiling(self):
+        param = qvarn.create_search_param(u'exact', u'nope', u'a')
+        with self.assertRaises(qvarn.FieldNotInResource):
+            self._search([param])
+        self.assertEqual(self.cache.get_stats()['misses'], 0)
+
+    def test_uses_given_field_index(self):
+        self.ro.set_field_index(self.ro.build_field_index())
+        param = qvarn.create_search_param(u'exact', u'foo', u'b')
+        self.assertEqual(self._search([param]), [u'b'])
+
+
+class SearchShapeTests(unittest.TestCase):
+
+    def test_ignores_values(self):
+        a = qvarn.create_search_param(u'exact', u'foo', u'a')
+        b = qvarn.create_search_param(u'exact', u'foo', u'b')
+        self.assertEqual(
+            qvarn.read_only.search_shape([a], [u'foo'], 1, None, u'token1'),
+            qvarn.read_only.search_shape([b], [u'foo'], 2, None, u'token2'))
+
+    def test_depends_on_number_of_any_values(self):
+        a = qvarn.create_search_param(u'exact', u'foo', [u'a'], True)
+        b = qvarn.create_search_param(u'exact', u'foo', [u'a', u'b'], True)
+        self.assertNotEqual(
+            qvarn.read_only.search_shape([a], None, None, None, None),
+            qvarn.read_only.search_shape([b], None, None, None, None))
@@ -26,6 +26,9 @@ class ResourceServer(object):
         self._path = None
         self._type = None
         self._latest_version = None
+        self._item_cache_config = None
+        self._json_document = False
+        self._notification_retention_days = None
         self._app = None
         self._vs = qvarn.VersionedStorage()
 
@@ -39,6 +42,27 @@ class ResourceServer(object):
     def set_resource_type(self, resource_type):
         self._type = resource_type
         self._vs.set_resource_type(resource_type)
+        self._vs.add_prepare_callback(
+            qvarn.ListenerRegistry(resource_type).prepare)
+
+    def set_item_cache_config(self, config):
+        '''Set item cache configuration from a resource type spec.
+
+        ``config`` is a dict with optional ``max_items`` and ``ttl``
+        keys, or None to not cache items.
+
+        '''
+
+        self._item_cache_config = config
+
+    def set_json_document(self, enabled):
+        '''Set whether items are also stored as JSON documents.'''
+        self._json_document = enabled
+        self._vs.set_json_document(enabled)
+
+    def set_notification_retention_days(self, days):
+        '''Set how many days notifications are kept, or None for ever.'''
+        self._notification_retention_days = days
 
     def add_resource_type_versions(self, versions):
         for version in versions:
@@ -56,6 +80,16 @@ class ResourceServer(object):
         self._vs.add_prototype(
             qvarn.notification_prototype, auxtable=u'notification')
 
+        self._add_search_indexes(version)
+
+    def _add_search_indexes(self, version):
+        for index in version.get(u'indexes', []):
+            self._vs.add_search_index(index[u'field'], index.get(u'rules'))
+
+        # Notifications are always listed by listener, sorted by time.
+        for field in [u'listener_id', u'last_modified']:
+            self._vs.add_search_index(field, auxtable=u'notification')
+
     def _add_subresources(self, version):
         subpaths = version.get(u'subpaths', [])
         for subpath in subpaths:
@@ -72,6 +106,8 @@ class ResourceServer(object):
     def _create_listener(self):
         listener = qvarn.ListenerResource()
         listener.set_top_resource_path(self._type, self._path)
+        listener.set_notification_retention_days(
+            self._notification_retention_days)
         return listener
 
     def _create_list_resource(self, listener):
@@ -80,6 +116,8 @@ class ResourceServer(object):
         resource.set_item_type(self._type)
         resource.set_item_prototype(self._latest_version[u'prototype'])
         resource.set_listener(listener)
+        resource.set_item_cache(self._create_item_cache())
+        resource.set_json_document(self._json_document)
 
         resource.set_item_validator(self._latest_version.get(u'validator'))
 
@@ -92,6 +130,14 @@ class ResourceServer(object):
 
         return resource
 
+    def _create_item_cache(self):
+        config = self._item_cache_config
+        if config is None:
+            return None
+        return qvarn.ItemCache(
+            max_items=config.get(u'max_items', 1000),
+            ttl=config.get(u'ttl', 60))
+
     def _create_file_resources(self, listener):
         resources = []
         for subpath in self._latest_version.get(u'files', []):
@@ -118,5 +164,10 @@ def add_resource_type_to_server(app, resource_type_spec):
     server.set_backend_app(app)
     server.set_resource_path(resource_type_spec[u'path'])
     server.set_resource_type(resource_type_spec[u'type'])
+    server.set_item_cache_config(resource_type_spec.get(u'item_cache'))
+    server.set_json_document(
+        bool(resource_type_spec.get(u'json_document', False)))
+    server.set_notification_retention_days(
+        resource_type_spec.get(u'notification_retention_days'))
     server.add_resource_type_versions(resource_type_spec[u'versions'])
     return server.create_resource()
@@ -0,0 +1,65 @@
+# search_plan_cache.py - cache compiled search queries
+#
+# Copyright 2017 QvarnLabs Ltd
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import collections
+import thread
+
+
+class SearchPlanCache(object):
+
+    '''A threadsafe cache of compiled search plans.
+
+    Plans are keyed by the shape of the search, which is anything
+    hashable. At most ``max_size`` plans are kept; when the cache is
+    full, the least recently used plan is dropped.
+
+    '''
+
+    def __init__(self, max_size=100):
+        self._lock = thread.allocate_lock()
+        self._max_size = max_size
+        self._plans = collections.OrderedDict()
+        self._hits = 0
+        self._misses = 0
+
+    def get(self, shape):
+        '''Return plan for shape, or None if it is not in the cache.'''
+        with self._lock:
+            plan = self._plans.pop(shape, None)
+            if plan is None:
+                self._misses += 1
+            else:
+                self._hits += 1
+                self._plans[shape] = plan
+            return plan
+
+    def put(self, shape, plan):
+        with self._lock:
+            self._plans.pop(shape, None)
+            self._plans[shape] = plan
+            while len(self._plans) > self._max_size:
+                self._plans.popitem(last=False)
+
+    def get_stats(self):
+        '''Return dict with numbers of hits and misses and cache size.'''
+        with self._lock:
+            return {
+                'hits': self._hits,
+                'misses': self._misses,
+                'size': len(self._plans),
+            }
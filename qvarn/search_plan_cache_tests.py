@@ -0,0 +1,53 @@
+# search_plan_cache_tests.py - unit tests for SearchPlanCache
+#
+# Copyright 2017 QvarnLabs Ltd
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import unittest
+
+import qvarn
+
+
+class SearchPlanCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = qvarn.SearchPlanCache(max_size=2)
+
+    def test_returns_none_for_unknown_shape(self):
+        self.assertEqual(self.cache.get(('foo',)), None)
+
+    def test_returns_plan_that_was_put(self):
+        self.cache.put(('foo',), 'plan')
+        self.assertEqual(self.cache.get(('foo',)), 'plan')
+
+    def test_counts_hits_and_misses(self):
+        self.cache.put(('foo',), 'plan')
+        self.cache.get(('foo',))
+        self.cache.get(('foo',))
+        self.cache.get(('bar',))
+        self.assertEqual(
+            self.cache.get_stats(),
+            {'hits': 2, 'misses': 1, 'size': 1})
+
+    def test_drops_least_recently_used_plan_when_full(self):
+        self.cache.put(('foo',), 'foo plan')
+        self.cache.put(('bar',), 'bar plan')
+        self.cache.get(('foo',))
+        self.cache.put(('yo',), 'yo plan')
+        self.assertEqual(self.cache.get(('bar',)), None)
+        self.assertEqual(self.cache.get(('foo',)), 'foo plan')
+        self.assertEqual(self.cache.get(('yo',)), 'yo plan')
+        self.assertEqual(self.cache.get_stats()['size'], 2)
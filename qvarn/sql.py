@@ -26,8 +26,10 @@ Qvarn are supported.
 '''
 
 
+import select
 import sqlite3
 import string
+import uuid
 
 import psycopg2
 import psycopg2.pool
@@ -59,16 +61,42 @@ class SqlAdapter(object):
     the following shapes:
 
         ('=', table_name, column_name, value)
+        ('<=', table_name, column_name, value)
+        ('>', table_name, column_name, value)
+        ('IN', table_name, column_name, values)
+        ('IS NULL', table_name, column_name)
+        ('IS NOT NULL', table_name, column_name)
         ('AND', cond...)
         ('OR', cond...)
 
     where "cond..." zero or more conditions of the same structure as
     the tree. A '=' node specifies a condition of where table row
-    matches if its column has an exact value. The 'AND' and 'OR' nodes
-    combine other conditions to a more complicated one.
+    matches if its column has an exact value, a '<=' node if its
+    column has at most the value, and a '>' node if its column has
+    more than the value. An 'IN' node is similar,
+    but the row matches if its column has any of the values in a
+    non-empty list. An 'IS NULL' node matches rows where the column has
+    no value, and an 'IS NOT NULL' node rows where it has one. The
+    'AND' and 'OR' nodes combine other conditions to a more
+    complicated one.
 
     A select_condition may be None to indicate that all rows match.
 
+    A "json_shape" argument describes how to assemble a nested JSON
+    document from a table and the tables of its list fields. The
+    shape is a tree, where the nodes have the following shapes:
+
+        ('dict', table_name, column_names, children)
+        ('str_list', table_name, column_name)
+        ('dict_list', table_name, column_names, children)
+
+    where "children" is a list of (field_name, json_shape) pairs. The
+    root is a 'dict' node. The rows of a child table belong to the
+    parent row with the same "id", and, if the parent is a dict list,
+    whose "dict_list_pos" column equals the parent's "list_pos". List
+    elements are ordered by "list_pos". Adapters that can build such
+    documents in the database set "supports_json_select" to True.
+
     In addition, the get_conn/put_conn method pair returns a
     "connection" object for communicating with the database. It
     follows the usual Python database binding style. Specifically:
@@ -91,6 +119,25 @@ class SqlAdapter(object):
     # override it.
     type_name = {}
 
+    # Subclasses that implement format_select_json set this to True.
+    supports_json_select = False
+
+    # Subclasses that can build indexes without locking out writes set
+    # this to True. Such indexes can't be created in a transaction.
+    supports_concurrent_index = False
+
+    # Database extensions needed by search indexes for some rules.
+    search_index_extensions = {}
+
+    # The most placeholders a single statement may have. Subclasses
+    # override this if their database allows more.
+    max_placeholders = 999
+
+    # Subclasses whose database can send messages from one connection
+    # to others, once a transaction commits, set this to True, and
+    # implement format_notify, get_listen_conn and wait_for_notifies.
+    supports_notify = False
+
     def quote(self, name):
         '''Quote a name for SQL.
 
@@ -100,9 +147,12 @@ class SqlAdapter(object):
 
         '''
 
+        self._check_name(name)
+        return u'_'.join(name.split('-'))
+
+    def _check_name(self, name):
         ok = string.ascii_letters + string.digits + '-_'
         assert name.strip(ok) == '', 'must have only allowed chars: %r' % name
-        return u'_'.join(name.split('-'))
 
     def qualified_column(self, table_name, column_name):
         return u'{}.{}'.format(self.quote(table_name), self.quote(column_name))
@@ -120,6 +170,92 @@ class SqlAdapter(object):
         )
         return sql
 
+    def format_create_index(self, index_name, table_name, column_names,
+                            concurrently=False):
+        return u'CREATE INDEX {}IF NOT EXISTS {} ON {} ({})'.format(
+            u'CONCURRENTLY ' if concurrently else u'',
+            self.quote(index_name),
+            self.quote(table_name),
+            u', '.join(self.quote(x) for x in column_names))
+
+    def format_create_search_index(self, index_name, table_name,
+                                   column_name, column_type, rule,
+                                   concurrently=False):
+        '''Format CREATE INDEX for searches on a column with a rule.
+
+        ``rule`` is a search rule (``exact``, ``startswith``,
+        ``contains``), or ``sort`` for sorting. Return None if the
+        database can't use an index for the rule.
+
+        '''
+
+        index = self._format_search_index_expression(
+            column_name, column_type, rule)
+        if index is None:
+            return None
+        method, expression = index
+        return u'CREATE INDEX {}IF NOT EXISTS {} ON {}{} ({})'.format(
+            u'CONCURRENTLY ' if concurrently else u'',
+            self.quote(index_name),
+            self.quote(table_name),
+            u' USING {}'.format(method) if method else u'',
+            expression)
+
+    def _format_search_index_expression(self, column_name, column_type,
+                                        rule):
+        # Return (index method, expression), or None. Searches compare
+        # LOWER(column) for unicode columns, but sort on the column.
+        column = self.quote(column_name)
+        if rule == u'sort':
+            return None, column
+        if rule == u'exact':
+            if column_type == unicode:
+                return None, u'LOWER({})'.format(column)
+            return None, column
+        return None
+
+    def format_has_extension(self, extension_name):
+        '''Format query for whether a database extension is installed.
+
+        Return the query and values for it. The query is None if the
+        database has no extensions.
+
+        '''
+
+        return None, {}
+
+    def set_autocommit(self, conn, autocommit):
+        '''Set whether each statement on conn is committed at once.'''
+
+    def format_notify(self, channel, payload):
+        '''Format statement to send payload to listeners of a channel.
+
+        Return the query and values for it. The payload is sent when the
+        transaction commits.
+
+        '''
+
+        raise NotImplementedError()
+
+    def get_listen_conn(self, channel):
+        '''Return a new connection that listens on a channel.
+
+        The connection is not from the pool. The caller closes it.
+
+        '''
+
+        raise NotImplementedError()
+
+    def wait_for_notifies(self, conn, timeout):
+        '''Return payloads sent to a listening connection.
+
+        Wait at most ``timeout`` seconds for the first one. The list is
+        empty if none came.
+
+        '''
+
+        raise NotImplementedError()
+
     def format_add_column(self, table_name, column_name, column_type):
         sql = u'ALTER TABLE {} ADD COLUMN {} {}'.format(
             self.quote(table_name),
@@ -127,6 +263,16 @@ class SqlAdapter(object):
             self.type_name[column_type])
         return sql
 
+    def format_select_column_names(self, table_name):
+        '''Format query for the names of the columns in a table.
+
+        Return the query and values for it. Each row of the result
+        has the name of one column.
+
+        '''
+
+        raise NotImplementedError()
+
     def format_rename_table(self, old_name, new_name):
         return u'ALTER TABLE {} RENAME TO {}'.format(
             self.quote(old_name), self.quote(new_name))
@@ -134,12 +280,15 @@ class SqlAdapter(object):
     def format_drop_table(self, table_name):
         return u'DROP TABLE IF EXISTS %s ' % self.quote(table_name)
 
-    def format_select(self, table_name, column_names, select_condition):
+    def format_select(self, table_name, column_names, select_condition,
+                      limit=None, order_by=None):
         '''Format an SQL SELECT statement.
 
         Return the statement, and a list of values to use for the
         placeholders, suitable to give to a database connection
-        execution.
+        execution. If ``limit`` is given, at most that many rows are
+        selected. If ``order_by`` is given, it is a list of columns of
+        the table to sort the rows by.
 
         '''
 
@@ -153,6 +302,11 @@ class SqlAdapter(object):
             u', '.join(self.quote(x) for x in table_names))
         if select_condition:
             sql += u' WHERE ' + self._format_condition(select_condition)
+        if order_by:
+            sql += u' ORDER BY ' + u', '.join(
+                self.qualified_column(table_name, x) for x in order_by)
+        if limit is not None:
+            sql += u' ' + self.format_limit(limit=limit)
 
         values = self._construct_values({}, select_condition)
 
@@ -161,9 +315,10 @@ class SqlAdapter(object):
     def _get_table_names(self, condition):
         if condition is None:
             return []
-        assert condition[0] in ('=', 'AND', 'OR')
+        assert condition[0] in (
+            '=', '<=', '>', 'IN', 'IS NULL', 'IS NOT NULL', 'AND', 'OR')
 
-        if condition[0] == '=':
+        if condition[0] in ('=', '<=', '>', 'IN', 'IS NULL', 'IS NOT NULL'):
             return [condition[1]]
         else:
             result = []
@@ -176,21 +331,43 @@ class SqlAdapter(object):
             return values
 
         op = condition[0]
-        assert op in ('=', 'AND', 'OR')
+        assert op in (
+            '=', '<=', '>', 'IN', 'IS NULL', 'IS NOT NULL', 'AND', 'OR')
 
-        if op == '=':
+        if op in ('=', '<=', '>'):
             _, table_name, column_name, value = condition
             x = self.format_qualified_placeholder_name(table_name, column_name)
             values[x] = value
+        elif op == 'IN':
+            _, table_name, column_name, value_list = condition
+            self._construct_in_values(
+                values, table_name, column_name, value_list)
+        elif op in ('IS NULL', 'IS NOT NULL'):
+            pass
         else:
             for cond in condition[1:]:
                 self._construct_values(values, cond)
 
         return values
 
+    def _construct_in_values(self, values, table_name, column_name,
+                             value_list):
+        for i, value in enumerate(value_list):
+            x = self.format_qualified_placeholder_name(
+                table_name, self._in_placeholder_name(column_name, i))
+            values[x] = value
+
+    def _in_placeholder_name(self, column_name, i):
+        return u'{}_{}'.format(column_name, i)
+
     def _format_condition(self, condition):
         funcs = {
             '=': self._format_equal,
+            '<=': self._format_at_most,
+            '>': self._format_greater,
+            'IN': self._format_in,
+            'IS NULL': self._format_is_null,
+            'IS NOT NULL': self._format_is_not_null,
             'AND': self._format_and,
             'OR': self._format_or,
         }
@@ -203,6 +380,38 @@ class SqlAdapter(object):
             self.quote(column_name),
             self.format_qualified_placeholder(table_name, column_name))
 
+    def _format_at_most(self, table_name, column_name, value):
+        return u'{}.{} <= {}'.format(
+            self.quote(table_name),
+            self.quote(column_name),
+            self.format_qualified_placeholder(table_name, column_name))
+
+    def _format_greater(self, table_name, column_name, value):
+        return u'{}.{} > {}'.format(
+            self.quote(table_name),
+            self.quote(column_name),
+            self.format_qualified_placeholder(table_name, column_name))
+
+    def _format_in(self, table_name, column_name, value_list):
+        assert value_list, 'IN condition must have at least one value'
+        placeholders = [
+            self.format_qualified_placeholder(
+                table_name, self._in_placeholder_name(column_name, i))
+            for i in range(len(value_list))
+        ]
+        return u'{}.{} IN ({})'.format(
+            self.quote(table_name),
+            self.quote(column_name),
+            u', '.join(placeholders))
+
+    def _format_is_null(self, table_name, column_name):
+        return u'{}.{} IS NULL'.format(
+            self.quote(table_name), self.quote(column_name))
+
+    def _format_is_not_null(self, table_name, column_name):
+        return u'{}.{} IS NOT NULL'.format(
+            self.quote(table_name), self.quote(column_name))
+
     def _format_and(self, *conds):
         return self._format_andor(u'AND', *conds)
 
@@ -214,9 +423,29 @@ class SqlAdapter(object):
         return op.join(
             u'({})'.format(self._format_condition(c)) for c in conds)
 
+    def format_select_json(self, json_shape, select_condition):
+        '''Format an SQL SELECT statement returning JSON documents.
+
+        Each row of the result has a single column: the document
+        described by ``json_shape`` for a row in its root table.
+        Return the statement, and the values for the placeholders.
+
+        '''
+
+        raise NotImplementedError()
+
     def format_limit(self, limit=None, offset=None):
         raise NotImplementedError()
 
+    def format_limit_placeholders(self, limit_placeholder=None,
+                                  offset_placeholder=None):
+        '''Format LIMIT and OFFSET with values bound to placeholders.'''
+        raise NotImplementedError()
+
+    def format_sort_key(self, expression):
+        '''Format an ORDER BY term that sorts NULLs after all values.'''
+        raise NotImplementedError()
+
     def format_insert(self, table_name, column_name_values):
         quoted_column_names = [self.quote(x) for x in column_name_values]
         placeholders = [
@@ -226,6 +455,32 @@ class SqlAdapter(object):
             u', '.join(quoted_column_names),
             u', '.join(placeholders))
 
+    def format_insert_many(self, table_name, rows):
+        '''Format an SQL INSERT statement for many rows at once.
+
+        ``rows`` is a non-empty list of dicts with the same keys, like
+        "column_name_values". Return the statement, and the values for
+        the placeholders.
+
+        '''
+
+        assert rows, 'must insert at least one row'
+        column_names = sorted(rows[0].keys())
+        values = {}
+        tuples = []
+        for i, row in enumerate(rows):
+            placeholders = []
+            for column_name in column_names:
+                name = self._in_placeholder_name(column_name, i)
+                placeholders.append(self.format_placeholder(name))
+                values[self.quote(name)] = row[column_name]
+            tuples.append(u'({})'.format(u', '.join(placeholders)))
+        sql = u'INSERT INTO {} ({}) VALUES {}'.format(
+            self.quote(table_name),
+            u', '.join(self.quote(x) for x in column_names),
+            u', '.join(tuples))
+        return sql, values
+
     def format_update(self, table_name, select_condition, column_name_values):
         assignments = [
             u'{} = {}'.format(self.quote(x), self.format_placeholder(x))
@@ -273,6 +528,17 @@ class SqlAdapter(object):
     def put_conn(self, conn):
         raise NotImplementedError()
 
+    def get_server_side_cursor(self, conn):
+        '''Return a cursor that keeps the result in the database.
+
+        Rows are fetched from such a cursor with fetchmany as they're
+        needed, instead of all of them being sent to the client when
+        the query is executed. By default, this is a normal cursor.
+
+        '''
+
+        return conn.cursor()
+
 
 class SqliteAdapter(SqlAdapter):
 
@@ -298,6 +564,22 @@ class SqliteAdapter(SqlAdapter):
             query.append(u'OFFSET %d' % offset)
         return u' '.join(query)
 
+    def format_limit_placeholders(self, limit_placeholder=None,
+                                  offset_placeholder=None):
+        query = []
+        if limit_placeholder is None and offset_placeholder is not None:
+            limit_placeholder = u'-1'
+        if limit_placeholder is not None:
+            query.append(u'LIMIT ' + limit_placeholder)
+        if offset_placeholder is not None:
+            query.append(u'OFFSET ' + offset_placeholder)
+        return u' '.join(query)
+
+    def format_sort_key(self, expression):
+        # SQLite sorts NULLs first, and older versions don't know
+        # NULLS LAST.
+        return u'{0} IS NULL, {0}'.format(expression)
+
     def format_placeholder(self, column_name):
         return ':{}'.format(self.quote(column_name))
 
@@ -309,6 +591,11 @@ class SqliteAdapter(SqlAdapter):
         q = self.qualified_column(table_name, column_name)
         return q.encode('hex')
 
+    def format_select_column_names(self, table_name):
+        query = u'SELECT name FROM pragma_table_info({})'.format(
+            self.format_placeholder(u'table_name'))
+        return query, {u'table_name': self.quote(table_name)}
+
     def get_conn(self):
         return self._conn
 
@@ -320,6 +607,8 @@ class PostgresAdapter(SqlAdapter):
 
     '''An SQL adapter for Postgres.'''
 
+    max_placeholders = 32767
+
     type_name = {
         bool: u'BOOLEAN',
         buffer: u'BYTEA',
@@ -327,8 +616,29 @@ class PostgresAdapter(SqlAdapter):
         unicode: u'TEXT',
     }
 
+    supports_json_select = True
+
+    # jsonb_build_object is a function, and Postgres functions take at
+    # most 100 arguments, so larger objects are built in pieces.
+    _max_json_pairs = 50
+
+    supports_concurrent_index = True
+
+    supports_notify = True
+
+    search_index_extensions = {
+        u'contains': u'pg_trgm',
+    }
+
     def __init__(self, **kwargs):
         self._check_init_args(kwargs)
+        self._conn_args = {
+            'database': kwargs['db_name'],
+            'user': kwargs['user'],
+            'password': kwargs['password'],
+            'host': kwargs['host'],
+            'port': kwargs['port'],
+        }
         self._pool = self._create_connection_pool(kwargs)
 
     def _check_init_args(self, kwargs):
@@ -356,11 +666,7 @@ class PostgresAdapter(SqlAdapter):
         pool = psycopg2.pool.ThreadedConnectionPool(
             minconn=kwargs['min_conn'],
             maxconn=kwargs['max_conn'],
-            database=kwargs['db_name'],
-            user=kwargs['user'],
-            password=kwargs['password'],
-            host=kwargs['host'],
-            port=kwargs['port'])
+            **self._conn_args)
 
         # These are needed (in Python 2) so that we always get
         # database input in Unicode. See
@@ -369,6 +675,94 @@ class PostgresAdapter(SqlAdapter):
         psycopg2.extensions.register_type(psycopg2.extensions.UNICODEARRAY)
         return pool
 
+    def _construct_in_values(self, values, table_name, column_name,
+                             value_list):
+        # Postgres gets the whole list as a single array value, so
+        # that the statement text does not depend on the number of
+        # values.
+        x = self.format_qualified_placeholder_name(table_name, column_name)
+        values[x] = list(value_list)
+
+    def _format_in(self, table_name, column_name, value_list):
+        assert value_list, 'IN condition must have at least one value'
+        return u'{}.{} = ANY({})'.format(
+            self.quote(table_name),
+            self.quote(column_name),
+            self.format_qualified_placeholder(table_name, column_name))
+
+    def format_select_json(self, json_shape, select_condition):
+        kind, table_name, column_names, children = json_shape
+        assert kind == 'dict'
+
+        aliases = iter(xrange(1, 2**31))
+        sql = u'SELECT {} FROM {}'.format(
+            self._format_json_object(
+                table_name, False, column_names, children, aliases),
+            self.quote(table_name))
+        if select_condition:
+            sql += u' WHERE ' + self._format_condition(select_condition)
+
+        values = self._construct_values({}, select_condition)
+
+        return sql, values
+
+    def _format_json_object(self, alias, in_list, column_names, children,
+                            aliases):
+        pairs = [
+            (name, self.qualified_column(alias, name))
+            for name in column_names
+        ]
+        for field, child in children:
+            pairs.append(
+                (field,
+                 self._format_json_list(alias, in_list, child, aliases)))
+
+        n = self._max_json_pairs
+        pieces = [pairs[i:i + n] for i in range(0, len(pairs), n)] or [[]]
+        return u' || '.join(
+            u'jsonb_build_object({})'.format(
+                u', '.join(
+                    u'{}, {}'.format(self._format_json_key(name), expr)
+                    for name, expr in piece))
+            for piece in pieces)
+
+    def _format_json_key(self, name):
+        # The key is the field name as is, so it can't go through
+        # quote, which turns dashes into underscores.
+        self._check_name(name)
+        return u"'{}'".format(name)
+
+    def _format_json_list(self, parent_alias, parent_in_list, json_shape,
+                          aliases):
+        kind, table_name = json_shape[:2]
+        assert kind in ('str_list', 'dict_list')
+
+        alias = u'j{}'.format(next(aliases))
+        if kind == 'str_list':
+            element = self.qualified_column(alias, json_shape[2])
+        else:
+            element = self._format_json_object(
+                alias, True, json_shape[2], json_shape[3], aliases)
+
+        conds = [
+            u'{} = {}'.format(
+                self.qualified_column(alias, u'id'),
+                self.qualified_column(parent_alias, u'id')),
+        ]
+        if parent_in_list:
+            conds.append(u'{} = {}'.format(
+                self.qualified_column(alias, u'dict_list_pos'),
+                self.qualified_column(parent_alias, u'list_pos')))
+
+        return (
+            u"COALESCE((SELECT jsonb_agg({} ORDER BY {}) FROM {} AS {} "
+            u"WHERE {}), '[]'::jsonb)".format(
+                element,
+                self.qualified_column(alias, u'list_pos'),
+                self.quote(table_name),
+                alias,
+                u' AND '.join(conds)))
+
     def format_limit(self, limit=None, offset=None):
         query = []
         if limit is None and offset is not None:
@@ -379,6 +773,22 @@ class PostgresAdapter(SqlAdapter):
             query.append(u'OFFSET %d' % offset)
         return u' '.join(query)
 
+    def format_limit_placeholders(self, limit_placeholder=None,
+                                  offset_placeholder=None):
+        query = []
+        if limit_placeholder is None and offset_placeholder is not None:
+            limit_placeholder = u'ALL'
+        if limit_placeholder is not None:
+            query.append(u'LIMIT ' + limit_placeholder)
+        if offset_placeholder is not None:
+            query.append(u'OFFSET ' + offset_placeholder)
+        return u' '.join(query)
+
+    def format_sort_key(self, expression):
+        # This is the default, but it's spelled out, since SQLite
+        # needs to be told the same.
+        return u'{} NULLS LAST'.format(expression)
+
     def format_placeholder(self, column_name):
         return u'%({})s'.format(self.quote(column_name))
 
@@ -394,3 +804,54 @@ class PostgresAdapter(SqlAdapter):
 
     def put_conn(self, conn):
         self._pool.putconn(conn)
+
+    def _format_search_index_expression(self, column_name, column_type,
+                                        rule):
+        lower = u'LOWER({})'.format(self.quote(column_name))
+        if rule == u'startswith' and column_type == unicode:
+            # Allows LIKE 'prefix%' to use the index in any locale.
+            return None, lower + u' text_pattern_ops'
+        if rule == u'contains' and column_type == unicode:
+            # Trigram indexes allow LIKE '%infix%' to use the index.
+            return u'gin', lower + u' gin_trgm_ops'
+        return super(PostgresAdapter, self)._format_search_index_expression(
+            column_name, column_type, rule)
+
+    def format_select_column_names(self, table_name):
+        query = (
+            u'SELECT column_name FROM information_schema.columns '
+            u'WHERE table_schema = current_schema() '
+            u'AND table_name = {}'.format(
+                self.format_placeholder(u'table_name')))
+        return query, {u'table_name': self.quote(table_name)}
+
+    def format_has_extension(self, extension_name):
+        query = u'SELECT 1 FROM pg_extension WHERE extname = {}'.format(
+            self.format_placeholder(u'extname'))
+        return query, {u'extname': extension_name}
+
+    def set_autocommit(self, conn, autocommit):
+        conn.autocommit = autocommit
+
+    def get_server_side_cursor(self, conn):
+        # A named cursor in psycopg2 is a server-side cursor.
+        return conn.cursor(name='qvarn_{}'.format(uuid.uuid4().hex))
+
+    def format_notify(self, channel, payload):
+        query = u'SELECT pg_notify({}, {})'.format(
+            self.format_placeholder(u'channel'),
+            self.format_placeholder(u'payload'))
+        return query, {u'channel': channel, u'payload': payload}
+
+    def get_listen_conn(self, channel):  # pragma: no cover
+        conn = psycopg2.connect(**self._conn_args)
+        conn.autocommit = True
+        conn.cursor().execute(u'LISTEN {}'.format(self.quote(channel)))
+        return conn
+
+    def wait_for_notifies(self, conn, timeout):  # pragma: no cover
+        if select.select([conn], [], [], timeout) != ([], [], []):
+            conn.poll()
+        payloads = [notify.payload for notify in conn.notifies]
+        del conn.notifies[:]
+        return payloads
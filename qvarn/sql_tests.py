@@ -0,0 +1,113 @@
+# sql_tests.py - unit tests
+#
+# Copyright 2017 QvarnLabs Ltd
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import unittest
+
+import qvarn
+
+
+class PostgresSelectJsonTests(unittest.TestCase):
+
+    prototype = {
+        u'type': u'',
+        u'id': u'',
+        u'foo': u'',
+        u'strs': [u''],
+        u'dicts': [
+            {
+                u'bar': u'',
+                u'inner': [
+                    {
+                        u'baz': u'',
+                    },
+                ],
+                u'tags': [u''],
+            },
+        ],
+    }
+
+    def setUp(self):
+        self.sql = PoollessPostgresAdapter(
+            host=u'localhost', port=5432, db_name=u'qvarn', user=u'qvarn',
+            password=u'secret', min_conn=1, max_conn=1)
+
+    def get_shape(self, prototype):
+        jw = qvarn.read_only.JsonShapeWalker(u'yo')
+        jw.walk_item(prototype, prototype)
+        return jw.shape
+
+    def test_selects_nested_lists_and_dicts(self):
+        query, values = self.sql.format_select_json(
+            self.get_shape(self.prototype), ('=', u'yo', u'id', u'123'))
+        self.assertEqual(query, u''.join([
+            u"SELECT jsonb_build_object(",
+            u"'foo', yo.foo, 'id', yo.id, 'type', yo.type, ",
+            u"'strs', COALESCE((SELECT jsonb_agg(j1.strs ",
+            u"ORDER BY j1.list_pos) FROM yo_strs AS j1 ",
+            u"WHERE j1.id = yo.id), '[]'::jsonb), ",
+            u"'dicts', COALESCE((SELECT jsonb_agg(jsonb_build_object(",
+            u"'bar', j2.bar, ",
+            u"'inner', COALESCE((SELECT jsonb_agg(jsonb_build_object(",
+            u"'baz', j3.baz) ORDER BY j3.list_pos) ",
+            u"FROM yo_dicts_inner AS j3 ",
+            u"WHERE j3.id = j2.id AND j3.dict_list_pos = j2.list_pos), ",
+            u"'[]'::jsonb), ",
+            u"'tags', COALESCE((SELECT jsonb_agg(j4.tags ",
+            u"ORDER BY j4.list_pos) FROM yo_dicts_tags AS j4 ",
+            u"WHERE j4.id = j2.id AND j4.dict_list_pos = j2.list_pos), ",
+            u"'[]'::jsonb)) ORDER BY j2.list_pos) ",
+            u"FROM yo_dicts AS j2 WHERE j2.id = yo.id), '[]'::jsonb)) ",
+            u"FROM yo WHERE yo.id = %(yo.id)s",
+        ]))
+        self.assertEqual(values, {u'yo.id': u'123'})
+
+    def test_builds_large_objects_in_pieces(self):
+        names = [u'f%02d' % i for i in range(60)]
+        shape = ('dict', u'yo', names, [])
+        query, values = self.sql.format_select_json(shape, None)
+        self.assertEqual(query.count(u'jsonb_build_object('), 2)
+        self.assertEqual(query.count(u' || '), 1)
+        for name in names:
+            self.assertIn(u"'{0}', yo.{0}".format(name), query)
+        self.assertEqual(values, {})
+
+
+class PostgresCreateIndexTests(unittest.TestCase):
+
+    def setUp(self):
+        self.sql = PoollessPostgresAdapter(
+            host=u'localhost', port=5432, db_name=u'qvarn', user=u'qvarn',
+            password=u'secret', min_conn=1, max_conn=1)
+
+    def test_creates_index(self):
+        self.assertEqual(
+            self.sql.format_create_index(
+                u'yo__idx_id', u'yo', [u'id', u'list_pos']),
+            u'CREATE INDEX IF NOT EXISTS yo__idx_id ON yo (id, list_pos)')
+
+    def test_creates_index_concurrently(self):
+        self.assertEqual(
+            self.sql.format_create_index(
+                u'yo__idx_id', u'yo', [u'id'], concurrently=True),
+            u'CREATE INDEX CONCURRENTLY IF NOT EXISTS yo__idx_id ON yo (id)')
+
+
+class PoollessPostgresAdapter(qvarn.PostgresAdapter):
+
+    def _create_connection_pool(self, kwargs):
+        return None
@@ -44,10 +44,35 @@ class Transaction(object):
         self._sql = None
         self._conn = None
         self._measurement = None
+        self._autocommit = False
+        self._commit_callbacks = []
 
     def set_sql(self, sql):
         self._sql = sql
 
+    def get_sql(self):
+        '''Return the SqlAdapter for building queries for this transaction.'''
+        return self._sql
+
+    def set_autocommit(self, autocommit):
+        '''Commit each statement at once, instead of at the end.
+
+        This is needed for statements that can't be run inside a
+        transaction, such as creating indexes concurrently.
+
+        '''
+
+        self._autocommit = autocommit
+
+    def on_commit(self, callback):
+        '''Call ``callback`` without arguments after a successful commit.
+
+        The callback is not called if the transaction is rolled back.
+
+        '''
+
+        self._commit_callbacks.append(callback)
+
     def __enter__(self):
         assert self._sql is not None
         assert self._conn is None
@@ -55,6 +80,8 @@ class Transaction(object):
         self._measurement = qvarn.Measurement()
         self._conn = self._sql.get_conn()
         qvarn.log.log('get_conn', conn=repr(self._conn))
+        if self._autocommit:
+            self._sql.set_autocommit(self._conn, True)
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
@@ -66,15 +93,25 @@ class Transaction(object):
             else:  # pragma: no cover
                 self._conn.rollback()
         except BaseException:  # pragma: no cover
+            self._reset_autocommit()
             qvarn.log.log('put_conn', conn=repr(self._conn))
             self._sql.put_conn(self._conn)
             raise
+        self._reset_autocommit()
         qvarn.log.log('put_conn', conn=repr(self._conn))
         self._sql.put_conn(self._conn)
         self._measurement.finish()
         self._measurement.log(exc_tb)
         self._conn = None
         self._measurement = None
+        callbacks, self._commit_callbacks = self._commit_callbacks, []
+        if exc_type is None:
+            for callback in callbacks:
+                callback()
+
+    def _reset_autocommit(self):
+        if self._autocommit:
+            self._sql.set_autocommit(self._conn, False)
 
     def _execute(self, what, query, values):
         with self._measurement.new(what) as m:
@@ -88,11 +125,65 @@ class Transaction(object):
             table_name, column_name_type_pairs)
         self._execute('CREATE TABLE', query, {})
 
+    def create_index(self, index_name, table_name, column_names):
+        '''Create an index on columns of a table.
+
+        The index is created concurrently, if the database supports
+        it and the transaction is in autocommit mode.
+
+        '''
+
+        query = self._sql.format_create_index(
+            index_name, table_name, column_names,
+            concurrently=(
+                self._autocommit and self._sql.supports_concurrent_index))
+        self._execute('CREATE INDEX', query, {})
+
+    def create_search_index(self, index_name, table_name, column_name,
+                            column_type, rule):
+        '''Create an index for searches on a column with a rule.
+
+        The index is created concurrently, if the database supports
+        it and the transaction is in autocommit mode. Return False if
+        the database can't have an index for the rule.
+
+        '''
+
+        query = self._sql.format_create_search_index(
+            index_name, table_name, column_name, column_type, rule,
+            concurrently=(
+                self._autocommit and self._sql.supports_concurrent_index))
+        if query is None:
+            return False
+        extension = self._sql.search_index_extensions.get(rule)
+        if extension is not None and not self._has_extension(extension):
+            return False
+        self._execute('CREATE INDEX', query, {})
+        return True
+
+    def _has_extension(self, extension_name):
+        query, values = self._sql.format_has_extension(extension_name)
+        if query is None:  # pragma: no cover
+            return False
+        cursor = self._execute('SELECT EXTENSION', query, values)
+        return cursor.fetchone() is not None
+
     def add_column(self, table_name, column_name, column_type):
         query = self._sql.format_add_column(
             table_name, column_name, column_type)
         self._execute('ALTER TABLE', query, {})
 
+    def get_column_names(self, table_name):
+        '''Return names of the columns in a table.
+
+        The list is empty if the table doesn't exist.
+
+        '''
+
+        query, values = self._sql.format_select_column_names(table_name)
+        cursor = self._execute('SELECT COLUMNS', query, values)
+        return [row[0] for row in cursor]
+
     def rename_table(self, old_name, new_name):
         query = self._sql.format_rename_table(old_name, new_name)
         self._execute('RENAME TABLE', query, {})
@@ -101,15 +192,70 @@ class Transaction(object):
         query = self._sql.format_drop_table(table_name)
         self._execute('DROP TABLE', query, {})
 
-    def select(self, table_name, column_names, select_condition):
+    def select(self, table_name, column_names, select_condition,
+               limit=None, order_by=None):
         query, values = self._sql.format_select(
-            table_name, column_names, select_condition)
+            table_name, column_names, select_condition, limit=limit,
+            order_by=order_by)
         cursor = self._execute('SELECT', query, values)
         with self._measurement.new('fetch-rows') as m:
             rows = self._construct_row_dicts(column_names, cursor)
             m.note(row_count=len(rows))
         return rows
 
+    def execute_raw(self, query, values):
+        '''Execute a query built with the SqlAdapter and return all rows.
+
+        This is for queries that are too complicated for the other
+        methods, such as searches. The rows are tuples.
+
+        '''
+
+        cursor = self._execute('SELECT RAW', query, values)
+        with self._measurement.new('fetch-rows') as m:
+            rows = [tuple(row) for row in cursor]
+            m.note(row_count=len(rows))
+        return rows
+
+    def iter_raw(self, query, values, batch_size):
+        '''Execute a query like execute_raw, but fetch rows in batches.
+
+        This is a generator that yields lists of at most
+        ``batch_size`` rows. The rows are kept in the database until
+        they're needed, where the database allows that. The
+        transaction may be used for other queries between batches.
+
+        '''
+
+        with self._measurement.new('SELECT RAW') as m:
+            cursor = self._sql.get_server_side_cursor(self._conn)
+            cursor.execute(query, values)
+            m.note(query=query, values=values)
+        try:
+            row_count = 0
+            while True:
+                rows = [tuple(row) for row in cursor.fetchmany(batch_size)]
+                if not rows:
+                    break
+                row_count += len(rows)
+                yield rows
+            with self._measurement.new('fetch-rows') as m:
+                m.note(row_count=row_count)
+        finally:
+            cursor.close()
+
+    def supports_json_select(self):
+        return self._sql.supports_json_select
+
+    def select_json(self, json_shape, select_condition):
+        query, values = self._sql.format_select_json(
+            json_shape, select_condition)
+        cursor = self._execute('SELECT JSON', query, values)
+        with self._measurement.new('fetch-rows') as m:
+            documents = [row[0] for row in cursor]
+            m.note(row_count=len(documents))
+        return documents
+
     def _construct_row_dicts(self, column_names, cursor):
         result = []
         indexes = range(len(column_names))
@@ -124,10 +270,37 @@ class Transaction(object):
         query = self._sql.format_insert(table_name, column_name_values)
         self._execute('INSERT', query, column_name_values)
 
+    def insert_many(self, table_name, rows):
+        '''Insert many rows into a table with as few statements as possible.
+
+        ``rows`` is a list of dicts with the same keys.
+
+        '''
+
+        if not rows:
+            return
+        rows_per_query = max(1, self._sql.max_placeholders // len(rows[0]))
+        for i in range(0, len(rows), rows_per_query):
+            query, values = self._sql.format_insert_many(
+                table_name, rows[i:i + rows_per_query])
+            self._execute('INSERT', query, values)
+
     def update(self, table_name, select_conditions, column_name_values):
+        '''Update rows, and return the number of rows that matched.'''
         query, values = self._sql.format_update(
             table_name, select_conditions, column_name_values)
-        self._execute('UPDATE', query, values)
+        cursor = self._execute('UPDATE', query, values)
+        return cursor.rowcount
+
+    def notify(self, channel, payload):
+        '''Send payload to listeners of a channel, when committed.
+
+        This only works if the SqlAdapter has ``supports_notify``.
+
+        '''
+
+        query, values = self._sql.format_notify(channel, payload)
+        self._execute('NOTIFY', query, values)
 
     def delete(self, table_name, select_conditions):
         query, values = self._sql.format_delete(table_name, select_conditions)
@@ -70,6 +70,74 @@ class TransactionTests(unittest.TestCase):
                 ('OR', ('=', u'foo', u'bar', 0), ('=', u'foo2', u'bar2', 0)))
         self.assertEqual(self.sql.selected_tables, [u'foo'])
 
+    def test_selects_rows_with_null_column(self):
+        with self.trans:
+            self.trans.create_table(u'foo', {u'bar': int, u'baz': int})
+            self.trans.insert(u'foo', {u'bar': 1})
+            self.trans.insert(u'foo', {u'bar': 2, u'baz': 3})
+            rows = self.trans.select(
+                u'foo', [u'bar'], ('IS NULL', u'foo', u'baz'))
+        self.assertEqual(rows, [{u'bar': 1}])
+
+    def test_selects_rows_with_at_most_a_value(self):
+        with self.trans:
+            self.trans.create_table(u'foo', {u'bar': int})
+            for i in range(3):
+                self.trans.insert(u'foo', {u'bar': i})
+            rows = self.trans.select(
+                u'foo', [u'bar'], ('<=', u'foo', u'bar', 1))
+        self.assertEqual(
+            sorted(row[u'bar'] for row in rows), [0, 1])
+
+    def test_selects_rows_with_non_null_column(self):
+        with self.trans:
+            self.trans.create_table(u'foo', {u'bar': int, u'baz': int})
+            self.trans.insert(u'foo', {u'bar': 1})
+            self.trans.insert(u'foo', {u'bar': 2, u'baz': 3})
+            rows = self.trans.select(
+                u'foo', [u'bar'], ('IS NOT NULL', u'foo', u'baz'))
+        self.assertEqual(rows, [{u'bar': 2}])
+
+    def test_selects_rows_with_more_than_a_value(self):
+        with self.trans:
+            self.trans.create_table(u'foo', {u'bar': int})
+            for i in range(3):
+                self.trans.insert(u'foo', {u'bar': i})
+            rows = self.trans.select(
+                u'foo', [u'bar'], ('>', u'foo', u'bar', 1))
+        self.assertEqual(rows, [{u'bar': 2}])
+
+    def test_selects_rows_in_order(self):
+        with self.trans:
+            self.trans.create_table(u'foo', {u'bar': int, u'baz': int})
+            for bar, baz in [(2, 1), (1, 2), (1, 1)]:
+                self.trans.insert(u'foo', {u'bar': bar, u'baz': baz})
+            rows = self.trans.select(
+                u'foo', [u'bar', u'baz'], None, order_by=[u'bar', u'baz'])
+        self.assertEqual(
+            [(row[u'bar'], row[u'baz']) for row in rows],
+            [(1, 1), (1, 2), (2, 1)])
+
+    def test_selects_limited_number_of_rows(self):
+        with self.trans:
+            self.trans.create_table(u'foo', {u'bar': int})
+            for i in range(3):
+                self.trans.insert(u'foo', {u'bar': i})
+            rows = self.trans.select(u'foo', [u'bar'], None, limit=2)
+        self.assertEqual(len(rows), 2)
+
+    def test_gets_column_names(self):
+        with self.trans:
+            self.trans.create_table(u'foo', {u'bar': int})
+            self.trans.add_column(u'foo', u'bar2', int)
+            names = self.trans.get_column_names(u'foo')
+        self.assertEqual(sorted(names), [u'bar', u'bar2'])
+
+    def test_gets_no_column_names_for_missing_table(self):
+        with self.trans:
+            names = self.trans.get_column_names(u'foo')
+        self.assertEqual(names, [])
+
     def test_inserts(self):
         with self.trans:
             self.trans.create_table(u'foo', {u'bar': int})
@@ -78,6 +146,32 @@ class TransactionTests(unittest.TestCase):
         self.assertEqual(self.sql.inserted_tables, [u'foo'])
         self.assertEqual(rows, [{u'bar': 42}])
 
+    def test_inserts_many_rows_in_one_statement(self):
+        with self.trans:
+            self.trans.create_table(u'foo', {u'bar': int, u'baz': unicode})
+            self.trans.insert_many(
+                u'foo', [{u'bar': i, u'baz': unicode(i)} for i in range(3)])
+            rows = self.trans.select(u'foo', [u'bar', u'baz'], None)
+        self.assertEqual(self.sql.inserted_many_tables, [u'foo'])
+        self.assertEqual(
+            sorted(rows, key=lambda row: row[u'bar']),
+            [{u'bar': i, u'baz': unicode(i)} for i in range(3)])
+
+    def test_inserts_many_rows_in_chunks(self):
+        self.sql.max_placeholders = 4
+        with self.trans:
+            self.trans.create_table(u'foo', {u'bar': int, u'baz': int})
+            self.trans.insert_many(
+                u'foo', [{u'bar': i, u'baz': i} for i in range(5)])
+            rows = self.trans.select(u'foo', [u'bar'], None)
+        self.assertEqual(self.sql.inserted_many_tables, [u'foo'] * 3)
+        self.assertEqual(len(rows), 5)
+
+    def test_inserts_nothing_for_no_rows(self):
+        with self.trans:
+            self.trans.insert_many(u'foo', [])
+        self.assertEqual(self.sql.inserted_many_tables, [])
+
     def test_updates(self):
         with self.trans:
             self.trans.create_table(u'foo', {u'bar': int})
@@ -87,6 +181,18 @@ class TransactionTests(unittest.TestCase):
         self.assertEqual(self.sql.updated_tables, [u'foo'])
         self.assertEqual(rows, [{u'bar': 7}])
 
+    def test_update_returns_number_of_matched_rows(self):
+        with self.trans:
+            self.trans.create_table(u'foo', {u'bar': int})
+            self.trans.insert(u'foo', {u'bar': 1})
+            self.trans.insert(u'foo', {u'bar': 2})
+            matched = self.trans.update(
+                u'foo', ('=', u'foo', u'bar', 1), {u'bar': 3})
+            unmatched = self.trans.update(
+                u'foo', ('=', u'foo', u'bar', 1), {u'bar': 4})
+        self.assertEqual(matched, 1)
+        self.assertEqual(unmatched, 0)
+
     def test_deletes(self):
         with self.trans:
             self.trans.create_table(u'foo', {u'bar': int})
@@ -96,6 +202,40 @@ class TransactionTests(unittest.TestCase):
         self.assertEqual(self.sql.deleted_tables, [u'foo'])
         self.assertEqual(rows, [])
 
+    def test_calls_commit_callbacks_after_commit(self):
+        called = []
+        with self.trans:
+            self.trans.on_commit(lambda: called.append(1))
+            self.assertEqual(called, [])
+        self.assertEqual(called, [1])
+
+    def test_does_not_call_commit_callbacks_after_rollback(self):
+        called = []
+        with self.assertRaises(ZeroDivisionError):
+            with self.trans:
+                self.trans.on_commit(lambda: called.append(1))
+                1 / 0
+        with self.trans:
+            pass
+        self.assertEqual(called, [])
+
+    def test_executes_raw_query(self):
+        with self.trans:
+            self.trans.create_table(u'foo', {u'bar': int})
+            self.trans.insert(u'foo', {u'bar': 42})
+            rows = self.trans.execute_raw(
+                u'SELECT bar FROM foo WHERE bar = :bar', {u'bar': 42})
+        self.assertEqual(rows, [(42,)])
+
+    def test_iterates_raw_query_in_batches(self):
+        with self.trans:
+            self.trans.create_table(u'foo', {u'bar': int})
+            for i in range(5):
+                self.trans.insert(u'foo', {u'bar': i})
+            batches = list(self.trans.iter_raw(
+                u'SELECT bar FROM foo ORDER BY bar', {}, 2))
+        self.assertEqual(batches, [[(0,), (1,)], [(2,), (3,)], [(4,)]])
+
 
 class DummyAdapter(qvarn.SqliteAdapter):
 
@@ -107,6 +247,7 @@ class DummyAdapter(qvarn.SqliteAdapter):
         self.dropped_tables = []
         self.selected_tables = []
         self.inserted_tables = []
+        self.inserted_many_tables = []
         self.updated_tables = []
         self.deleted_tables = []
 
@@ -131,16 +272,22 @@ class DummyAdapter(qvarn.SqliteAdapter):
         self.dropped_tables.append(table_name)
         return self._call('format_drop_table', table_name)
 
-    def format_select(self, table_name, column_names, select_conditions):
+    def format_select(self, table_name, column_names, select_conditions,
+                      limit=None, order_by=None):
         self.selected_tables.append(table_name)
         return self._call(
-            'format_select', table_name, column_names, select_conditions)
+            'format_select', table_name, column_names, select_conditions,
+            limit=limit, order_by=order_by)
 
     def format_insert(self, table_name, column_name_values):
         self.inserted_tables.append(table_name)
         return self._call(
             'format_insert', table_name, column_name_values)
 
+    def format_insert_many(self, table_name, rows):
+        self.inserted_many_tables.append(table_name)
+        return self._call('format_insert_many', table_name, rows)
+
     def format_update(self, table_name, select_conditions, column_name_values):
         self.updated_tables.append(table_name)
         return self._call(
@@ -19,6 +19,7 @@
 '''Random utility functions for the backend.'''
 
 
+import hashlib
 import re
 
 import yaml
@@ -53,6 +54,9 @@ def get_resource_type_from_path(path):
 def route_to_scope(route_rule, request_method):
     ''' Gives an authorization scope string for a route and a HTTP method.
     '''
+    # HEAD is a GET without the body, and needs the same access.
+    if request_method.upper() == 'HEAD':
+        request_method = 'GET'
     route_scope = re.sub(route_to_scope_re, 'id', route_rule)
     route_scope = route_scope.replace(u'/', u'_')
     route_scope = u'uapi%s_%s' % (route_scope, request_method)
@@ -172,6 +176,23 @@ def table_name(**kwargs):
     assert False  # pragma: no cover
 
 
+def index_name(table_name, column_names):
+    '''Construct an index name for columns in a table.
+
+    PostgreSQL truncates names to 63 characters, which could make
+    names of different indexes the same. Long names are shortened
+    and made unique with a hash of the full name.
+
+    '''
+
+    name = u'{}__idx_{}'.format(table_name, u'_'.join(column_names))
+    max_len = 63
+    if len(name) > max_len:
+        digest = hashlib.sha1(name.encode('utf-8')).hexdigest()[:16]
+        name = u'{}_{}'.format(name[:max_len - len(digest) - 1], digest)
+    return name
+
+
 class ComplicatedTableNameError(qvarn.QvarnException):
 
     msg = (u'Internal error: tried to construct a database table name '
@@ -230,6 +251,53 @@ def create_tables_from_schema(transaction, schema):  # pragma: no cover
         transaction.create_table(table, tables[table])
 
 
+def create_indexes_for_resource_type(
+        transaction, resource_type, prototype_list):  # pragma: no cover
+    '''Create database indexes for a resource type.
+
+    The arguments are as for ``create_tables_for_resource_type``.
+    Indexes that already exist are left alone.
+
+    '''
+
+    for prototype, kwargs in prototype_list:
+        schema = qvarn.schema_from_prototype(
+            prototype, resource_type=resource_type, **kwargs)
+        create_indexes_from_schema(transaction, schema)
+
+
+def create_indexes_from_schema(transaction, schema):  # pragma: no cover
+    '''Create indexes for looking up rows of tables in a schema by id.
+
+    Every table with an id column gets an index on the id and the
+    list position columns, which also serves lookups by id alone.
+
+    '''
+
+    for table, column_names in index_columns_from_schema(schema):
+        transaction.create_index(
+            index_name(table, column_names), table, column_names)
+
+
+def index_columns_from_schema(schema):
+    '''Return list of (table name, column names) to index for a schema.'''
+
+    pos_names = (u'dict_list_pos', u'list_pos', u'str_list_pos')
+    tables = {}
+    order = []
+    for table, column, _ in schema:
+        if table not in tables:
+            tables[table] = []
+            order.append(table)
+        tables[table].append(column)
+
+    return [
+        (table, [u'id'] + [x for x in pos_names if x in tables[table]])
+        for table in order
+        if u'id' in tables[table]
+    ]
+
+
 # We want to load strings as unicode, not str.
 # From http://stackoverflow.com/questions/2890146/
 # It seems this will be unnecessary in Python 3.
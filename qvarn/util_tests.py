@@ -46,6 +46,10 @@ class BasicRouteTests(unittest.TestCase):
         route_scope = qvarn.route_to_scope('/orgs/<item_id>', 'PUT')
         self.assertEqual(route_scope, u'uapi_orgs_id_put')
 
+    def test_head_route_needs_get_scope(self):
+        route_scope = qvarn.route_to_scope('/orgs/<item_id>', 'HEAD')
+        self.assertEqual(route_scope, u'uapi_orgs_id_get')
+
     def test_basic_subitem_route_to_scope(self):
         route_scope = qvarn.route_to_scope(
             '/orgs/<item_id>/document', 'PUT')
@@ -129,3 +133,47 @@ class TableNameTests(unittest.TestCase):
             qvarn.table_name(
                 resource_type=u'foo', auxtable=u'aux',
                 list_field='yo', subdict_list_field=u'bar')
+
+
+class IndexNameTests(unittest.TestCase):
+
+    def test_returns_name_with_table_and_columns(self):
+        self.assertEqual(
+            qvarn.index_name(u'foo_bars', [u'id', u'list_pos']),
+            u'foo_bars__idx_id_list_pos')
+
+    def test_shortens_long_names_uniquely(self):
+        table = u'x' * 70
+        name1 = qvarn.index_name(table, [u'id'])
+        name2 = qvarn.index_name(table, [u'id', u'list_pos'])
+        self.assertEqual(len(name1), 63)
+        self.assertEqual(len(name2), 63)
+        self.assertNotEqual(name1, name2)
+
+
+class IndexColumnsFromSchemaTests(unittest.TestCase):
+
+    def test_returns_id_and_position_columns_of_each_table(self):
+        prototype = {
+            u'type': u'',
+            u'id': u'',
+            u'foo': u'',
+            u'dicts': [
+                {
+                    u'bar': u'',
+                    u'bars': [u''],
+                },
+            ],
+        }
+        schema = qvarn.schema_from_prototype(prototype, resource_type=u'yo')
+        self.assertEqual(
+            sorted(qvarn.index_columns_from_schema(schema)),
+            [
+                (u'yo', [u'id']),
+                (u'yo_dicts', [u'id', u'list_pos']),
+                (u'yo_dicts_bars', [u'id', u'dict_list_pos', u'list_pos']),
+            ])
+
+    def test_skips_tables_without_id(self):
+        schema = [(u'yo__aux_versions', u'version', unicode)]
+        self.assertEqual(qvarn.index_columns_from_schema(schema), [])
@@ -16,6 +16,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import json
 import random
 
 import qvarn
@@ -33,6 +34,8 @@ class VersionedStorage(object):
     def __init__(self):
         self._resource_type = None
         self._versions = []
+        self._json_document = False
+        self._prepare_callbacks = []
 
     def get_resource_type(self):
         return self._resource_type
@@ -40,6 +43,29 @@ class VersionedStorage(object):
     def set_resource_type(self, resource_type):
         self._resource_type = resource_type
 
+    def set_json_document(self, enabled):
+        '''Set whether the main table keeps items as JSON documents.
+
+        If so, ``prepare_storage`` adds the column for the documents,
+        and ``fill_json_documents`` fills it in for items that don't
+        have one yet. If not, ``prepare_storage`` clears any documents
+        in the column, since writes don't keep them up to date.
+
+        '''
+
+        self._json_document = enabled
+
+    def add_prepare_callback(self, callback):
+        '''Call ``callback(transaction)`` whenever storage is prepared.
+
+        This is for tables that are not described by the prototypes of
+        the versions. The callback must work whether or not it has been
+        called before.
+
+        '''
+
+        self._prepare_callbacks.append(callback)
+
     @property
     def _versions_table_name(self):
         return qvarn.table_name(
@@ -56,12 +82,32 @@ class VersionedStorage(object):
         v = self._versions[-1]
         v.add_prototype(prototype, kwargs)
 
+    def add_search_index(self, field, rules=None, **kwargs):
+        '''Declare an index for searches on a field.
+
+        ``rules`` is a list of search rules the index should serve:
+        ``exact`` (the default, which also serves ``gt``, ``lt``, etc),
+        ``startswith``, ``contains``, or ``sort``. If keyword
+        arguments are given, only tables of the prototype added with
+        the same arguments are indexed, otherwise all tables with the
+        field are.
+
+        '''
+
+        rules = rules or [u'exact']
+        for rule in rules:
+            if rule not in search_index_rules:
+                raise UnknownSearchIndexRule(field=field, rule=rule)
+        v = self._versions[-1]
+        v.add_search_index(field, rules, kwargs)
+
     def prepare_storage(self, transaction):
         self._prepare_versions_table(transaction)
         versions = self._get_known_versions(transaction)
         qvarn.log.log('previously-prepared-versions', versions=versions)
 
         if self._versions:
+            items_changed = False
             first = self._versions[0]
             if first.version not in versions:
                 self._prepare_first_version(transaction, first)
@@ -70,10 +116,83 @@ class VersionedStorage(object):
             prev_version = first
             for v in self._versions[1:]:
                 if v.version not in versions:
-                    self._prepare_next_version(transaction, prev_version, v)
+                    if self._prepare_next_version(
+                            transaction, prev_version, v):
+                        items_changed = True
                     self._remember_version(transaction, v)
                 prev_version = v
 
+            self._prepare_json_document_column(transaction, items_changed)
+
+        for callback in self._prepare_callbacks:
+            callback(transaction)
+
+    def create_indexes(self, transaction):
+        '''Create all indexes of the latest version.
+
+        These are the indexes for looking up rows by id, and the
+        search indexes. This should be done after ``prepare_storage``,
+        since indexes of renamed tables keep their names until the
+        tables are dropped, preferably in an autocommit transaction,
+        so that indexes can be created without locking out writes to
+        the tables.
+
+        '''
+
+        if not self._versions:
+            return
+        qvarn.create_indexes_for_resource_type(
+            transaction, self._resource_type,
+            self._versions[-1].prototype_list)
+        self.create_search_indexes(transaction)
+
+    def create_search_indexes(self, transaction):
+        '''Create the search indexes declared for the latest version.
+
+        This should be done after ``prepare_storage``, preferably in
+        an autocommit transaction, so that indexes can be created
+        without locking out writes to the tables.
+
+        '''
+
+        if not self._versions:
+            return
+        version = self._versions[-1]
+        for field, rules, kwargs in version.search_indexes:
+            columns = self._find_search_index_columns(version, field, kwargs)
+            if not columns:
+                raise SearchIndexFieldNotInResource(field=field)
+            for table_name, column_type in columns:
+                for rule in rules:
+                    self._create_search_index(
+                        transaction, table_name, field, column_type, rule)
+
+    def _find_search_index_columns(self, version, field, kwargs):
+        columns = []
+        for prototype, proto_kwargs in version.prototype_list:
+            if kwargs and kwargs != proto_kwargs:
+                continue
+            schema = qvarn.schema_from_prototype(
+                prototype, resource_type=self._resource_type, **proto_kwargs)
+            columns.extend(
+                (table_name, column_type)
+                for table_name, column_name, column_type in schema
+                if column_name == field)
+        return columns
+
+    def _create_search_index(self, transaction, table_name, column_name,
+                             column_type, rule):
+        index_name = qvarn.index_name(table_name, [column_name, rule])
+        created = transaction.create_search_index(
+            index_name, table_name, column_name, column_type, rule)
+        qvarn.log.log(
+            'create-search-index',
+            index_name=index_name,
+            table_name=table_name,
+            column_name=column_name,
+            rule=rule,
+            created=created)
+
     def _prepare_versions_table(self, transaction):
         transaction.create_table(
             self._versions_table_name, {u'version': unicode})
@@ -143,9 +262,96 @@ class VersionedStorage(object):
             transaction.drop_table(table)
 
         # Drop all old tables that are no longer needed.
-        for table in old_tables:  # pragma: no cover
-            if table not in new_tables:
-                transaction.drop_table(table)
+        removed_tables = [
+            table for table in old_tables if table not in new_tables]
+        for table in removed_tables:  # pragma: no cover
+            transaction.drop_table(table)
+
+        # Tell whether items may have changed.
+        return bool(changed_tables or added_tables or removed_tables or
+                    new_version.func)
+
+    def _prepare_json_document_column(self, transaction, items_changed):
+        table_name = qvarn.table_name(resource_type=self._resource_type)
+        column_name = qvarn.json_document_column
+        exists = column_name in transaction.get_column_names(table_name)
+        if self._json_document and not exists:
+            transaction.add_column(table_name, column_name, unicode)
+        elif self._json_document and items_changed:
+            # New versions changed the tables of the items, or their
+            # data, without changing the documents.
+            transaction.update(table_name, None, {column_name: None})
+        elif exists and not self._json_document:
+            # Writes don't change the documents while they're turned
+            # off, so they must all be filled in again if they're
+            # turned back on.
+            transaction.update(
+                table_name, ('IS NOT NULL', table_name, column_name),
+                {column_name: None})
+
+    def fill_json_documents(self, dbconn):
+        '''Fill in the JSON documents that items don't have yet.
+
+        This should be done after ``prepare_storage``. The items are
+        filled in ``json_document_batch_size`` at a time, in order of
+        id, each batch in its own transaction, so that the main table
+        is never locked for long. A document is only stored if the
+        item has not been changed since it was read.
+
+        '''
+
+        if not self._json_document or not self._versions:
+            return
+
+        prototype = self._get_main_prototype(self._versions[-1])
+        ro = qvarn.ReadOnlyStorage()
+        ro.set_item_prototype(self._resource_type, prototype)
+
+        item_count = 0
+        last_id = None
+        while True:
+            with dbconn.transaction() as t:
+                item_ids = self._find_items_without_document(t, last_id)
+                for item in ro.get_items(t, item_ids):
+                    self._store_json_document(t, prototype, item)
+            item_count += len(item_ids)
+            if len(item_ids) < json_document_batch_size:
+                break
+            last_id = item_ids[-1]
+
+        qvarn.log.log(
+            'backfill-json-documents',
+            resource_type=self._resource_type,
+            item_count=item_count)
+
+    def _find_items_without_document(self, transaction, last_id):
+        table_name = qvarn.table_name(resource_type=self._resource_type)
+        condition = ('IS NULL', table_name, qvarn.json_document_column)
+        if last_id is not None:
+            condition = (
+                'AND', condition, ('>', table_name, u'id', last_id))
+        rows = transaction.select(
+            table_name, [u'id'], condition,
+            limit=json_document_batch_size, order_by=[u'id'])
+        return [row[u'id'] for row in rows]
+
+    def _store_json_document(self, transaction, prototype, item):
+        table_name = qvarn.table_name(resource_type=self._resource_type)
+        document = qvarn.make_json_document(prototype, item)
+        match = (
+            'AND',
+            ('=', table_name, u'id', item[u'id']),
+            ('=', table_name, u'revision', item[u'revision']),
+        )
+        transaction.update(
+            table_name, match,
+            {qvarn.json_document_column: json.dumps(document)})
+
+    def _get_main_prototype(self, version):
+        for prototype, kwargs in version.prototype_list:
+            if not kwargs:
+                return prototype
+        raise NoMainPrototype(version=version.version)
 
     def _make_table_dict_from_version(self, version):
         tables = {}
@@ -209,6 +415,33 @@ class Version(object):
         self.version = version
         self.func = update_data_func
         self.prototype_list = []
+        self.search_indexes = []
 
     def add_prototype(self, prototype, kwargs):
         self.prototype_list.append((prototype, kwargs))
+
+    def add_search_index(self, field, rules, kwargs):
+        self.search_indexes.append((field, rules, kwargs))
+
+
+search_index_rules = (u'exact', u'startswith', u'contains', u'sort')
+
+
+# How many items are read at once when filling in missing JSON
+# documents.
+json_document_batch_size = 100
+
+
+class UnknownSearchIndexRule(qvarn.QvarnException):
+
+    msg = u'Unknown rule {rule} in search index for field {field}'
+
+
+class SearchIndexFieldNotInResource(qvarn.QvarnException):
+
+    msg = u'Search index field {field} is not in resource type'
+
+
+class NoMainPrototype(qvarn.QvarnException):
+
+    msg = u'Version {version} has no prototype for the main table'
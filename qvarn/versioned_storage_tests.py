@@ -16,6 +16,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import json
 import unittest
 
 import qvarn
@@ -41,6 +42,21 @@ class VersionedStorageTests(unittest.TestCase):
         vs.start_version('v1', None)
         self.assertEqual(vs.get_versions(), ['v1'])
 
+    def test_calls_prepare_callbacks_every_time(self):
+        vs = qvarn.VersionedStorage()
+        vs.set_resource_type(u'foo')
+        vs.start_version(u'v1', None)
+        vs.add_prototype({u'type': u'', u'id': u''})
+        called = []
+        vs.add_prepare_callback(called.append)
+
+        dbconn = qvarn.DatabaseConnection()
+        dbconn.set_sql(qvarn.SqliteAdapter())
+        with dbconn.transaction() as t:
+            vs.prepare_storage(t)
+            vs.prepare_storage(t)
+        self.assertEqual(called, [t, t])
+
     def test_prepares_a_single_version(self):
         prototype_v1 = {
             u'type': u'',
@@ -125,3 +141,296 @@ class VersionedStorageTests(unittest.TestCase):
             self.assertEqual(
                 rows,
                 [{u'id': u'foo.id', u'bar': None, u'foobar': None}])
+
+    def test_creates_indexes_after_migrations(self):
+        prototype_v1 = {
+            u'type': u'',
+            u'id': u'',
+            u'foo': u'',
+            u'bars': [u''],
+        }
+
+        prototype_v2 = {
+            u'type': u'',
+            u'id': u'',
+            u'foo': u'',
+            u'foobar': u'',
+            u'bars': [u''],
+        }
+
+        vs = qvarn.VersionedStorage()
+        vs.set_resource_type(u'resource')
+        vs.start_version(u'v1', None)
+        vs.add_prototype(prototype_v1)
+        vs.start_version(u'v2', None)
+        vs.add_prototype(prototype_v2)
+
+        sql = qvarn.SqliteAdapter()
+        dbconn = qvarn.DatabaseConnection()
+        dbconn.set_sql(sql)
+        with dbconn.transaction() as t:
+            vs.prepare_storage(t)
+            vs.prepare_storage(t)
+        with dbconn.transaction(autocommit=True) as t:
+            vs.create_indexes(t)
+            vs.create_indexes(t)
+        with dbconn.transaction() as t:
+            rows = t.select(
+                u'sqlite_master', [u'name', u'tbl_name'],
+                (u'=', u'sqlite_master', u'type', u'index'))
+        self.assertEqual(
+            sorted((row[u'tbl_name'], row[u'name']) for row in rows),
+            [
+                (u'resource', u'resource__idx_id'),
+                (u'resource_bars', u'resource_bars__idx_id_list_pos'),
+            ])
+
+
+class JsonDocumentTests(unittest.TestCase):
+
+    resource_type = u'resource'
+
+    prototype_v1 = {
+        u'type': u'',
+        u'id': u'',
+        u'revision': u'',
+        u'foo': u'',
+        u'bars': [u''],
+    }
+
+    prototype_v2 = {
+        u'type': u'',
+        u'id': u'',
+        u'revision': u'',
+        u'foo': u'',
+        u'foobar': u'',
+        u'bars': [u''],
+    }
+
+    def setUp(self):
+        self.dbconn = qvarn.DatabaseConnection()
+        self.dbconn.set_sql(qvarn.SqliteAdapter())
+        self.table_name = qvarn.table_name(resource_type=self.resource_type)
+
+        vs = self.create_versioned_storage([self.prototype_v1])
+        with self.dbconn.transaction() as t:
+            vs.prepare_storage(t)
+            wo = qvarn.WriteOnlyStorage()
+            wo.set_item_prototype(self.resource_type, self.prototype_v1)
+            self.item = wo.add_item(t, {
+                u'type': self.resource_type,
+                u'foo': u'foo',
+                u'bars': [u'bar1', u'bar2'],
+            })
+
+    def create_versioned_storage(self, prototypes, json_document=False,
+                                 funcs=None):
+        vs = qvarn.VersionedStorage()
+        vs.set_resource_type(self.resource_type)
+        vs.set_json_document(json_document)
+        funcs = funcs or [None] * len(prototypes)
+        for i, (prototype, func) in enumerate(zip(prototypes, funcs)):
+            vs.start_version(u'v{}'.format(i + 1), func)
+            vs.add_prototype(prototype)
+        return vs
+
+    def prepare(self, vs):
+        with self.dbconn.transaction() as t:
+            vs.prepare_storage(t)
+        vs.fill_json_documents(self.dbconn)
+
+    def get_documents(self):
+        with self.dbconn.transaction() as t:
+            rows = t.select(
+                self.table_name, [qvarn.json_document_column], None)
+        return [
+            json.loads(row[qvarn.json_document_column] or u'null')
+            for row in rows
+        ]
+
+    def add_items(self, count):
+        with self.dbconn.transaction() as t:
+            wo = qvarn.WriteOnlyStorage()
+            wo.set_item_prototype(self.resource_type, self.prototype_v1)
+            for _ in range(count):
+                wo.add_item(t, {
+                    u'type': self.resource_type, u'foo': u'', u'bars': []})
+
+    def test_adds_column_and_fills_in_documents(self):
+        self.prepare(self.create_versioned_storage(
+            [self.prototype_v1], json_document=True))
+        self.assertEqual(self.get_documents(), [self.item])
+
+    def test_fills_in_documents_in_batches_of_own_transactions(self):
+        self.add_items(4)
+        dbconn = CountingConnection()
+        dbconn.set_sql(self.dbconn._sql)
+        vs = self.create_versioned_storage(
+            [self.prototype_v1], json_document=True)
+        with dbconn.transaction() as t:
+            vs.prepare_storage(t)
+
+        old_size = qvarn.versioned_storage.json_document_batch_size
+        qvarn.versioned_storage.json_document_batch_size = 2
+        try:
+            dbconn.count = 0
+            vs.fill_json_documents(dbconn)
+        finally:
+            qvarn.versioned_storage.json_document_batch_size = old_size
+        self.assertEqual(dbconn.count, 3)
+        self.assertNotIn(None, self.get_documents())
+        self.assertEqual(len(self.get_documents()), 5)
+
+    def test_does_not_store_document_of_changed_item(self):
+        vs = self.create_versioned_storage(
+            [self.prototype_v1], json_document=True)
+        with self.dbconn.transaction() as t:
+            vs.prepare_storage(t)
+            ro = qvarn.ReadOnlyStorage()
+            ro.set_item_prototype(self.resource_type, self.prototype_v1)
+            item = ro.get_item(t, self.item[u'id'])
+            item[u'revision'] = u'changed-meanwhile'
+            vs._store_json_document(t, self.prototype_v1, item)
+        self.assertEqual(self.get_documents(), [None])
+
+    def test_rebuilds_documents_after_new_version(self):
+        self.prepare(self.create_versioned_storage(
+            [self.prototype_v1], json_document=True))
+        self.prepare(self.create_versioned_storage(
+            [self.prototype_v1, self.prototype_v2], json_document=True))
+        item = dict(self.item, foobar=None)
+        self.assertEqual(self.get_documents(), [item])
+
+    def test_keeps_documents_after_version_that_changes_nothing(self):
+        self.prepare(self.create_versioned_storage(
+            [self.prototype_v1], json_document=True))
+        vs = self.create_versioned_storage(
+            [self.prototype_v1, self.prototype_v1], json_document=True)
+        with self.dbconn.transaction() as t:
+            vs.prepare_storage(t)
+        self.assertEqual(self.get_documents(), [self.item])
+
+    def test_rebuilds_documents_after_data_update(self):
+        self.prepare(self.create_versioned_storage(
+            [self.prototype_v1], json_document=True))
+
+        def update_data(transaction, temp_tables):
+            transaction.update(self.table_name, None, {u'foo': u'updated'})
+
+        self.prepare(self.create_versioned_storage(
+            [self.prototype_v1, self.prototype_v1], json_document=True,
+            funcs=[None, update_data]))
+        self.assertEqual(
+            self.get_documents(), [dict(self.item, foo=u'updated')])
+
+    def test_rebuilds_documents_turned_off_and_on_again(self):
+        self.prepare(self.create_versioned_storage(
+            [self.prototype_v1], json_document=True))
+        self.prepare(self.create_versioned_storage([self.prototype_v1]))
+        self.assertEqual(self.get_documents(), [None])
+
+        with self.dbconn.transaction() as t:
+            wo = qvarn.WriteOnlyStorage()
+            wo.set_item_prototype(self.resource_type, self.prototype_v1)
+            updated = wo.update_item(t, dict(self.item, foo=u'updated'))
+
+        self.prepare(self.create_versioned_storage(
+            [self.prototype_v1], json_document=True))
+        self.assertEqual(self.get_documents(), [updated])
+
+
+class CountingConnection(qvarn.DatabaseConnection):
+
+    def __init__(self):
+        super(CountingConnection, self).__init__()
+        self.count = 0
+
+    def transaction(self, autocommit=False):
+        self.count += 1
+        return super(CountingConnection, self).transaction(
+            autocommit=autocommit)
+
+
+class SearchIndexTests(unittest.TestCase):
+
+    prototype = {
+        u'type': u'',
+        u'id': u'',
+        u'foo': u'',
+        u'count': 0,
+        u'dicts': [
+            {
+                u'foo': u'',
+            },
+        ],
+    }
+
+    def setUp(self):
+        self.vs = qvarn.VersionedStorage()
+        self.vs.set_resource_type(u'yo')
+        self.vs.start_version(u'v1', None)
+        self.vs.add_prototype(self.prototype)
+        self.vs.add_prototype(
+            qvarn.notification_prototype, auxtable=u'notification')
+
+        sql = qvarn.SqliteAdapter()
+        self.dbconn = qvarn.DatabaseConnection()
+        self.dbconn.set_sql(sql)
+
+    def _create_search_indexes(self):
+        with self.dbconn.transaction() as t:
+            self.vs.prepare_storage(t)
+        with self.dbconn.transaction(autocommit=True) as t:
+            self.vs.create_search_indexes(t)
+        with self.dbconn.transaction() as t:
+            rows = t.select(
+                u'sqlite_master', [u'name', u'sql'],
+                (u'=', u'sqlite_master', u'type', u'index'))
+        return dict(
+            (row[u'name'], row[u'sql']) for row in rows
+            if u'__idx_id' not in row[u'name'])
+
+    def test_creates_no_search_indexes_by_default(self):
+        self.assertEqual(self._create_search_indexes(), {})
+
+    def test_indexes_lowercase_unicode_field_in_all_tables(self):
+        self.vs.add_search_index(u'foo')
+        self.assertEqual(
+            self._create_search_indexes(),
+            {
+                u'yo__idx_foo_exact':
+                u'CREATE INDEX yo__idx_foo_exact ON yo (LOWER(foo))',
+                u'yo_dicts__idx_foo_exact':
+                u'CREATE INDEX yo_dicts__idx_foo_exact '
+                u'ON yo_dicts (LOWER(foo))',
+            })
+
+    def test_indexes_other_field_and_sort_as_is(self):
+        self.vs.add_search_index(u'count')
+        self.vs.add_search_index(u'foo', [u'sort'])
+        indexes = self._create_search_indexes()
+        self.assertEqual(
+            indexes[u'yo__idx_count_exact'],
+            u'CREATE INDEX yo__idx_count_exact ON yo (count)')
+        self.assertEqual(
+            indexes[u'yo__idx_foo_sort'],
+            u'CREATE INDEX yo__idx_foo_sort ON yo (foo)')
+
+    def test_skips_rules_database_cannot_index(self):
+        self.vs.add_search_index(u'foo', [u'startswith', u'contains'])
+        self.assertEqual(self._create_search_indexes(), {})
+
+    def test_indexes_only_tables_of_given_prototype(self):
+        self.vs.add_search_index(u'type', auxtable=u'notification')
+        self.assertEqual(
+            self._create_search_indexes().keys(),
+            [u'yo__aux_notification__idx_type_exact'])
+
+    def test_raises_error_for_unknown_rule(self):
+        with self.assertRaises(qvarn.UnknownSearchIndexRule):
+            self.vs.add_search_index(u'foo', [u'nope'])
+
+    def test_raises_error_for_unknown_field(self):
+        self.vs.add_search_index(u'nope')
+        with self.assertRaises(qvarn.SearchIndexFieldNotInResource):
+            self._create_search_indexes()
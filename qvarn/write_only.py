@@ -16,9 +16,17 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import collections
+import json
+
 import qvarn
 
 
+# Name of the column on the main table of a resource type that has
+# the whole item as a JSON document, if the resource type keeps one.
+json_document_column = u'qvarn_json_document'
+
+
 class WriteOnlyStorage(object):
 
     '''Write-only interface to a database.
@@ -33,6 +41,7 @@ class WriteOnlyStorage(object):
         self._subitem_prototypes = qvarn.SubItemPrototypes()
         self._id_generator = qvarn.ResourceIdGenerator()
         self._revision_id_type = 'revision id'
+        self._json_document = False
 
     def set_item_prototype(self, item_type, prototype):
         '''Set type and prototype for items handled by this instance.'''
@@ -43,6 +52,16 @@ class WriteOnlyStorage(object):
         '''Set prototype for a subitem.'''
         self._subitem_prototypes.add(item_type, subitem_name, prototype)
 
+    def set_json_document(self, enabled):
+        '''Set whether items are also stored as JSON documents.
+
+        The main table MUST then have the ``json_document_column``
+        column.
+
+        '''
+
+        self._json_document = enabled
+
     def add_item(self, transaction, item):
         '''Add an item to the database.
 
@@ -52,77 +71,194 @@ class WriteOnlyStorage(object):
 
         '''
 
-        if u'id' in item:
-            raise CannotAddWithId(id=item[u'id'])
-        if u'revision' in item:
-            raise CannotAddWithRevision(revision=item[u'revision'])
+        return self.add_items(transaction, [item])[0]
 
-        added = dict(item)
-        added[u'id'] = self._id_generator.new_id(self._item_type)
-        added[u'revision'] = self._id_generator.new_id(self._revision_id_type)
+    def add_items(self, transaction, items):
+        '''Add many items to the database at once.
 
-        self._insert_item_into_database(transaction, added)
-        for subitem_name, prototype in self._subitem_prototypes.get_all():
-            self._insert_subitem_into_database(
-                transaction, added[u'id'], subitem_name, prototype)
-        return added
+        This is like ``add_item``, but the rows of each table are
+        inserted for all items with one statement. The added items are
+        returned in the same order.
 
-    def _insert_item_into_database(self, transaction, item):
-        ww = WriteWalker(transaction, self._item_type, item[u'id'])
+        '''
+
+        for item in items:
+            if u'id' in item:
+                raise CannotAddWithId(id=item[u'id'])
+            if u'revision' in item:
+                raise CannotAddWithRevision(revision=item[u'revision'])
+
+        rows = RowBuffer()
+        added_items = []
+        for item in items:
+            added = dict(item)
+            added[u'id'] = self._id_generator.new_id(self._item_type)
+            added[u'revision'] = self._id_generator.new_id(
+                self._revision_id_type)
+
+            self._insert_item_into_database(transaction, added, rows)
+            for subitem_name, prototype in self._subitem_prototypes.get_all():
+                self._insert_subitem_into_database(
+                    transaction, added[u'id'], subitem_name, prototype, rows)
+            added_items.append(added)
+        rows.flush(transaction)
+        return added_items
+
+    def _insert_item_into_database(self, transaction, item, rows=None):
+        main_columns = {}
+        if self._json_document:
+            document = make_json_document(self._prototype, item)
+            main_columns[json_document_column] = json.dumps(document)
+        ww = WriteWalker(
+            transaction, self._item_type, item[u'id'],
+            main_columns=main_columns, rows=rows)
         ww.walk_item(item, self._prototype)
 
     def _insert_subitem_into_database(self, transaction, item_id,
-                                      subitem_name, subitem):
+                                      subitem_name, subitem, rows=None):
         prototype = self._subitem_prototypes.get(self._item_type, subitem_name)
         table_name = qvarn.table_name(
             resource_type=self._item_type, subpath=subitem_name)
-        ww = WriteWalker(transaction, table_name, item_id)
+        ww = WriteWalker(transaction, table_name, item_id, rows=rows)
         ww.walk_item(subitem, prototype)
 
     def update_item(self, transaction, item):
         '''Update an existing item.
 
-        The item MUST have an id set.
+        The item MUST have an id set. Only the rows that differ from
+        the current item are updated, inserted or deleted. If nothing
+        differs, the revision stays the same.
 
         '''
 
-        current = self._get_current_revision(transaction, item[u'id'])
-        if current != item[u'revision']:
-            raise qvarn.WrongRevision(
-                item_id=item[u'id'],
-                current=current,
-                update=item[u'revision'])
+        return self.update_items(transaction, [item])[0]
 
-        updated = item.copy()
-        updated[u'revision'] = self._id_generator.new_id(
-            self._revision_id_type)
+    def update_items(self, transaction, items):
+        '''Update many existing items at once.
 
-        self._delete_item_in_transaction(
-            transaction, item[u'id'], delete_subitems=False)
+        This is like ``update_item``, but the current items are read
+        at once, and new rows of each table are inserted for all items
+        with one statement. If any item has the wrong revision,
+        nothing is updated. The updated items are returned in the same
+        order.
 
-        self._insert_item_into_database(transaction, updated)
-        return updated
+        The revision is checked when reading the current items, and
+        again by updating the main row only if it still has the same
+        revision, so that concurrent updates of an item can't both
+        succeed.
 
-    def _get_current_revision(self, transaction, item_id):
-        table_name = qvarn.table_name(resource_type=self._item_type)
-        column_names = [u'revision']
-        match_columns = ('=', table_name, u'id', item_id)
-        rows = transaction.select(table_name, column_names, match_columns)
-        for row in rows:
-            return row[u'revision']
+        '''
 
-    def update_subitem(self, transaction, item_id, revision, subitem_name,
-                       subitem):
-        current_revision = self._get_current_revision(transaction, item_id)
-        if current_revision != revision:
+        current_items = self._get_current_items(transaction, items)
+        for item in items:
+            current = current_items[item[u'id']][u'revision']
+            if current != item[u'revision']:
+                raise qvarn.WrongRevision(
+                    item_id=item[u'id'],
+                    current=current,
+                    update=item[u'revision'])
+
+        inserts = RowBuffer()
+        updated_items = []
+        for item in items:
+            old_rows = self._get_item_rows(current_items[item[u'id']])
+
+            # The item has the current revision, so if its rows are
+            # the same as the current ones, nothing has changed.
+            if not _diff_rows(old_rows, self._get_item_rows(item)):
+                updated_items.append(item.copy())
+                continue
+
+            updated = item.copy()
+            updated[u'revision'] = self._id_generator.new_id(
+                self._revision_id_type)
+            changes = _diff_rows(old_rows, self._get_item_rows(updated))
+            if self._json_document:
+                self._add_json_document_change(changes, updated)
+            self._apply_row_changes(
+                transaction, changes, inserts, item[u'revision'])
+            updated_items.append(updated)
+        inserts.flush(transaction)
+        return updated_items
+
+    def _get_current_items(self, transaction, items):
+        ro = qvarn.ReadOnlyStorage()
+        ro.set_item_prototype(self._item_type, self._prototype)
+        revisions = dict((item[u'id'], item[u'revision']) for item in items)
+        try:
+            found = ro.get_items(transaction, [item[u'id'] for item in items])
+        except qvarn.ItemDoesNotExist as e:
+            item_id = e.error[u'item_id']
+            raise qvarn.WrongRevision(
+                item_id=item_id, current=None, update=revisions[item_id])
+        return dict((item[u'id'], item) for item in found)
+
+    def _get_item_rows(self, item):
+        # The JSON document is left out, as values read from some
+        # databases, such as booleans from SQLite, are serialised
+        # differently.
+        rows = RowBuffer()
+        ww = WriteWalker(None, self._item_type, item[u'id'], rows=rows)
+        ww.walk_item(item, self._prototype)
+        return rows.get_rows()
+
+    def _add_json_document_change(self, changes, item):
+        # The revision always changes, so the main row is updated.
+        document = make_json_document(self._prototype, item)
+        for op, table_name, _, values in changes:
+            if op == u'update' and table_name == self._item_type:
+                values[json_document_column] = json.dumps(document)
+
+    def _apply_row_changes(self, transaction, changes, inserts,
+                           old_revision):
+        deletes = collections.OrderedDict()
+        for op, table_name, key, values in changes:
+            if op == u'insert':
+                inserts.add(table_name, values)
+            elif op == u'update' and table_name == self._item_type:
+                self._update_main_row(
+                    transaction, key[u'id'], old_revision, values)
+            elif op == u'update':
+                transaction.update(
+                    table_name, _key_condition(table_name, key), values)
+            else:
+                # Rows of a shortened list are deleted with one
+                # statement per list.
+                list_key = dict(key)
+                list_pos = list_key.pop(u'list_pos')
+                group = (table_name, tuple(sorted(list_key.items())))
+                deletes.setdefault(group, []).append(list_pos)
+
+        for (table_name, list_key), positions in deletes.items():
+            condition = _key_condition(table_name, dict(list_key))
+            condition = (
+                'AND', condition, ('IN', table_name, u'list_pos', positions))
+            transaction.delete(table_name, condition)
+
+    def _update_main_row(self, transaction, item_id, old_revision, values):
+        # The revision check and the write are one statement, so no
+        # other transaction can change the item in between.
+        table_name = qvarn.table_name(resource_type=self._item_type)
+        match = (
+            'AND',
+            ('=', table_name, u'id', item_id),
+            ('=', table_name, u'revision', old_revision),
+        )
+        if transaction.update(table_name, match, values) == 0:
             raise qvarn.WrongRevision(
                 item_id=item_id,
-                current=current_revision,
-                update=revision)
+                current=self._get_current_revision(transaction, item_id),
+                update=old_revision)
 
-        # Update revision of main item.
+    def _get_current_revision(self, transaction, item_id):
+        return qvarn.select_revision(transaction, self._item_type, item_id)
+
+    def update_subitem(self, transaction, item_id, revision, subitem_name,
+                       subitem):
+        # Update revision of main item, if it has the expected one.
         new_revision = self._id_generator.new_id(self._revision_id_type)
-        self._update_revision(transaction, item_id, new_revision)
+        self._update_main_row(
+            transaction, item_id, revision, {u'revision': new_revision})
 
         # Add or replace subitem.
         self._delete_subitem_in_transaction(
@@ -132,26 +268,30 @@ class WriteOnlyStorage(object):
 
         return new_revision
 
-    def _update_revision(self, transaction, item_id, new_revision):
-        table_name = qvarn.table_name(resource_type=self._item_type)
-        match_columns = ('=', table_name, u'id', item_id)
-        values = {
-            u'revision': new_revision,
-        }
-        transaction.update(table_name, match_columns, values)
-
     def delete_item(self, transaction, item_id):
         '''Delete an item given its id.'''
-        self._delete_item_in_transaction(transaction, item_id)
+        self.delete_items(transaction, [item_id])
 
-    def _delete_item_in_transaction(self, transaction, item_id,
-                                    delete_subitems=True):
-        dw = DeleteWalker(transaction, self._item_type, item_id)
-        dw.walk_item(self._prototype, self._prototype)
-        if delete_subitems:
-            for subitem_name, _ in self._subitem_prototypes.get_all():
-                self._delete_subitem_in_transaction(
-                    transaction, item_id, subitem_name)
+    def delete_items(self, transaction, item_ids):
+        '''Delete many items given their ids.
+
+        The rows of each table are deleted with as few statements as
+        possible.
+
+        '''
+
+        self._delete_items_in_transaction(transaction, item_ids)
+
+    def _delete_items_in_transaction(self, transaction, item_ids):
+        subitems = self._subitem_prototypes.get_all()
+        for chunk in id_chunks(item_ids):
+            dw = BatchDeleteWalker(transaction, self._item_type, chunk)
+            dw.walk_item(self._prototype, self._prototype)
+            for subitem_name, prototype in subitems:
+                table_name = qvarn.table_name(
+                    resource_type=self._item_type, subpath=subitem_name)
+                dw = BatchDeleteWalker(transaction, table_name, chunk)
+                dw.walk_item(prototype, prototype)
 
     def _delete_subitem_in_transaction(self, transaction, item_id,
                                        subitem_name):
@@ -162,6 +302,95 @@ class WriteOnlyStorage(object):
         dw.walk_item(prototype, prototype)
 
 
+# The most item ids in one IN condition, so that statements stay
+# within the placeholder limits of all databases.
+max_ids_per_query = 500
+
+
+def id_chunks(item_ids):
+    '''Split a list of ids into lists of at most max_ids_per_query.'''
+    for i in range(0, len(item_ids), max_ids_per_query):
+        yield item_ids[i:i + max_ids_per_query]
+
+
+# The columns that identify a row of an item in any table. Tables of
+# lists have list_pos, and tables of lists in dicts in lists also have
+# dict_list_pos.
+_key_columns = (u'id', u'dict_list_pos', u'list_pos')
+
+
+def _diff_rows(old_rows, new_rows):
+    '''Compare the rows of an item before and after a change.
+
+    Both arguments map table names to lists of rows, as collected by
+    a RowBuffer. Return a list of (op, table_name, key, values)
+    tuples, where op is ``insert``, ``update`` or ``delete``, key has
+    the values of the key columns of the row, and values has the
+    columns to insert or update.
+
+    '''
+
+    changes = []
+    for table_name in _union_keys(old_rows, new_rows):
+        old_by_key = _rows_by_key(old_rows.get(table_name, []))
+        new_by_key = _rows_by_key(new_rows.get(table_name, []))
+        for row_key, row in new_by_key.items():
+            key = dict(row_key)
+            if row_key not in old_by_key:
+                changes.append((u'insert', table_name, key, row))
+                continue
+            old_row = old_by_key[row_key]
+            values = dict(
+                (name, value)
+                for name, value in row.items()
+                if name not in key and old_row.get(name) != value)
+            if values:
+                changes.append((u'update', table_name, key, values))
+        for row_key in old_by_key:
+            if row_key not in new_by_key:
+                changes.append((u'delete', table_name, dict(row_key), None))
+    return changes
+
+
+def _union_keys(first, second):
+    return list(first) + [x for x in second if x not in first]
+
+
+def _rows_by_key(rows):
+    return collections.OrderedDict(
+        (tuple((name, row[name]) for name in _key_columns if name in row),
+         row)
+        for row in rows)
+
+
+def _key_condition(table_name, key):
+    conds = tuple(
+        ('=', table_name, name, key[name]) for name in sorted(key))
+    if len(conds) == 1:
+        return conds[0]
+    return ('AND',) + conds
+
+
+def make_json_document(prototype, item):
+    '''Make the JSON document of an item, as it would be read back.
+
+    Fields that aren't in the prototype are left out, and missing
+    fields are filled in as ReadWalker would return them.
+
+    '''
+
+    document = {}
+    for field, proto_value in prototype.items():
+        value = item.get(field)
+        if isinstance(proto_value, list):
+            value = list(value or [])
+            if proto_value and isinstance(proto_value[0], dict):
+                value = [
+                    make_json_document(proto_value[0], x) for x in value]
+        document[field] = value
+    return document
+
+
 class CannotAddWithId(qvarn.BadRequest):
 
     msg = u"Object being added already has an id"
@@ -179,20 +408,68 @@ class WrongRevision(qvarn.Conflict):
            'update wants to update {update}')
 
 
+class RowBuffer(object):
+
+    '''Collect rows to insert, so that each table gets one INSERT.'''
+
+    def __init__(self):
+        self._rows = collections.OrderedDict()
+
+    def add(self, table_name, columns):
+        if table_name not in self._rows:
+            self._rows[table_name] = []
+        self._rows[table_name].append(columns)
+
+    def get_rows(self):
+        '''Return a dict mapping table names to lists of rows.'''
+        return dict(self._rows)
+
+    def flush(self, transaction):
+        for table_name, rows in self._rows.items():
+            transaction.insert_many(table_name, rows)
+        self._rows.clear()
+
+
 class WriteWalker(qvarn.ItemWalker):
 
-    '''Visit every part of an item to write it to database.'''
+    '''Visit every part of an item to write it to database.
 
-    def __init__(self, transaction, item_type, item_id):
+    ``main_columns`` gives values for columns of the main table that
+    aren't in the prototype.
+
+    Rows are collected per table in a RowBuffer while walking. If
+    ``rows`` is given, the caller inserts them later, otherwise each
+    table's rows are inserted with one statement at the end of
+    ``walk_item``.
+
+    '''
+
+    def __init__(self, transaction, item_type, item_id, main_columns=None,
+                 rows=None):
         self._transaction = transaction
         self._item_type = item_type
         self._item_id = item_id
+        self._main_columns = main_columns or {}
+        self._rows = rows
+
+    def walk_item(self, item, proto_item):
+        if self._rows is not None:
+            super(WriteWalker, self).walk_item(item, proto_item)
+        else:
+            self._rows = RowBuffer()
+            super(WriteWalker, self).walk_item(item, proto_item)
+            self._rows.flush(self._transaction)
+            self._rows = None
+
+    def _insert(self, table_name, columns):
+        self._rows.add(table_name, columns)
 
     def visit_main_dict(self, item, column_names):
-        columns = dict((x, item[x]) for x in column_names)
+        columns = dict(self._main_columns)
+        columns.update((x, item[x]) for x in column_names)
         if u'id' not in column_names:
             columns[u'id'] = self._item_id
-        self._transaction.insert(self._item_type, columns)
+        self._insert(self._item_type, columns)
 
     def visit_main_str_list(self, item, field):
         table_name = qvarn.table_name(
@@ -211,7 +488,7 @@ class WriteWalker(qvarn.ItemWalker):
             columns = dict(prefix)
             columns[u'list_pos'] = i
             columns[column_name] = str_value
-            self._transaction.insert(table_name, columns)
+            self._insert(table_name, columns)
 
     def visit_dict_in_list(self, item, field, pos, column_names):
         table_name = qvarn.table_name(
@@ -222,7 +499,7 @@ class WriteWalker(qvarn.ItemWalker):
         }
         for column_name in column_names:
             columns[column_name] = item[field][pos][column_name]
-        self._transaction.insert(table_name, columns)
+        self._insert(table_name, columns)
 
     def visit_dict_in_list_str_list(self, item, field, pos, str_list_field):
         table_name = qvarn.table_name(
@@ -247,7 +524,7 @@ class WriteWalker(qvarn.ItemWalker):
         inner_dict = item[field][outer_pos][inner_field][inner_pos]
         for column_name in column_names:
             columns[column_name] = inner_dict[column_name]
-        self._transaction.insert(table_name, columns)
+        self._insert(table_name, columns)
 
 
 class DeleteWalker(qvarn.ItemWalker):
@@ -288,3 +565,16 @@ class DeleteWalker(qvarn.ItemWalker):
             list_field=field,
             subdict_list_field=inner_field)
         self._delete_rows(table_name, self._item_id)
+
+
+class BatchDeleteWalker(DeleteWalker):
+
+    '''Visit every part of a prototype to delete many items at once.'''
+
+    def __init__(self, transaction, item_type, item_ids):
+        super(BatchDeleteWalker, self).__init__(transaction, item_type, None)
+        self._item_ids = item_ids
+
+    def _delete_rows(self, table_name, item_id):
+        self._transaction.delete(
+            table_name, ('IN', table_name, u'id', self._item_ids))
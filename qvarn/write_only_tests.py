@@ -16,6 +16,9 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import collections
+import copy
+import json
 import unittest
 
 import qvarn
@@ -174,6 +177,68 @@ class WriteOnlyStorageTests(unittest.TestCase):
             self.wo.delete_item(t, added1[u'id'])
             self.assertEqual(self.ro.get_item_ids(t), [added2[u'id']])
 
+    def test_inserts_rows_of_each_table_with_one_statement(self):
+        with self.dbconn.transaction() as t:
+            counter = StatementCounter(t)
+            added = self.wo.add_item(counter, self.person)
+            obj = self.get_item_from_disk(t, added)
+        self.assertEqual(added, obj)
+        # One each for the main table, aliases, addrs, addrs lines,
+        # addrs inner, and the subitem.
+        self.assertEqual(counter.counts['insert_many'], 6)
+
+    def test_updates_only_changed_rows(self):
+        with self.dbconn.transaction() as t:
+            added = self.wo.add_item(t, self.person)
+            person_v2 = dict(added)
+            person_v2[u'name'] = u'Bruce Wayne'
+            counter = StatementCounter(t)
+            updated = self.wo.update_item(counter, person_v2)
+            obj = self.get_item_from_disk(t, added)
+        self.assertEqual(updated, obj)
+        self.assertEqual(counter.counts['update'], 1)
+        self.assertEqual(counter.counts['delete'], 0)
+        self.assertEqual(counter.counts['insert_many'], 0)
+
+    def test_refuses_update_if_revision_changes_after_reading(self):
+        with self.dbconn.transaction() as t:
+            added = self.wo.add_item(t, self.person)
+            person_v2 = dict(added)
+            person_v2[u'name'] = u'Bruce Wayne'
+            racer = RevisionChanger(t, self.resource_type, added[u'id'])
+            with self.assertRaises(qvarn.WrongRevision) as cm:
+                self.wo.update_item(racer, person_v2)
+        self.assertEqual(cm.exception.error[u'current'], u'other-revision')
+
+    def test_refuses_to_update_missing_item(self):
+        with self.dbconn.transaction() as t:
+            person = dict(self.person, id=u'nonexistent', revision=u'1')
+            with self.assertRaises(qvarn.WrongRevision):
+                self.wo.update_item(t, person)
+
+    def test_updates_lists_that_grow_and_shrink(self):
+        with self.dbconn.transaction() as t:
+            added = self.wo.add_item(t, self.person)
+            person_v2 = copy.deepcopy(added)
+            person_v2[u'aliases'].append(u'Bruce Wayne')
+            del person_v2[u'addrs'][1]
+            person_v2[u'addrs'][0][u'lines'] = [u'addr1']
+            person_v2[u'addrs'][0][u'inner'].append({u'inner_str': u'new'})
+            updated = self.wo.update_item(t, person_v2)
+            obj = self.get_item_from_disk(t, added)
+        self.assertEqual(updated, obj)
+
+    def test_keeps_revision_if_nothing_changes(self):
+        with self.dbconn.transaction() as t:
+            added = self.wo.add_item(t, self.person)
+            counter = StatementCounter(t)
+            updated = self.wo.update_item(counter, dict(added))
+            obj = self.get_item_from_disk(t, added)
+        self.assertEqual(updated, added)
+        self.assertEqual(obj, added)
+        self.assertEqual(counter.counts['update'], 0)
+        self.assertEqual(counter.counts['insert_many'], 0)
+
     def test_updates_subitem(self):
         with self.dbconn.transaction() as t:
             added = self.wo.add_item(t, self.person)
@@ -187,6 +252,19 @@ class WriteOnlyStorageTests(unittest.TestCase):
             updated_item = self.ro.get_item(t, added[u'id'])
             self.assertNotEqual(updated_item[u'revision'], added[u'revision'])
 
+    def test_checks_subitem_revision_without_select(self):
+        with self.dbconn.transaction() as t:
+            added = self.wo.add_item(t, self.person)
+            subitem = {
+                u'secret_identity': u'Peter Parker',
+            }
+            counter = StatementCounter(t)
+            self.wo.update_subitem(
+                counter, added[u'id'], added[u'revision'], self.subitem_name,
+                subitem)
+        self.assertEqual(counter.counts['select'], 0)
+        self.assertEqual(counter.counts['update'], 1)
+
     def test_refuses_to_update_subitem_without_correct_revision(self):
         with self.dbconn.transaction() as t:
             added = self.wo.add_item(t, self.person)
@@ -200,3 +278,106 @@ class WriteOnlyStorageTests(unittest.TestCase):
 
             item = self.ro.get_item(t, added[u'id'])
             self.assertEqual(item, added)
+
+
+class StatementCounter(object):
+
+    def __init__(self, transaction):
+        self._transaction = transaction
+        self.counts = collections.Counter()
+
+    def __getattr__(self, name):
+        method = getattr(self._transaction, name)
+
+        def counted(*args, **kwargs):
+            self.counts[name] += 1
+            return method(*args, **kwargs)
+        return counted
+
+
+class RevisionChanger(object):
+
+    '''Change an item's revision just before its first update.
+
+    This pretends another transaction updated the item after it was
+    read.
+
+    '''
+
+    def __init__(self, transaction, resource_type, item_id):
+        self._transaction = transaction
+        self._table_name = qvarn.table_name(resource_type=resource_type)
+        self._item_id = item_id
+        self._changed = False
+
+    def __getattr__(self, name):
+        return getattr(self._transaction, name)
+
+    def update(self, *args, **kwargs):
+        if not self._changed:
+            self._changed = True
+            self._transaction.update(
+                self._table_name,
+                ('=', self._table_name, u'id', self._item_id),
+                {u'revision': u'other-revision'})
+        return self._transaction.update(*args, **kwargs)
+
+
+class JsonDocumentWriteOnlyStorageTests(WriteOnlyStorageTests):
+
+    def setUp(self):
+        super(JsonDocumentWriteOnlyStorageTests, self).setUp()
+        table_name = qvarn.table_name(resource_type=self.resource_type)
+        with self.dbconn.transaction() as t:
+            t.add_column(table_name, qvarn.json_document_column, unicode)
+        self.wo.set_json_document(True)
+        self.ro.set_json_document(True)
+
+    def get_document(self, transaction, item_id):
+        table_name = qvarn.table_name(resource_type=self.resource_type)
+        rows = transaction.select(
+            table_name, [qvarn.json_document_column],
+            ('=', table_name, u'id', item_id))
+        return json.loads(rows[0][qvarn.json_document_column])
+
+    def test_stores_document_of_added_item(self):
+        with self.dbconn.transaction() as t:
+            added = self.wo.add_item(t, self.person)
+            self.assertEqual(self.get_document(t, added[u'id']), added)
+
+    def test_stores_document_of_updated_item(self):
+        with self.dbconn.transaction() as t:
+            added = self.wo.add_item(t, self.person)
+            person_v2 = dict(added)
+            person_v2[u'name'] = u'Bruce Wayne'
+            updated = self.wo.update_item(t, person_v2)
+            self.assertEqual(self.get_document(t, added[u'id']), updated)
+
+
+class MakeJsonDocumentTests(unittest.TestCase):
+
+    def test_fills_in_missing_fields_and_drops_unknown_ones(self):
+        prototype = {
+            u'name': u'',
+            u'age': 0,
+            u'aliases': [u''],
+            u'addrs': [
+                {
+                    u'country': u'',
+                    u'lines': [u''],
+                },
+            ],
+        }
+        item = {
+            u'name': u'James Bond',
+            u'addrs': [{u'country': u'GB'}],
+            u'unknown': u'ignored',
+        }
+        self.assertEqual(
+            qvarn.make_json_document(prototype, item),
+            {
+                u'name': u'James Bond',
+                u'age': None,
+                u'aliases': [],
+                u'addrs': [{u'country': u'GB', u'lines': []}],
+            })